@@ -20,7 +20,7 @@ import time
 import re
 import pexpect
 
-from switchdevice import Switch
+from switchdevice import Switch, cached_fact, FINGERPRINT_PREFIX
 from parseclock import parse_clock_arubacli
 
 try:
@@ -157,8 +157,8 @@ class ArubaSwitch(Switch):
                 "#",
                 pexpect.EOF,
                 pexpect.TIMEOUT]
-            ret = self.pexp.expect(responses, timeout=5)
-            #ret = self.pexp.expect(responses)
+            ret = self.timed_expect('prompt', responses, 5)
+            #ret = self.expect(responses)
             #if ret < 6:
             #    ln_before = self.pexp.before.decode('UTF-8')
             #    ln_after = self.pexp.after.decode('UTF-8')
@@ -182,7 +182,7 @@ class ArubaSwitch(Switch):
             else:
                 L.debug("got eof/timeout")
                 self.pexp.sendline("\r\n")
-            time.sleep(2)
+            time.sleep(self.get_poll_interval('prompt', 2))
 
         self.pexp.sendline("terminal width 512\r\n")
         self.pexp.sendline("terminal length 512\r\n")
@@ -192,11 +192,15 @@ class ArubaSwitch(Switch):
         #self.pexp.sendcontrol('c')
         self.pexp.sendline('end\r\n')
         self.pexp.sendline("exit\r\n")
-        ret = self.pexp.expect(["\(y/n\)","\(yes/no\)","\[yes/no\]", "\[confirm\]","Press RETURN to get started.",">","#"])
+        ret = self.expect(["\(y/n\)","\(yes/no\)","\[yes/no\]", "\[confirm\]","Press RETURN to get started.",">","#"])
         if ret < 1:
             self.pexp.sendline("y")
         self.pexp.sendline()
 
+    # 'console baud-rate' takes effect after reboot only, the console speed is not changed
+    def _send_console_speed(self, baud):
+        return False
+
     # save the current config to disk
     def save_config(self):
         self._enter_enable()
@@ -204,15 +208,18 @@ class ArubaSwitch(Switch):
         #self.pexp.sendline("copy startup-config default-config\r\n")
         self.pexp.sendline("write memory")
         L.info("save_config DONE.")
-        self.pexp.expect(["#"])
+        self.expect(["#"])
 
     def _wait_reboot(self):
+        tm_start = time.monotonic()
+        # wake the console if no boot messages in the interval
+        timeout = max(self.get_timeout('prompt', 5) * 3, 5)
         exp_list = [
             "\(y/n\)","\(yes/no\)","\[yes/no\]", "\[confirm\]",
             "Rebooting the System", "Initialization done", "Waiting for Speed Sense", "Press any key to continue",
             pexpect.EOF, pexpect.TIMEOUT]
         while True:
-            ret = self.pexp.expect(exp_list, timeout=15)
+            ret = self.expect(exp_list, timeout=timeout)
             if ret < 3:
                 L.info("send 'y' for '{0}' ...".format(exp_list[ret]))
                 self.pexp.sendline("y")
@@ -220,10 +227,14 @@ class ArubaSwitch(Switch):
                 L.info("get expect messages ...")
                 self.pexp.sendline("\r\n")
             elif exp_list[ret] == pexpect.TIMEOUT:
+                if time.monotonic() - tm_start > self.get_timeout('reboot'):
+                    L.error("the device is not back in {0:.0f} seconds".format(time.monotonic() - tm_start))
+                    break
                 L.info("timeout, waiting for console ...")
                 self.pexp.sendline("\r\n")
             else:
                 L.info("it's time to enter console ...")
+                self.record_latency('reboot', time.monotonic() - tm_start)
                 break
         self.pexp.sendline("\r\n\r\n\r\n")
         self._enter_enable()
@@ -231,12 +242,14 @@ class ArubaSwitch(Switch):
     # reboot system
     def reboot(self, wait_network=True):
         self._enter_enable()
+        self.invalidate_facts()
         L.info("reload ...")
         self.pexp.sendline("reload")
         self._wait_reboot()
 
         L.info("reboot() DONE")
 
+    @cached_fact('board')
     def get_board(self):
         self._enter_enable()
         self._esc_console()
@@ -253,6 +266,7 @@ class ArubaSwitch(Switch):
         self._end_console()
         return parse_chassis_line(ln_before)
 
+    @cached_fact('model')
     def get_model_name(self):
         self._enter_enable()
         self._esc_console()
@@ -269,13 +283,14 @@ class ArubaSwitch(Switch):
         self._end_console()
         return parse_model_line(ln_before)
 
+    @cached_fact('version')
     def get_version(self):
         self._enter_enable()
         L.info("get version")
         self.pexp.sendline('show ver\r\n')
         #time.sleep(3)
-        self.pexp.expect('Boot Image')
-        self.pexp.expect('Active Boot ROM')
+        self.expect('Boot Image')
+        self.expect('Active Boot ROM')
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         # L.info("version ln_before=" + str(ln_before))
@@ -295,17 +310,18 @@ class ArubaSwitch(Switch):
         lst = re.split(r'\.', ver)
         return float(lst[1].strip() + "." + lst[2].strip())
 
+    @cached_fact('hostname')
     def get_hostname(self):
         self._enter_enable()
         L.info("get hostname")
 
         # self.pexp.sendline('show system\r\n')
-        # self.pexp.expect('Status and Counters')
-        # self.pexp.expect('System Contact')
+        # self.expect('Status and Counters')
+        # self.expect('System Contact')
         # parse_hostname_line(ln_before)
 
         self.pexp.sendline('sh run | i ostname\r\n')
-        self.pexp.expect('hostname .*[\r\n]+')
+        self.expect('hostname .*[\r\n]+')
         #ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         #L.debug("hostname ln_before=" + str(ln_before))
@@ -315,19 +331,39 @@ class ArubaSwitch(Switch):
     def set_hostname(self, hostname):
         self._enter_enable()
         L.info("set hostname {0} ...".format(hostname))
+        self.invalidate_facts('hostname')
         self.pexp.sendline("config t\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("hostname {0}\r\n".format(hostname))
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
+        self.pexp.sendline("exit\r\n")
+
+    ## get the fingerprint of the config applied, it's stored in the SNMP location
+    #  The tool owns the SNMP location: set_config_fingerprint() replaces or removes the location set by the others.
+    def get_config_fingerprint(self):
+        self._enter_enable()
+        return self._show_config_fingerprint('sh run | i snmp-server location')
+
+    def set_config_fingerprint(self, digest):
+        self._enter_enable()
+        self.pexp.sendline("config t\r\n")
+        self.expect("\(config\)#")
+        if digest:
+            self.pexp.sendline("snmp-server location {0}{1}\r\n".format(FINGERPRINT_PREFIX, digest))
+        else:
+            self.pexp.sendline("no snmp-server location\r\n")
+        self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
+        self.expect("#")
+        return True
 
     def set_root_passwd(self, root_pw):
         self._enter_enable()
         L.info("set root pw")
         self.pexp.sendline("config t\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("enable secret {0}\r\n".format(root_pw))
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
         #self._quit_enable()
 
@@ -336,8 +372,8 @@ class ArubaSwitch(Switch):
         self._enter_enable()
         self.pexp.sendline("show int status\r\n")
         # Port     Name       Status
-        self.pexp.expect("Port[\s]+Name[\s]+Status")
-        self.pexp.expect("#")
+        self.expect("Port[\s]+Name[\s]+Status")
+        self.expect("#")
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         # L.debug("vlan-switch ln_before=" + str(ln_before))
@@ -354,8 +390,8 @@ class ArubaSwitch(Switch):
         L.info("get vlans")
 
         self.pexp.sendline("show vlan\r\n")
-        self.pexp.expect("VLAN ID")
-        self.pexp.expect("{0}#".format(hostname))
+        self.expect("VLAN ID")
+        self.expect("{0}#".format(hostname))
 
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
@@ -369,41 +405,41 @@ class ArubaSwitch(Switch):
         self._enter_enable()
         L.info("set_clock ...")
         self.pexp.sendline("config t\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         L.debug("clock timezone EST -5")
         self.pexp.sendline("clock timezone EST -5\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("clock summer-time EST recurring 2 Sun Mar 2:00 first Sun Nov 3:00 -5\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("time daylight-time-rule continental-us-and-canada\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         #(config)#clock set 01/13/2001 00:01:02
         str_time = strftime("%m/%d/%Y %H:%M:%S", localtime())
         L.info("clock set {0} ...".format(str_time))
         self.pexp.sendline("clock set {0}\r\n".format(str_time))
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
         L.info("clock set DONE")
         return True
 
     def _esc_console(self):
         self.pexp.sendline('\r\nend\r\n')
         self.pexp.sendline('config')
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
 
-        #self.pexp.sendline('console terminal ans'); self.pexp.expect("\(config\)#")
-        self.pexp.sendline('console local-terminal none'); self.pexp.expect("\(config\)#")
+        #self.pexp.sendline('console terminal ans'); self.expect("\(config\)#")
+        self.pexp.sendline('console local-terminal none'); self.expect("\(config\)#")
 
         from switchdevice import pexpect_clean_buffer; pexpect_clean_buffer(self.pexp)
         pass
 
     def _nor_console(self):
-        self.pexp.sendline('console local-terminal ansi'); self.pexp.expect(["tty=ansi", "Invalid input: console"], timeout=2)
+        self.pexp.sendline('console local-terminal ansi'); self.expect(["tty=ansi", "Invalid input: console"], timeout=2)
         pass
 
     def _end_console(self):
-        self.pexp.sendline('console local-terminal vt100'); self.pexp.expect("\(config\)#")
+        self.pexp.sendline('console local-terminal vt100'); self.expect("\(config\)#")
         self.pexp.sendline('exit')
         pass
 
@@ -448,6 +484,8 @@ class ArubaSwitch(Switch):
 
         self._enter_enable()
         L.info("reset config")
+        # no reboot, the model and the version are kept for set_vlans()
+        self.invalidate_facts('hostname')
 
         L.info("reset interfaces")
         self.pexp.sendline("config t\r\n")
@@ -455,25 +493,25 @@ class ArubaSwitch(Switch):
         for v in vlan_list:
             L.info("no vlan {0} tagged {1} ...".format(v,str_ports))
             self.pexp.sendline("no vlan {0} tagged {1}\r\n".format(v,str_ports))
-            self.pexp.expect("\(config\)#")
+            self.expect("\(config\)#")
             self.pexp.sendline("no vlan {0} untagged {1}\r\n".format(v,str_ports))
-            self.pexp.expect("\(config\)#")
+            self.expect("\(config\)#")
         self.pexp.sendline("vlan 1 untagged {0}\r\n".format(str_ports))
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
 
         self.pexp.sendline("interface ethernet {0}\r\n".format(str_ports))
-        self.pexp.expect("\(eth-")
+        self.expect("\(eth-")
         self.pexp.sendline("enable\r\n")
-        self.pexp.expect("\(eth-")
+        self.expect("\(eth-")
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
 
         for i in vlan_list:
             if (i > 1) and (i < 1000):
                 L.info("no vlan {0} ...".format(i))
                 self.pexp.sendline("no vlan {0}\r\n".format(i))
                 L.debug("expect (config)# ...")
-                self.pexp.expect("\(config\)#")
+                self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
         L.info("reset config DONE")
         return True
@@ -481,6 +519,7 @@ class ArubaSwitch(Switch):
     # factory reset
     def reset_config_hw(self):
         self._enter_enable()
+        self.invalidate_facts()
 
         L.info("clear config all ...")
         self.pexp.sendline("erase startup-config\r\n")
@@ -500,16 +539,16 @@ class ArubaSwitch(Switch):
         L.info("add VLAN to database ...")
         # add vlan
         self.pexp.sendline("config t\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         for i in vlan_set:
             if i < 2:
                 # ignore
                 continue
             L.info("add VLAN {0} ...".format(i))
             self.pexp.sendline("vlan {0}\r\n".format(i))
-            self.pexp.expect("\(vlan-{0}\)#".format(i))
+            self.expect("\(vlan-{0}\)#".format(i))
             self.pexp.sendline("exit\r\n")
-            self.pexp.expect("\(config\)#")
+            self.expect("\(config\)#")
 
         assert(not port_map == None)
         assert(len(port_map) > 0)
@@ -524,30 +563,30 @@ class ArubaSwitch(Switch):
                 L.info("add {0} as trunk ...".format(port_map[port_list[i]]))
                 for j in vlan_set:
                     self.pexp.sendline("vlan {1} tagged {0}\r\n".format(port_map[port_list[i]],j))
-                self.pexp.expect("\(config\)#")
+                self.expect("\(config\)#")
             else:
                 # setup vlan
                 L.info("add {0} to VLAN {1} ...".format(port_map[port_list[i]],vlan_list[i]))
                 self.pexp.sendline("vlan {1} untagged {0}\r\n".format(port_map[port_list[i]],vlan_list[i]))
-                self.pexp.expect("\(config\)#")
+                self.expect("\(config\)#")
 
         self.pexp.sendline("end\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
 
         # show VLAN
         self.pexp.sendline("sh vlan-switch brief\r\n")
         self.pexp.sendline("sh vlans\r\n")
         self.pexp.sendline("sh vlan\r\n")
-        self.pexp.expect(["Invalid input detected at","#"])
+        self.expect(["Invalid input detected at","#"])
 
         self.pexp.sendline("show interfaces trunk\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
         self.pexp.sendline("show interface status\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
 
         self.pexp.sendline("show mac\r\n")
         self.pexp.sendline("show mac address\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
 
         L.info("set vlans DONE")
         return True
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the asyncio API of the switch drivers
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import asyncio
+import functools
+import threading
+import concurrent.futures
+
+from switchdevice import Switch
+
+# the max number of the device operations running at the same time
+DEFAULT_MAX_WORKERS = 64
+
+_executor = None
+_executor_lock = threading.Lock()
+
+## get the worker pool shared by all of the devices
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS, thread_name_prefix="switch")
+        return _executor
+
+## AsyncSwitch Class
+#
+#  The coroutines of the core operations of a Switch, to run them from asyncio code.
+#  The driver operations are blocking expect scripts, they are not made non-blocking: each running operation holds
+#  a thread of the worker pool until it's done, and the operations of the same device run one by one.
+#  So at most DEFAULT_MAX_WORKERS devices (or the max workers of the executor passed) run at the same time,
+#  the others wait for a free worker; it's a thread pool with an asyncio API, not one thread for many devices.
+class AsyncSwitch():
+    def __init__(self, device, executor=None):
+        assert (isinstance(device, Switch))
+        self.device = device
+        self.executor = executor
+        self._lock = None
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## run a blocking function of the device in the worker pool
+    async def _call(self, func, *args, **kwargs):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            executor = self.executor if self.executor else get_executor()
+            return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    ## see Switch.collect_facts()
+    async def collect_facts(self):
+        return await self._call(self.device.collect_facts)
+
+    ## see Switch.reset_config()
+    async def reset_config(self, port_map):
+        return await self._call(self.device.reset_config, port_map)
+
+    ## see Switch.set_vlans()
+    async def set_vlans(self, port_map, port_list, vlan_list, vlan_set, interface_config={}):
+        return await self._call(self.device.set_vlans, port_map, port_list, vlan_list, vlan_set, interface_config=interface_config)
+
+    ## see Switch.save_config()
+    async def save_config(self):
+        return await self._call(self.device.save_config)
+
+    ## see Switch.reboot()
+    async def reboot(self, wait_network=True):
+        return await self._call(self.device.reboot, wait_network=wait_network)
+
+## run the coroutines of many devices, at most 'limit' of them at the same time
+#  @param coros The list of the coroutines.
+#  @param limit The max number of the coroutines running at the same time, 0 for no limit.
+#  @return the list of the results in the same order; the exception is returned as the result if the coroutine failed.
+async def gather_devices(coros, limit=0):
+    if limit <= 0:
+        return await asyncio.gather(*coros, return_exceptions=True)
+    sem = asyncio.Semaphore(limit)
+    async def run_one(coro):
+        async with sem:
+            return await coro
+    return await asyncio.gather(*[run_one(i) for i in coros], return_exceptions=True)
+
+if __name__ == '__main__':
+    import unittest
+    import time
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_concurrent(self):
+            class MySwitch(Switch):
+                def __init__(self, name):
+                    super().__init__()
+                    self.name = name
+                    self.calls = []
+                def save_config(self):
+                    self.calls.append('save_config')
+                    time.sleep(0.2)
+                    return True
+                def reboot(self, wait_network=True):
+                    self.calls.append('reboot')
+                    time.sleep(0.2)
+                    return wait_network
+                def get_model_name(self):
+                    return "Archer C7"
+                def get_version(self):
+                    return "22.03.5"
+                def get_hostname(self):
+                    if self.name == "ap3":
+                        raise RuntimeError("no response")
+                    return self.name
+
+            devices = [ AsyncSwitch(MySwitch("ap{0}".format(i))) for i in range(10) ]
+            async def apply(dev):
+                await dev.save_config()
+                return await dev.reboot(wait_network=False)
+
+            tm_start = time.monotonic()
+            ret = asyncio.run(gather_devices([ apply(i) for i in devices ]))
+            # the devices run at the same time, the operations of each device run in order
+            self.assertLess(time.monotonic() - tm_start, 1.5)
+            self.assertEqual(ret, [False] * 10)
+            self.assertEqual(devices[0].device.calls, ['save_config', 'reboot'])
+
+            ret = asyncio.run(gather_devices([ i.collect_facts() for i in devices[:4] ], limit=2))
+            self.assertEqual(ret[0], { 'board': 'Archer C7', 'model': 'Archer C7', 'version': '22.03.5', 'hostname': 'ap0' })
+            self.assertIsInstance(ret[3], RuntimeError)
+
+    unittest.main()
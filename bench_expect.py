@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the micro-benchmark of the expect engine, it replays a large device output
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import sys
+import time
+import argparse
+
+import pexpect
+from pexpect.spawnbase import SpawnBase
+
+from expectset import get_pattern_set, expect_pattern_set, DEFAULT_SEARCH_WINDOW
+
+## ReplaySpawn Class
+#
+#  A pexpect spawn reads the captured output chunk by chunk, as the console does.
+class ReplaySpawn(SpawnBase):
+    def __init__(self, data, chunk_size=2000, timeout=5):
+        super().__init__(timeout=timeout, maxread=chunk_size)
+        self.data = data
+        self.pos = 0
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if self.pos >= len(self.data):
+            self.flag_eof = True
+            raise pexpect.EOF('End of the replay.')
+        s = self.data[self.pos:self.pos + size]
+        self.pos += len(s)
+        return s
+
+## generate a large output like 'opkg list' followed by the shell prompt
+def get_sample_output(num_lines):
+    lines = [ "kmod-pkg{0} - 5.10.176-1 - The kernel module {0} for the test of the expect engine.".format(i) for i in range(num_lines) ]
+    return ("\r\n".join(lines) + "\r\nroot@OpenWrt:/# ").encode('UTF-8')
+
+# the patterns used by the drivers while waiting for the prompt
+PATTERNS = [ "Entry not found", "Signature check passed\\.", "\\(config\\)#", "root@.*:/# ", pexpect.EOF, pexpect.TIMEOUT ]
+
+def bench_pexpect(data, chunk_size, rounds):
+    tm_start = time.perf_counter()
+    for i in range(rounds):
+        pexp = ReplaySpawn(data, chunk_size)
+        ret = pexp.expect(PATTERNS)
+    return (ret, time.perf_counter() - tm_start)
+
+def bench_pattern_set(data, chunk_size, rounds, searchwindowsize):
+    tm_start = time.perf_counter()
+    for i in range(rounds):
+        pexp = ReplaySpawn(data, chunk_size)
+        ret = expect_pattern_set(pexp, get_pattern_set("bench", PATTERNS), searchwindowsize=searchwindowsize)
+    return (ret, time.perf_counter() - tm_start)
+
+def main():
+    parser = argparse.ArgumentParser(description='The micro-benchmark of the expect engine.')
+    parser.add_argument('--lines', type=int, default=5000, help='The number of lines of the output')
+    parser.add_argument('--chunk', type=int, default=2000, help='The size of each read')
+    parser.add_argument('--rounds', type=int, default=5, help='The rounds of the test')
+    parser.add_argument('--window', type=int, default=DEFAULT_SEARCH_WINDOW, help='The search window in bytes')
+    args = parser.parse_args()
+
+    data = get_sample_output(args.lines)
+    print("replay {0} bytes in chunks of {1} bytes, {2} rounds".format(len(data), args.chunk, args.rounds))
+    ret1, tm1 = bench_pexpect(data, args.chunk, args.rounds)
+    print("pexpect.expect():      index={0} {1:.3f} seconds".format(ret1, tm1))
+    ret2, tm2 = bench_pattern_set(data, args.chunk, args.rounds, args.window)
+    print("expect_pattern_set():  index={0} {1:.3f} seconds".format(ret2, tm2))
+    if ret1 != ret2:
+        print("error: the results are different")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
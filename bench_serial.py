@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the benchmark of the expect latency of the serial port
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import os
+import sys
+import tty
+import threading
+import argparse
+
+from pexpect_serial import SerialSpawn
+
+## answer each line with a prompt on the master of a pty, like the shell of a device
+def run_responder(fd_master, prompt):
+    while True:
+        try:
+            data = os.read(fd_master, 4096)
+        except OSError:
+            break
+        if not data:
+            break
+        for i in range(data.count(b'\n')):
+            os.write(fd_master, b'\r\n' + prompt)
+
+def bench(port, baud, low_latency, rounds, prompt):
+    pexp = SerialSpawn(port, baud, timeout=5)
+    applied = pexp.set_low_latency(low_latency)
+    for i in range(rounds):
+        pexp.sendline("")
+        pexp.expect(prompt)
+    stats = pexp.get_latency_stats()
+    pexp.close()
+    print("low latency {0:3s} {1}: {2} expects, mean {3:.2f} ms, p50 {4:.2f} ms, p95 {5:.2f} ms, max {6:.2f} ms".format(
+        "on" if low_latency else "off", applied, stats['count'], stats['mean'], stats['p50'], stats['p95'], stats['max']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the latency of the expects on a serial port.')
+    parser.add_argument('-p', '--port', default=None, help='The serial port of a device at the shell prompt; a pty loopback if not set')
+    parser.add_argument('-b', '--baud', type=int, default=115200, help='The baud rate')
+    parser.add_argument('-r', '--rounds', type=int, default=200, help='The number of the expects')
+    parser.add_argument('--prompt', default='# ', help='The prompt of the device')
+    args = parser.parse_args()
+
+    port = args.port
+    if not port:
+        fd_master, fd_slave = os.openpty()
+        tty.setraw(fd_master)
+        tty.setraw(fd_slave)
+        threading.Thread(target=run_responder, args=(fd_master, args.prompt.encode()), daemon=True).start()
+        port = os.ttyname(fd_slave)
+        print("pty loopback {0}".format(port))
+    for low_latency in [False, True]:
+        bench(port, args.baud, low_latency, args.rounds, args.prompt)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
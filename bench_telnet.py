@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the benchmark of the built-in telnet client and the telnet binary
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import sys
+import time
+import shutil
+import argparse
+
+import pexpect
+
+from telnetspawn import TelnetSpawn, TelnetStandIn
+
+PROMPT = 'root@.*:/# '
+
+## connect and wait for the prompt
+#  @return (the spawn, the seconds of the setup)
+def bench_connect(create):
+    tm_start = time.perf_counter()
+    pexp = create()
+    pexp.expect('Please press Enter')
+    pexp.sendline("")
+    pexp.expect(PROMPT)
+    return (pexp, time.perf_counter() - tm_start)
+
+## run the commands and wait for the prompts
+#  @return the average seconds of each command
+def bench_expect(pexp, rounds):
+    tm_start = time.perf_counter()
+    for i in range(rounds):
+        pexp.sendline("uci get system.@system[0].hostname")
+        pexp.expect(PROMPT)
+    return (time.perf_counter() - tm_start) / rounds
+
+def run_bench(name, create, connections, rounds):
+    tm_setup = 0
+    tm_expect = 0
+    for i in range(connections):
+        pexp, tm = bench_connect(create)
+        tm_setup += tm
+        tm_expect += bench_expect(pexp, rounds)
+        pexp.close()
+    print("{0:8s} setup: {1:.2f} ms, expect: {2:.3f} ms".format(name, tm_setup * 1000 / connections, tm_expect * 1000 / connections))
+
+def main():
+    parser = argparse.ArgumentParser(description='The benchmark of the telnet clients.')
+    parser.add_argument('--connections', type=int, default=20, help='The number of the connections')
+    parser.add_argument('--rounds', type=int, default=100, help='The commands of each connection')
+    args = parser.parse_args()
+
+    server = TelnetStandIn()
+    port = server.start()
+    print("telnet stand-in at 127.0.0.1:{0}, {1} connections, {2} commands for each".format(port, args.connections, args.rounds))
+    try:
+        run_bench("builtin", lambda: TelnetSpawn('127.0.0.1', port, timeout=10), args.connections, args.rounds)
+        if shutil.which("telnet"):
+            run_bench("binary", lambda: pexpect.spawn("telnet 127.0.0.1 {0}".format(port), timeout=10), args.connections, args.rounds)
+        else:
+            print("binary   skipped, the telnet command is not found")
+    finally:
+        server.stop()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
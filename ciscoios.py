@@ -20,7 +20,7 @@ import time
 import re
 import pexpect
 
-from switchdevice import Switch
+from switchdevice import Switch, cached_fact, FINGERPRINT_PREFIX
 from parseclock import parse_clock_ciscoios
 
 try:
@@ -91,6 +91,8 @@ def parse_host_name(str_output):
 class CiscoSwitch(Switch):
     def __init__(self):
         super().__init__()
+        # the console speed is a line setting of the running config
+        self.console_speed_saved = True
 
     def _enter_enable(self):
         L.debug("enter to console")
@@ -104,7 +106,7 @@ class CiscoSwitch(Switch):
             self.pexp.sendline("\r\n\r\n")
             #self.pexp.sendline('\r\nsh run | i ostname\r\n')
             responses = ["Please answer 'yes' or 'no'","\[yes/no\]:","\[confirm\]","Press RETURN to get started.", ">", "#", pexpect.EOF, pexpect.TIMEOUT]
-            ret = self.pexp.expect(responses, timeout=5)
+            ret = self.timed_expect('prompt', responses, 5)
             #if ret < 6:
             #    ln_before = self.pexp.before.decode('UTF-8')
             #    ln_after = self.pexp.after.decode('UTF-8')
@@ -131,7 +133,7 @@ class CiscoSwitch(Switch):
             else:
                 L.debug("got eof/timeout")
                 pass
-            time.sleep(2)
+            time.sleep(self.get_poll_interval('prompt', 2))
 
         self.pexp.sendline("terminal width 512\r\n")
         self.pexp.sendline("terminal length 512\r\n")
@@ -141,18 +143,28 @@ class CiscoSwitch(Switch):
         #self.pexp.sendcontrol('c')
         self.pexp.sendline('end\r\n')
         self.pexp.sendline("exit\r\n")
-        #self.pexp.expect(["Press RETURN to get started."])
+        #self.expect(["Press RETURN to get started."])
         self.pexp.sendline()
 
+    # line con 0 / speed
+    def _send_console_speed(self, baud):
+        self._enter_enable()
+        self.pexp.sendline("configure terminal\r\n")
+        self.expect(["\(config\)#"])
+        self.pexp.sendline("line con 0\r\n")
+        self.expect(["\(config-line\)#"])
+        self.pexp.sendline("speed {0}\r\n".format(baud))
+        return True
+
     # save the current config to disk
     def save_config(self):
         self._enter_enable()
         L.info("copy config run -> startup ...")
         self.pexp.sendline("copy running-config startup-config\r\n")
-        ret = self.pexp.expect(["The copy operation was completed successfully","Destination filename \[startup-config\]?"])
+        ret = self.expect(["The copy operation was completed successfully","Destination filename \[startup-config\]?"])
         if ret == 1:
             self.pexp.sendline("\r\n")
-            self.pexp.expect(["\[OK\]","#"])
+            self.expect(["\[OK\]","#"])
 
     # reboot system
     def reboot(self, wait_network=True):
@@ -161,30 +173,33 @@ class CiscoSwitch(Switch):
             return True
 
         self._enter_enable()
+        self.invalidate_facts()
 
         L.info("reload ...")
+        tm_start = time.monotonic()
         self.pexp.sendline("reload\r\n")
         while True:
-            ret = self.pexp.expect(["\[yes/no\]","\[confirm\]"])
+            ret = self.expect(["\[yes/no\]","\[confirm\]"])
             if ret == 0:
                 self.pexp.sendline("yes\r\n")
             else:
                 self.pexp.sendline("\r\n")
                 break
         L.info("waiting for reload ...")
-        ret = self.pexp.expect(["enter the initial configuration dialog", "Press RETURN to get started", "Cisco IOS Software"])
+        ret = self.timed_expect('reboot', ["enter the initial configuration dialog", "Press RETURN to get started", "Cisco IOS Software"], tm_start=tm_start)
         if ret == 0:
             self.pexp.sendline("n\r\n")
         self.pexp.sendline("\r\n")
 
         L.info("reboot() DONE")
 
+    @cached_fact('model')
     def get_model_name(self):
         self._enter_enable()
         L.info("get_model_name() get version")
         self.pexp.sendline('sh ver | i ytes of memory\r\n')
         L.info("wait memory")
-        self.pexp.expect('bytes of memory')
+        self.expect('bytes of memory')
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("model ln_before=" + str(ln_before))
@@ -192,12 +207,13 @@ class CiscoSwitch(Switch):
         L.info("parse model")
         return parse_model_line(ln_before)
 
+    @cached_fact('version')
     def get_version(self):
         self._enter_enable()
         L.info("get version")
         self.pexp.sendline('sh ver | i IOS\r\n')
         #time.sleep(3)
-        self.pexp.expect('RELEASE SOFTWARE')
+        self.expect('RELEASE SOFTWARE')
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("version ln_before=" + str(ln_before))
@@ -215,11 +231,12 @@ class CiscoSwitch(Switch):
         ver = self.get_version()
         return float(re.split(r'\(', ver)[0].strip())
 
+    @cached_fact('hostname')
     def get_hostname(self):
         self._enter_enable()
         L.info("get hostname")
         self.pexp.sendline('sh run | i ostname\r\n')
-        self.pexp.expect('hostname .*[\r\n]+')
+        self.expect('hostname .*[\r\n]+')
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("hostname ln_before=" + str(ln_before))
@@ -229,19 +246,39 @@ class CiscoSwitch(Switch):
     def set_hostname(self, hostname):
         self._enter_enable()
         L.info("set hostname {0} ...".format(hostname))
+        self.invalidate_facts('hostname')
         self.pexp.sendline("config t\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("hostname {0}\r\n".format(hostname))
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
+        self.pexp.sendline("exit\r\n")
+
+    ## get the fingerprint of the config applied, it's stored in the SNMP location
+    #  The tool owns the SNMP location: set_config_fingerprint() replaces or removes the location set by the others.
+    def get_config_fingerprint(self):
+        self._enter_enable()
+        return self._show_config_fingerprint('sh run | i snmp-server location')
+
+    def set_config_fingerprint(self, digest):
+        self._enter_enable()
+        self.pexp.sendline("config t\r\n")
+        self.expect("\(config\)#")
+        if digest:
+            self.pexp.sendline("snmp-server location {0}{1}\r\n".format(FINGERPRINT_PREFIX, digest))
+        else:
+            self.pexp.sendline("no snmp-server location\r\n")
+        self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
+        self.expect("#")
+        return True
 
     def set_root_passwd(self, root_pw):
         self._enter_enable()
         L.info("set root pw")
         self.pexp.sendline("config t\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("enable secret {0}\r\n".format(root_pw))
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
         #self._quit_enable()
 
@@ -249,8 +286,8 @@ class CiscoSwitch(Switch):
     def get_ports(self):
         self._enter_enable()
         self.pexp.sendline("show int status\r\n")
-        self.pexp.expect("Port[\s]+Name[\s]+Status[\s]+Vlan[\s]+Duplex[\s]+Speed[\s]+Type")
-        self.pexp.expect("#")
+        self.expect("Port[\s]+Name[\s]+Status[\s]+Vlan[\s]+Duplex[\s]+Speed[\s]+Type")
+        self.expect("#")
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("vlan-switch ln_before=" + str(ln_before))
@@ -267,12 +304,12 @@ class CiscoSwitch(Switch):
 
         if ver_num < 15:
             self.pexp.sendline("sh vlan-switch brief\r\n")
-            self.pexp.expect("VLAN Name")
-            self.pexp.expect("1002 fddi-default")
+            self.expect("VLAN Name")
+            self.expect("1002 fddi-default")
         else:
             self.pexp.sendline("show vlan\r\n")
-            self.pexp.expect("VLAN Name")
-            self.pexp.expect("1002 fddi-default")
+            self.expect("VLAN Name")
+            self.expect("1002 fddi-default")
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("vlan-switch ln_before=" + str(ln_before))
@@ -285,18 +322,18 @@ class CiscoSwitch(Switch):
         self._enter_enable()
         L.debug("set_clock ...")
         self.pexp.sendline("config t\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("clock timezone EST -5\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         #self.pexp.sendline("clock summer-time EDT recurring first sun apr 02:00 last sun oct 02:00\r\n")
         self.pexp.sendline("clock summer-time EDT recurring\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
         str_time = strftime("%H:%M:%S %b %d %Y", localtime())
         L.info("clock set {0} ...".format(str_time))
         self.pexp.sendline("clock set {0}\r\n".format(str_time))
-        self.pexp.expect("#")
+        self.expect("#")
         L.info("clock set DONE")
         return True
 
@@ -304,7 +341,7 @@ class CiscoSwitch(Switch):
         self._enter_enable()
         L.debug("get_clock ...")
         self.pexp.sendline('show clock detail\r\n')
-        self.pexp.expect(["Time source is","No time source"])
+        self.expect(["Time source is","No time source"])
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("get_clock ln_before=" + str(ln_before))
@@ -323,39 +360,41 @@ class CiscoSwitch(Switch):
 
         self._enter_enable()
         L.info("reset config")
+        # no reboot, the model and the version are kept for set_vlans()
+        self.invalidate_facts('hostname')
 
         L.info("reset interfaces")
         self.pexp.sendline("config t\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         for p in port_list:
             L.info("reset interface {0} ...".format(p))
             self.pexp.sendline("interface {0}\r\n".format(p))
-            self.pexp.expect("\(config-if\)#")
+            self.expect("\(config-if\)#")
             self.pexp.sendline("switchport trunk allowed vlan remove 1-1000\r\n")
-            self.pexp.expect("\(config-if\)#")
+            self.expect("\(config-if\)#")
             self.pexp.sendline("switchport mode access\r\n")
-            self.pexp.expect("\(config-if\)#")
+            self.expect("\(config-if\)#")
             self.pexp.sendline("switchport access vlan 1\r\n")
-            self.pexp.expect("\(config-if\)#")
-            #self.pexp.sendline("mtu 9000\r\n"); self.pexp.expect("\(config-if\)#")
-            #self.pexp.sendline("no ip address\r\n"); self.pexp.expect("\(config-if\)#")
+            self.expect("\(config-if\)#")
+            #self.pexp.sendline("mtu 9000\r\n"); self.expect("\(config-if\)#")
+            #self.pexp.sendline("no ip address\r\n"); self.expect("\(config-if\)#")
             self.pexp.sendline("no shutdown\r\n")
-            self.pexp.expect("\(config-if\)#")
+            self.expect("\(config-if\)#")
             self.pexp.sendline("exit\r\n")
-            self.pexp.expect("\(config\)#")
+            self.expect("\(config\)#")
 
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
 
         L.info("remove vlan record one by one")
         if ver_num < 15:
             self.pexp.sendline("vlan database\r\n")
-            self.pexp.expect("\(vlan\)#")
+            self.expect("\(vlan\)#")
             for i in vlan_list:
                 if (i > 1) and (i < 1000):
                     L.info("no vlan {0} ...".format(i))
                     self.pexp.sendline("no vlan {0}\r\n".format(i))
-                    self.pexp.expect("\(vlan\)#")
+                    self.expect("\(vlan\)#")
                 else:
                     L.info("skip vlan {0}".format(i))
 
@@ -365,53 +404,54 @@ class CiscoSwitch(Switch):
             L.debug("config t ...")
             self.pexp.sendline("config t\r\n")
             L.debug("expect (config)# ...")
-            self.pexp.expect("\(config\)#")
+            self.expect("\(config\)#")
             for i in vlan_list:
                 if (i > 1) and (i < 1000):
                     L.info("no vlan {0} ...".format(i))
                     self.pexp.sendline("no vlan {0}\r\n".format(i))
                     L.debug("expect (config)# ...")
-                    self.pexp.expect("\(config\)#")
+                    self.expect("\(config\)#")
             self.pexp.sendline("exit\r\n")
         L.info("reset config DONE")
         return True
 
     def reset_config_hw(self, port_map):
+        self.invalidate_facts()
         hostname = 'Switch'
         self.set_hostname(hostname)
         self._enter_enable()
 
         L.info("clear config all ...")
         self.pexp.sendline("clear config all\r\n")
-        ret = self.pexp.expect(["continue \(y/n\)", "Invalid input detected at"])
+        ret = self.expect(["continue \(y/n\)", "Invalid input detected at"])
         if ret == 0:
             self.pexp.sendline("y\r\n")
-            self.pexp.expect("configuration cleared")
+            self.expect("configuration cleared")
 
         L.info("erase startup-config ...")
         self.pexp.sendline("erase startup-config\r\n")
-        ret = self.pexp.expect(["\[confirm\]", "Invalid input detected at"])
+        ret = self.expect(["\[confirm\]", "Invalid input detected at"])
         if ret == 0:
             self.pexp.sendline("\r\n")
-            self.pexp.expect(["{0}#".format(hostname),"complete"])
+            self.expect(["{0}#".format(hostname),"complete"])
 
         L.info("write erase ...")
         self.pexp.sendline("write erase\r\n")
-        ret = self.pexp.expect(["\[confirm\]", "Invalid input detected at"])
+        ret = self.expect(["\[confirm\]", "Invalid input detected at"])
         if ret == 0:
             self.pexp.sendline("y\r\n")
-            self.pexp.expect("complete")
+            self.expect("complete")
 
         self.reboot()
         self._enter_enable()
 
         L.info("delete the VLAN database file ...")
         self.pexp.sendline("delete flash:vlan.dat\r\n")
-        self.pexp.expect("elete .*vlan.dat") #self.pexp.expect("\[confirm\]")
+        self.expect("elete .*vlan.dat") #self.expect("\[confirm\]")
         self.pexp.sendline("\r\n")
-        self.pexp.expect(["elete .*vlan.dat","Error deleting flash:/vlan.dat"])
+        self.expect(["elete .*vlan.dat","Error deleting flash:/vlan.dat"])
         self.pexp.sendline("\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
 
         self.reboot()
         self._enter_enable()
@@ -430,33 +470,33 @@ class CiscoSwitch(Switch):
         L.info("add VLAN to database ...")
         if ver_num < 15:
             self.pexp.sendline("vlan database\r\n")
-            self.pexp.expect("\(vlan\)#")
+            self.expect("\(vlan\)#")
             for i in vlan_set:
                 if i < 2:
                     # ignore
                     continue
                 L.info("add VLAN {0} ...".format(i))
                 self.pexp.sendline("vlan {0}\r\n".format(i))
-                self.pexp.expect("\(vlan\)#")
+                self.expect("\(vlan\)#")
 
             self.pexp.sendline("exit\r\n")
-            self.pexp.expect("#")
+            self.expect("#")
         else:
             # add vlan
             self.pexp.sendline("config t\r\n")
-            self.pexp.expect("\(config\)#")
+            self.expect("\(config\)#")
             for i in vlan_set:
                 if i < 2:
                     # ignore
                     continue
                 L.info("add VLAN {0} ...".format(i))
                 self.pexp.sendline("add vlan {0}\r\n".format(i))
-                self.pexp.expect("\(config\)#")
+                self.expect("\(config\)#")
             self.pexp.sendline("exit\r\n")
-            self.pexp.expect("#")
+            self.expect("#")
 
         self.pexp.sendline("config t\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
 
         assert(not port_map == None)
         assert(len(port_map) > 0)
@@ -470,46 +510,46 @@ class CiscoSwitch(Switch):
                 # setup trunk
                 L.info("add {0} as trunk ...".format(port_map[port_list[i]]))
                 self.pexp.sendline("int {0}\r\n".format(port_map[port_list[i]]))
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("switchport trunk encapsulation dot1q\r\n")
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("switchport mode trunk\r\n")
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("exit\r\n")
-                self.pexp.expect("\(config\)#")
+                self.expect("\(config\)#")
             else:
                 # setup vlan
                 L.info("add {0} to VLAN {1} ...".format(port_map[port_list[i]],vlan_list[i]))
                 self.pexp.sendline("int vlan {0}\r\n".format(vlan_list[i]))
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("exit\r\n")
-                self.pexp.expect("\(config\)#")
+                self.expect("\(config\)#")
                 self.pexp.sendline("int {0}\r\n".format(port_map[port_list[i]]))
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("switchport mode access\r\n")
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("switchport access vlan {0}\r\n".format(vlan_list[i]))
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("exit\r\n")
-                self.pexp.expect("\(config\)#")
+                self.expect("\(config\)#")
 
         self.pexp.sendline("end\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
 
         # show VLAN
         self.pexp.sendline("sh vlan-switch brief\r\n")
         self.pexp.sendline("sh vlans\r\n")
         self.pexp.sendline("sh vlan\r\n")
-        self.pexp.expect(["Invalid input detected at","#"])
+        self.expect(["Invalid input detected at","#"])
 
         self.pexp.sendline("show interfaces trunk\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
         self.pexp.sendline("show interface status\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
 
         self.pexp.sendline("show mac\r\n")
         self.pexp.sendline("show mac address\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
 
         L.info("set vlans DONE")
         return True
@@ -527,6 +567,35 @@ if __name__ == '__main__':
         def tearDown(self):
             pass
 
+        def test_config_fingerprint(self):
+            import pexpect.spawnbase
+            # replay the output of the console
+            class ReplaySpawn(pexpect.spawnbase.SpawnBase):
+                def __init__(self, data):
+                    super().__init__(timeout=1)
+                    self.data = data
+                def read_nonblocking(self, size=1, timeout=-1):
+                    if not self.data:
+                        raise pexpect.EOF("end of the replay")
+                    ret, self.data = self.data[:size], self.data[size:]
+                    return ret
+                def send(self, s):
+                    return len(s)
+                def sendline(self, s=''):
+                    return self.send(s + '\n')
+                def discard_pending(self):
+                    return 0
+            class MyCiscoSwitch(CiscoSwitch):
+                def _enter_enable(self):
+                    pass
+            # the stale prompts of _enter_enable() arrive after the buffer is cleared
+            stale = b"\r\r\nSwitch#\r\r\nSwitch#terminal length 0\r\nSwitch#"
+            sw = MyCiscoSwitch()
+            sw.pexp = ReplaySpawn(stale + b"sh run | i snmp-server location\r\r\nsnmp-server location agilenet-config-0123456789abcdef\r\nSwitch#")
+            self.assertEqual(sw.get_config_fingerprint(), '0123456789abcdef')
+            sw.pexp = ReplaySpawn(stale + b"sh run | i snmp-server location\r\r\nsnmp-server location lab 3\r\nSwitch#")
+            self.assertEqual(sw.get_config_fingerprint(), None)
+
         def test_parse_model_line(self):
             self.assertEqual('Cisco 3640', parse_model_line("""Switch#sh ver | i ytes of memory
 Cisco 3640 (R4700) processor (revision 0xFF) with 187392K/9216K """))
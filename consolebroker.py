@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the console broker of the serial ports
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import os
+import sys
+import signal
+import asyncio
+import argparse
+import logging as L
+
+import serial
+
+from telnetspawn import TelnetCodec
+
+# the bytes of the recent output replayed to a new client
+DEFAULT_SCROLLBACK = 4096
+# the bytes waiting to be written to the serial port, the writer client is not read while there are more
+DEFAULT_WRITE_BUFFER = 4096
+
+## BrokerClient Class
+#
+#  A TCP client of a console port. The client speaks telnet or raw TCP, the telnet commands are answered by the broker.
+class BrokerClient():
+    def __init__(self, writer):
+        self.writer = writer
+        self.codec = TelnetCodec()
+        self.peer = writer.get_extra_info('peername')
+        self.notified = False
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(self.codec.encode(data))
+
+## BrokerPort Class
+#
+#  A serial port shared by the TCP clients: all of the clients watch the console output,
+#  only the holder of the writer lease can write to the port.
+#  The lease is granted to the first client which sends data, and released when the client disconnects.
+#  The port is written without blocking, the data not written yet is sent when the port is writable,
+#  so a paste at a low baud rate doesn't stall the other ports and clients.
+class BrokerPort():
+    def __init__(self, device, baud, tcp_port, scrollback=DEFAULT_SCROLLBACK, name=None):
+        self.device = device
+        self.baud = baud
+        self.tcp_port = tcp_port
+        self.scrollback = scrollback
+        self.name = name if name else device
+        self.history = bytearray()
+        self.clients = []
+        self.lease = None
+        self._serial = None
+        self._server = None
+        # the data to write to the serial port
+        self._pending = bytearray()
+        self._writable = None
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## open the serial port and listen to the TCP port
+    async def start(self, host='0.0.0.0'):
+        self._serial = serial.Serial(self.device, self.baud, timeout=0, write_timeout=0)
+        self._writable = asyncio.Event()
+        self._writable.set()
+        asyncio.get_running_loop().add_reader(self._serial.fileno(), self._on_serial)
+        self._server = await asyncio.start_server(self._handle, host, self.tcp_port)
+        if not self.tcp_port:
+            self.tcp_port = self._server.sockets[0].getsockname()[1]
+        L.info("broker '{0}' ({1} baud) at TCP port {2}".format(self.device, self.baud, self.tcp_port))
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for i in self.clients:
+            i.writer.close()
+        if self._serial:
+            asyncio.get_running_loop().remove_reader(self._serial.fileno())
+            asyncio.get_running_loop().remove_writer(self._serial.fileno())
+            self._serial.close()
+            self._serial = None
+
+    def _on_serial(self):
+        try:
+            data = os.read(self._serial.fileno(), 65536)
+        except OSError as e:
+            L.error("broker '{0}': {1}".format(self.device, e))
+            data = b''
+        if not data:
+            # the port is gone, such as the USB adapter is unplugged
+            asyncio.get_running_loop().remove_reader(self._serial.fileno())
+            return
+        self.history += data
+        if len(self.history) > self.scrollback:
+            del self.history[:len(self.history) - self.scrollback]
+        for i in self.clients:
+            i.send(data)
+
+    ## write the data to the serial port without blocking, the rest is written when the port is writable
+    def _write(self, data):
+        waiting = bool(self._pending)
+        self._pending += data
+        if not waiting:
+            self._on_writable()
+
+    def _on_writable(self):
+        try:
+            written = os.write(self._serial.fileno(), self._pending)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            L.error("broker '{0}': {1}".format(self.device, e))
+            self._pending.clear()
+            written = 0
+        del self._pending[:written]
+        loop = asyncio.get_running_loop()
+        if self._pending:
+            loop.add_writer(self._serial.fileno(), self._on_writable)
+        else:
+            loop.remove_writer(self._serial.fileno())
+        if len(self._pending) > DEFAULT_WRITE_BUFFER:
+            self._writable.clear()
+        else:
+            self._writable.set()
+
+    def _on_client(self, client, data):
+        payload, reply = client.codec.decode(data)
+        if reply:
+            client.writer.write(reply)
+        if not payload:
+            return
+        if self.lease is None:
+            self.lease = client
+            L.info("broker '{0}': the writer lease is granted to {1}".format(self.name, client.peer))
+        if self.lease is not client:
+            if not client.notified:
+                client.notified = True
+                client.send("\r\n[broker] '{0}' is read-only, the writer is {1}\r\n".format(self.name, self.lease.peer).encode())
+            return
+        self._write(payload)
+
+    async def _handle(self, reader, writer):
+        client = BrokerClient(writer)
+        self.clients.append(client)
+        L.info("broker '{0}': client {1} attached".format(self.name, client.peer))
+        # the recent output, so the client finds the prompt without waiting
+        client.send(bytes(self.history))
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                self._on_client(client, data)
+                await writer.drain()
+                # the serial port is slower than the network
+                await self._writable.wait()
+        except OSError:
+            pass
+        finally:
+            self.clients.remove(client)
+            if self.lease is client:
+                self.lease = None
+            writer.close()
+            L.info("broker '{0}': client {1} detached".format(self.name, client.peer))
+
+## ConsoleBroker Class
+#
+#  All of the serial ports are served by one asyncio process.
+class ConsoleBroker():
+    def __init__(self, ports, host='0.0.0.0'):
+        self.ports = ports
+        self.host = host
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    async def start(self):
+        for i in self.ports:
+            await i.start(self.host)
+
+    async def stop(self):
+        for i in self.ports:
+            await i.stop()
+
+    ## run until SIGINT or SIGTERM
+    async def serve(self):
+        await self.start()
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+        await stop_event.wait()
+        L.info("stop the broker")
+        await self.stop()
+
+## parse the port argument 'DEVICE:BAUD:TCPPORT', such as '/dev/ttyUSB0:115200:6000'
+def parse_port_arg(arg, scrollback=DEFAULT_SCROLLBACK):
+    items = arg.rsplit(':', 2)
+    if len(items) != 3:
+        raise ValueError("the port should be DEVICE:BAUD:TCPPORT: '{0}'".format(arg))
+    return BrokerPort(items[0], int(items[1]), int(items[2]), scrollback)
+
+def main():
+    parser = argparse.ArgumentParser(description='Share the serial consoles over TCP.')
+    parser.add_argument('-p', '--port', action='append', required=True, help='The serial port DEVICE:BAUD:TCPPORT, such as /dev/ttyUSB0:115200:6000')
+    parser.add_argument('-b', '--bind', default='0.0.0.0', help='The address to listen')
+    parser.add_argument('-s', '--scrollback', type=int, default=DEFAULT_SCROLLBACK, help='The bytes of the recent output replayed to a new client')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Verbose')
+    args = parser.parse_args()
+
+    L.basicConfig(level=L.INFO if args.verbose else L.WARNING, format='%(asctime)s|%(levelname)s|%(message)s')
+    try:
+        ports = [ parse_port_arg(i, args.scrollback) for i in args.port ]
+    except ValueError as e:
+        L.error(str(e))
+        return 1
+    try:
+        asyncio.run(ConsoleBroker(ports, args.bind).serve())
+    except OSError as e:
+        L.error("broker: {0}".format(e))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main())
+
+    import unittest
+    import tty
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_parse_port_arg(self):
+            port = parse_port_arg("/dev/ttyRT1ow:115200:6000")
+            self.assertEqual((port.device, port.baud, port.tcp_port), ("/dev/ttyRT1ow", 115200, 6000))
+            self.assertRaises(ValueError, parse_port_arg, "/dev/ttyUSB0:9600")
+
+        def test_broker(self):
+            # the pty pair stands in for the serial port, the master is the device side
+            fd_master, fd_slave = os.openpty()
+            tty.setraw(fd_master)
+            async def read_until(reader, pattern):
+                data = b''
+                while not pattern in data:
+                    data += await asyncio.wait_for(reader.read(4096), 5)
+                return data
+            async def read_device(size):
+                loop = asyncio.get_running_loop()
+                return await asyncio.wait_for(loop.run_in_executor(None, os.read, fd_master, size), 5)
+            async def scenario():
+                port = BrokerPort(os.ttyname(fd_slave), 115200, 0, scrollback=32)
+                broker = ConsoleBroker([port], '127.0.0.1')
+                await broker.start()
+                try:
+                    boot_log = b"boot log ... Please press Enter to activate this console.\r\nroot@OpenWrt:/# "
+                    os.write(fd_master, boot_log)
+                    await asyncio.sleep(0.2)
+                    # the scrollback keeps the recent output only
+                    self.assertEqual(bytes(port.history), boot_log[-32:])
+                    # the new client gets the prompt at once
+                    reader1, writer1 = await asyncio.open_connection('127.0.0.1', port.tcp_port)
+                    self.assertTrue((await read_until(reader1, b"root@OpenWrt:/# ")).endswith(b"root@OpenWrt:/# "))
+                    writer1.write(b"uname\n")
+                    self.assertEqual(await read_device(100), b"uname\n")
+                    # the second client watches only
+                    reader2, writer2 = await asyncio.open_connection('127.0.0.1', port.tcp_port)
+                    await read_until(reader2, b"root@OpenWrt:/# ")
+                    writer2.write(b"reboot\n")
+                    await read_until(reader2, b"is read-only")
+                    os.write(fd_master, b"Linux\r\nroot@OpenWrt:/# ")
+                    await read_until(reader1, b"Linux")
+                    await read_until(reader2, b"Linux")
+                    # the lease is released when the writer leaves
+                    writer1.close()
+                    await asyncio.sleep(0.2)
+                    self.assertEqual(port.lease, None)
+                    writer2.write(b"date\n")
+                    self.assertEqual(await read_device(100), b"date\n")
+                    writer2.close()
+                finally:
+                    await broker.stop()
+            try:
+                asyncio.run(scenario())
+            finally:
+                os.close(fd_master)
+                os.close(fd_slave)
+
+        def test_paste(self):
+            # the paste is larger than the buffer of the pty, the device doesn't read it yet
+            fd_master, fd_slave = os.openpty()
+            tty.setraw(fd_master)
+            tty.setraw(fd_slave)
+            paste = b"x" * 65536
+            async def read_until(reader, pattern):
+                data = b''
+                while not pattern in data:
+                    data += await asyncio.wait_for(reader.read(4096), 5)
+                return data
+            async def scenario():
+                port = BrokerPort(os.ttyname(fd_slave), 115200, 0)
+                broker = ConsoleBroker([port], '127.0.0.1')
+                await broker.start()
+                try:
+                    reader1, writer1 = await asyncio.open_connection('127.0.0.1', port.tcp_port)
+                    reader2, writer2 = await asyncio.open_connection('127.0.0.1', port.tcp_port)
+                    writer1.write(paste)
+                    await asyncio.sleep(0.2)
+                    self.assertGreater(len(port._pending), 0)
+                    # the loop still serves the other clients
+                    os.write(fd_master, b"tick")
+                    await read_until(reader2, b"tick")
+                    # the rest is written when the device reads
+                    loop = asyncio.get_running_loop()
+                    data = b''
+                    while len(data) < len(paste):
+                        data += await asyncio.wait_for(loop.run_in_executor(None, os.read, fd_master, 65536), 5)
+                    self.assertEqual(data, paste)
+                    writer1.close()
+                    writer2.close()
+                finally:
+                    await broker.stop()
+            try:
+                asyncio.run(scenario())
+            finally:
+                os.close(fd_master)
+                os.close(fd_slave)
+
+    unittest.main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# drain the console in background
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import os
+import errno
+import select
+import threading
+import time
+import logging as L
+
+import pexpect
+from pexpect_serial import SerialSpawn
+
+# the default size of the ring buffer, enough for the boot log of most of the devices
+DEFAULT_RING_SIZE = 1024 * 1024
+
+## RingBuffer Class
+#
+#  A bounded buffer of the console output. Each byte has a monotonic sequence number,
+#  so the readers keep their own cursors, and the oldest bytes are dropped if the buffer is full.
+class RingBuffer():
+    def __init__(self, capacity=DEFAULT_RING_SIZE):
+        self.capacity = capacity
+        self._buf = bytearray()
+        self._seq_start = 0 # the sequence number of the first byte in the buffer
+        self._eof = False
+        self._cond = threading.Condition()
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## the sequence number of the next byte to be written
+    def get_seq_end(self):
+        with self._cond:
+            return self._seq_start + len(self._buf)
+    seq_end = property(get_seq_end)
+
+    def get_eof(self):
+        with self._cond:
+            return self._eof
+    eof = property(get_eof)
+
+    def write(self, data):
+        with self._cond:
+            self._buf += data
+            if len(self._buf) > self.capacity:
+                drop = len(self._buf) - self.capacity
+                del self._buf[:drop]
+                self._seq_start += drop
+            self._cond.notify_all()
+
+    def set_eof(self):
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    ## read the data from a sequence number
+    #  @param seq The sequence number of the reader.
+    #  @param size The max size of the data.
+    #  @param timeout The seconds to wait for the data; None to wait forever.
+    #  @return (data, the new sequence number, the number of bytes dropped before reading);
+    #    data is b'' if timeout, None if EOF.
+    def read(self, seq, size, timeout=None):
+        with self._cond:
+            if timeout is None:
+                while seq >= self._seq_start + len(self._buf) and not self._eof:
+                    self._cond.wait()
+            else:
+                tm_end = time.monotonic() + timeout
+                while seq >= self._seq_start + len(self._buf) and not self._eof:
+                    remain = tm_end - time.monotonic()
+                    if remain <= 0:
+                        break
+                    self._cond.wait(remain)
+            dropped = 0
+            if seq < self._seq_start:
+                dropped = self._seq_start - seq
+                seq = self._seq_start
+            pos = seq - self._seq_start
+            data = bytes(self._buf[pos:pos + size])
+            if not data and self._eof:
+                return (None, seq, dropped)
+            return (data, seq + len(data), dropped)
+
+## ConsoleDrain Class
+#
+#  A background thread reads the file descriptor of the console continuously into a ring buffer,
+#  so the device output never stays in the kernel buffers.
+class ConsoleDrain():
+    def __init__(self, fd, capacity=DEFAULT_RING_SIZE):
+        self.fd = fd
+        self.ring = RingBuffer(capacity)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="console-drain", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread and self._thread != threading.current_thread():
+            self._thread.join(1)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                rlist = select.select([self.fd], [], [], 0.2)[0]
+                if not rlist:
+                    continue
+                data = os.read(self.fd, 65536)
+            except InterruptedError:
+                continue
+            except (OSError, ValueError) as e:
+                # EIO is the EOF of the pty on Linux; EBADF if the fd was closed
+                if isinstance(e, OSError) and not e.errno in (errno.EIO, errno.EBADF):
+                    L.error("console drain: {0}".format(e))
+                break
+            if not data:
+                break
+            self.ring.write(data)
+        self.ring.set_eof()
+
+## ConsoleDrainMixin Class
+#
+#  The mixin of the pexpect spawn classes, the read_nonblocking() reads from the ring buffer of a ConsoleDrain.
+#  The drain is started by start_drain(), the spawn works as usual before that.
+class ConsoleDrainMixin():
+    _drain = None
+    _drain_seq = 0
+
+    def start_drain(self, capacity=DEFAULT_RING_SIZE):
+        if self._drain:
+            return
+        self._drain = ConsoleDrain(self.child_fd, capacity)
+        self._drain_seq = self._drain.ring.seq_end
+        self._drain.start()
+
+    def stop_drain(self):
+        if self._drain:
+            self._drain.stop()
+
+    ## drop all of the received data not matched yet, it only moves the cursor and clears the buffer of expect
+    #  @return the number of bytes dropped
+    def discard_pending(self):
+        if not self._drain:
+            return None
+        seq_end = self._drain.ring.seq_end
+        dropped = seq_end - self._drain_seq + len(self.buffer)
+        self._drain_seq = seq_end
+        self.buffer = self.string_type()
+        self._before = self.buffer_type()
+        return dropped
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if not self._drain:
+            return super().read_nonblocking(size, timeout)
+        if timeout == -1:
+            timeout = self.timeout
+        data, self._drain_seq, dropped = self._drain.ring.read(self._drain_seq, size, timeout)
+        if dropped > 0:
+            L.warning("console drain: the ring buffer is full, {0} bytes lost".format(dropped))
+        if data is None:
+            self.flag_eof = True
+            raise pexpect.EOF('End Of File (EOF). Console drain stopped.')
+        if not data:
+            raise pexpect.TIMEOUT('Timeout exceeded.')
+        s = self._decoder.decode(data, final=False)
+        self._log(s, 'read')
+        return s
+
+    def close(self, *args, **kwargs):
+        self.stop_drain()
+        return super().close(*args, **kwargs)
+
+class DrainedSpawn(ConsoleDrainMixin, pexpect.spawn):
+    pass
+
+class DrainedSerialSpawn(ConsoleDrainMixin, SerialSpawn):
+    pass
+
+if __name__ == '__main__':
+    import unittest
+    from pexpect import fdpexpect
+    class DrainedFdSpawn(ConsoleDrainMixin, fdpexpect.fdspawn):
+        pass
+
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_ring_buffer(self):
+            ring = RingBuffer(8)
+            ring.write(b'0123')
+            self.assertEqual(ring.read(0, 100, 0), (b'0123', 4, 0))
+            self.assertEqual(ring.read(4, 100, 0), (b'', 4, 0))
+            ring.write(b'456789')
+            # the oldest 2 bytes were dropped
+            self.assertEqual(ring.read(0, 3, 0), (b'234', 5, 2))
+            self.assertEqual(ring.seq_end, 10)
+            ring.set_eof()
+            self.assertEqual(ring.read(10, 100, 0), (None, 10, 0))
+
+        def test_drained_spawn(self):
+            fd_r, fd_w = os.pipe()
+            try:
+                pexp = DrainedFdSpawn(fd_r, timeout=5)
+                pexp.start_drain()
+                os.write(fd_w, b'boot log ...\r\nPlease press Enter to activate this console.\r\n')
+                pexp.expect('Please press Enter')
+                # wait the drain thread to read the data
+                tm_end = time.monotonic() + 5
+                os.write(fd_w, b'old output')
+                while pexp._drain.ring.seq_end < pexp._drain_seq + 10 and time.monotonic() < tm_end:
+                    time.sleep(0.01)
+                self.assertEqual(pexp.discard_pending(), 10 + len(b' to activate this console.\r\n'))
+                os.write(fd_w, b'root@OpenWrt:/# ')
+                pexp.expect('root@.*:/# ')
+                self.assertEqual(pexp.before, b'')
+                self.assertRaises(pexpect.TIMEOUT, pexp.read_nonblocking, 10, 0.1)
+                os.close(fd_w); fd_w = None
+                self.assertRaises(pexpect.EOF, pexp.read_nonblocking, 10, 5)
+                pexp.stop_drain()
+            finally:
+                if fd_w:
+                    os.close(fd_w)
+                os.close(fd_r)
+
+    unittest.main()
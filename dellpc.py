@@ -20,7 +20,7 @@ import time
 import re
 import pexpect
 
-from switchdevice import Switch
+from switchdevice import Switch, cached_fact, FINGERPRINT_PREFIX
 from parseclock import parse_clock_dellpc
 
 try:
@@ -115,6 +115,8 @@ def parse_host_name(str_output):
 class DellSwitch(Switch):
     def __init__(self):
         super().__init__()
+        # the console speed is a line setting of the running config
+        self.console_speed_saved = True
 
     def _enter_enable(self):
         L.debug("enter to console")
@@ -123,11 +125,11 @@ class DellSwitch(Switch):
         #self.pexp.sendcontrol('c')
         while True:
             L.debug("enter to active prompt ...")
-            time.sleep(1)
+            time.sleep(self.get_poll_interval('prompt', 1))
             self.pexp.sendline("\r\n\r\n")
             #self.pexp.sendline('\r\nsh run | i ostname\r\n')
             responses = ["Press RETURN to get started.", ">", "#", pexpect.EOF, pexpect.TIMEOUT]
-            ret = self.pexp.expect(responses, timeout=3)
+            ret = self.timed_expect('prompt', responses, 3)
             #if ret < 3:
             #    ln_before = self.pexp.before.decode('UTF-8')
             #    ln_after = self.pexp.after.decode('UTF-8')
@@ -162,49 +164,63 @@ class DellSwitch(Switch):
         self.pexp.sendline('show system\r\n')
         self.pexp.sendline('show clock\r\n')
 
+    # line console / speed
+    def _send_console_speed(self, baud):
+        self._enter_enable()
+        self.pexp.sendline("configure\r\n")
+        self.expect(["\(config\)#"])
+        self.pexp.sendline("line console\r\n")
+        self.expect(["\(config-line\)#"])
+        self.pexp.sendline("speed {0}\r\n".format(baud))
+        return True
+
     # save the current config to disk
     def save_config(self):
         self._enter_enable()
         self.pexp.sendline("copy running-config startup-config\r\n")
-        self.pexp.expect("The copy operation was completed successfully")
+        self.expect("The copy operation was completed successfully")
 
     # reboot system
     def reboot(self, wait_network=True):
         hostname = self.get_hostname()
         self._enter_enable()
+        self.invalidate_facts()
         L.info("reboot ...")
+        tm_start = time.monotonic()
         while True:
             L.debug("send 'reload' ...")
             self.pexp.sendline("reload")
-            ret = self.pexp.expect(["\(Y/N\)","{0}#".format(hostname)])
+            ret = self.expect(["\(Y/N\)","{0}#".format(hostname)])
             L.debug("get respose: {0}".format(ret))
             if ret == 0:
                 L.debug("send reboot 'Y' ans ...")
                 self.pexp.sendline("Y\r\n")
-                ret = self.pexp.expect(["Shutting down","{0}#".format(hostname)])
+                ret = self.expect(["Shutting down","{0}#".format(hostname)])
                 if ret == 0:
                     break
             time.sleep(1)
 
-        ret = self.pexp.expect(["press RETURN or Esc."])
+        ret = self.timed_expect('reboot', ["press RETURN or Esc."], tm_start=tm_start)
 
         L.info("reboot DONE")
 
+    @cached_fact('model')
     def get_model_name(self):
         self._enter_enable()
         self.pexp.sendline('show system\r\n')
-        self.pexp.expect('Main Power Supply Status')
+        self.expect('Main Power Supply Status')
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("model ln_before=" + str(ln_before))
         L.debug("model ln_after=" + str(ln_after))
         return parse_model_line(ln_before)
 
+    @cached_fact('version')
     def get_version(self):
         self._enter_enable()
         self.pexp.sendline('sh ver\r\n')
         #time.sleep(3)
-        self.pexp.expect('Boot version')
+        self.expect('Boot version')
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("version ln_before=" + str(ln_before))
@@ -219,7 +235,7 @@ class DellSwitch(Switch):
     def get_ports(self):
         self._enter_enable()
         self.pexp.sendline("show int status\r\n")
-        self.pexp.expect("Ch       Type    Duplex  Speed  Neg      control  State")
+        self.expect("Ch       Type    Duplex  Speed  Neg      control  State")
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("vlan-switch ln_before=" + str(ln_before))
@@ -231,43 +247,64 @@ class DellSwitch(Switch):
         self._enter_enable()
         self.pexp.sendline("show vlan\r\n")
         time.sleep(1)
-        self.pexp.expect("Authorization")
-        self.pexp.expect("#")
+        self.expect("Authorization")
+        self.expect("#")
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("vlan-switch ln_before=" + str(ln_before))
         L.debug("vlan-switch ln_after=" + str(ln_after))
         return parse_vlans(ln_before)
 
+    @cached_fact('hostname')
     def get_hostname(self):
         self._enter_enable()
         self.pexp.sendline('show system\r\n')
-        self.pexp.expect('Main Power Supply Status')
+        self.expect('Main Power Supply Status')
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("hostname ln_before=" + str(ln_before))
         L.debug("hostname ln_after=" + str(ln_after))
         return parse_host_name(ln_before)
 
+    ## get the fingerprint of the config applied, it's stored in the SNMP location
+    #  The tool owns the SNMP location: set_config_fingerprint() replaces or removes the location set by the others.
+    def get_config_fingerprint(self):
+        self._enter_enable()
+        return self._show_config_fingerprint('show running-config | include snmp-server location')
+
+    def set_config_fingerprint(self, digest):
+        self._enter_enable()
+        self.pexp.sendline("config\r\n")
+        self.expect("\(config\)#")
+        if digest:
+            self.pexp.sendline("snmp-server location {0}{1}\r\n".format(FINGERPRINT_PREFIX, digest))
+        else:
+            self.pexp.sendline("no snmp-server location\r\n")
+        self.expect("\(config\)#")
+        self.pexp.sendline("exit\r\n")
+        self.expect("#")
+        return True
+
     def set_root_passwd(self, root_pw):
         self._enter_enable()
         self.pexp.sendline("config t\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("enable secret {0}\r\n".format(root_pw))
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect(">")
+        self.expect(">")
 
     def set_hostname(self, hostname):
         self._enter_enable()
+        self.invalidate_facts('hostname')
         self.pexp.sendline("config\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("hostname {0}\r\n".format(hostname))
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("{0}#".format(hostname))
+        self.expect("{0}#".format(hostname))
 
     # set current time to device
     def set_clock(self):
@@ -275,17 +312,17 @@ class DellSwitch(Switch):
         self._enter_enable()
         L.debug("set_clock ...")
         self.pexp.sendline("config\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("clock timezone -5 zone UTC\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("clock summer-time recurring first sun apr 2:00 last sun oct 2:00\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
         str_time = strftime("%H:%M:%S %b %d %Y", localtime())
         L.info("clock set {0} ...".format(str_time))
         self.pexp.sendline("clock set {0}\r\n".format(str_time))
-        self.pexp.expect("#")
+        self.expect("#")
         L.info("clock set DONE")
         return True
 
@@ -293,7 +330,7 @@ class DellSwitch(Switch):
         self._enter_enable()
         L.debug("get_clock ...")
         self.pexp.sendline('show clock\r\n')
-        self.pexp.expect(["Time source is","No time source"])
+        self.expect(["Time source is","No time source"])
         ln_before = self.pexp.before.decode('UTF-8')
         ln_after = self.pexp.after.decode('UTF-8')
         L.debug("get_clock ln_before=" + str(ln_before))
@@ -309,25 +346,27 @@ class DellSwitch(Switch):
         hostname = 'Switch'
         self.set_hostname(hostname)
         self._enter_enable()
+        # no reboot, the model and the version are kept for set_vlans()
+        self.invalidate_facts('hostname')
 
         self.pexp.sendline("config\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
 
         L.info("reset interfaces")
         self.pexp.sendline("interface range ethernet all\r\n")
-        self.pexp.expect("\(config-if\)#")
+        self.expect("\(config-if\)#")
         self.pexp.sendline("switchport trunk allowed vlan remove all\r\n")
-        self.pexp.expect("\(config-if\)#")
+        self.expect("\(config-if\)#")
         self.pexp.sendline("switchport mode access\r\n")
-        self.pexp.expect("\(config-if\)#")
+        self.expect("\(config-if\)#")
         self.pexp.sendline("switchport access vlan 1\r\n")
-        self.pexp.expect("\(config-if\)#")
-        #self.pexp.sendline("mtu 9000\r\n"); self.pexp.expect("\(config-if\)#")
-        #self.pexp.sendline("no ip address\r\n"); self.pexp.expect("\(config-if\)#")
+        self.expect("\(config-if\)#")
+        #self.pexp.sendline("mtu 9000\r\n"); self.expect("\(config-if\)#")
+        #self.pexp.sendline("no ip address\r\n"); self.expect("\(config-if\)#")
         self.pexp.sendline("no shutdown\r\n")
-        self.pexp.expect("\(config-if\)#")
+        self.expect("\(config-if\)#")
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
 
         L.info("reset VLANs")
         for i in vlan_list:
@@ -335,25 +374,25 @@ class DellSwitch(Switch):
                 continue
             L.info("reset vlan {0} ...".format(i))
             self.pexp.sendline("interface vlan {0}\r\n".format(i))
-            self.pexp.expect("\(config-if\)#")
+            self.expect("\(config-if\)#")
             self.pexp.sendline("no ip address\r\n")
-            self.pexp.expect("\(config-if\)#")
+            self.expect("\(config-if\)#")
             self.pexp.sendline("exit\r\n")
-            self.pexp.expect("\(config\)#")
+            self.expect("\(config\)#")
 
         L.info("remove vlan record one by one: {0}".format(vlan_list))
         self.pexp.sendline("vlan database\r\n")
-        self.pexp.expect("vlan\)#")
+        self.expect("vlan\)#")
         for i in vlan_list:
             if (1 < i) and (i < 1000):
                 L.info("no vlan {0} ...".format(i))
                 self.pexp.sendline("no vlan {0}\r\n".format(i))
-                self.pexp.expect(["vlan\)#"])
+                self.expect(["vlan\)#"])
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
 
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
 
         L.info("reset config DONE")
         return True
@@ -370,17 +409,17 @@ class DellSwitch(Switch):
         self._enter_enable()
 
         self.pexp.sendline("config\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("vlan database\r\n")
-        self.pexp.expect("vlan\)#")
+        self.expect("vlan\)#")
         for i in vlan_set:
             self.pexp.sendline("vlan {0}\r\n".format(i))
-            self.pexp.expect("vlan\)#")
+            self.expect("vlan\)#")
 
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
 
         vlan_set2 = self.get_vlans()
         vlist2 = [str(element) for element in vlan_set2]
@@ -388,43 +427,43 @@ class DellSwitch(Switch):
 
         L.info("setup ports with VLANs ...")
         self.pexp.sendline("config\r\n")
-        self.pexp.expect("\(config\)#")
+        self.expect("\(config\)#")
         for i in range(0,len(vlan_list)):
             if vlan_list[i] == 0:
                 # setup trunk
                 L.info("setup port {0} -> trunk ...".format(port_list[i]))
                 self.pexp.sendline("interface ethernet {0}\r\n".format(port_map[port_list[i]]))
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 #self.pexp.sendline("switchport trunk encapsulation dot1q\r\n")
-                #self.pexp.expect("\(config-if\)#")
+                #self.expect("\(config-if\)#")
                 self.pexp.sendline("switchport mode trunk\r\n")
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("switchport trunk allowed vlan add {0}\r\n".format(str_vlans))
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("no shutdown\r\n")
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("exit\r\n")
-                self.pexp.expect("\(config\)#")
+                self.expect("\(config\)#")
             else:
                 # setup vlan
                 L.info("setup port {0} -> VLAN {1} ...".format(port_list[i], vlan_list[i]))
                 self.pexp.sendline("interface ethernet {0}\r\n".format(port_map[port_list[i]]))
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("switchport mode access\r\n")
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("switchport access vlan {0}\r\n".format(vlan_list[i]))
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("no shutdown\r\n")
-                self.pexp.expect("\(config-if\)#")
+                self.expect("\(config-if\)#")
                 self.pexp.sendline("exit\r\n")
-                self.pexp.expect("\(config\)#")
+                self.expect("\(config\)#")
 
         self.pexp.sendline("exit\r\n")
-        self.pexp.expect("#")
-        #self.pexp.sendline("exit\r\n"); self.pexp.expect(">")
+        self.expect("#")
+        #self.pexp.sendline("exit\r\n"); self.expect(">")
 
         self.pexp.sendline("sh vlan\r\n")
-        self.pexp.expect("#")
+        self.expect("#")
         L.info("set_vlans DONE")
         return True
 
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the precompiled pattern sets for pexpect
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import re
+import functools
+import logging as L
+
+import pexpect
+
+# the default search window in bytes; it should be larger than the maxread of the spawn (2000 by default)
+DEFAULT_SEARCH_WINDOW = 16384
+
+# the regex meta characters, a pattern without them (unless escaped) is a literal string
+_REGEX_META = set('.^$*+?{}[]|()')
+
+## convert a regex pattern to a literal string if it has no regex meta characters
+#  @param pattern The regex pattern, such as '\(config-if\)#'.
+#  @return the literal string, such as '(config-if)#', or None if it's not a literal
+def pattern_to_literal(pattern):
+    ret = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 >= len(pattern):
+                return None
+            n = pattern[i + 1]
+            # '\d', '\s', '\n', ... are not literal
+            if n.isalnum() or n == '_':
+                return None
+            ret.append(n)
+            i += 2
+            continue
+        if c in _REGEX_META:
+            return None
+        ret.append(c)
+        i += 1
+    return "".join(ret)
+
+## PatternSet Class
+#
+#  A list of the patterns compiled once for bytes, the same semantics as pexpect.expect():
+#  the string patterns are regex (re.DOTALL), and pexpect.EOF/pexpect.TIMEOUT can be in the list.
+#  The patterns without regex meta characters are searched by bytes.find().
+class PatternSet():
+    def __init__(self, patterns):
+        if not isinstance(patterns, (list, tuple)):
+            patterns = [patterns]
+        self.patterns = list(patterns)
+        self.eof_index = -1
+        self.timeout_index = -1
+        # list of (index, literal bytes or None, compiled regex)
+        self._items = []
+        for idx, p in enumerate(self.patterns):
+            if p is pexpect.EOF:
+                self.eof_index = idx
+                continue
+            if p is pexpect.TIMEOUT:
+                self.timeout_index = idx
+                continue
+            if isinstance(p, type(re.compile(b''))):
+                self._items.append((idx, None, p))
+                continue
+            if isinstance(p, str):
+                p = p.encode('UTF-8')
+            literal = pattern_to_literal(p.decode('UTF-8', errors='replace'))
+            if literal is not None:
+                literal = literal.encode('UTF-8')
+                self._items.append((idx, literal, re.compile(re.escape(literal), re.DOTALL)))
+            else:
+                self._items.append((idx, None, re.compile(p, re.DOTALL)))
+        # the max length of the literals, if all of the patterns are literals
+        self.longest_string = None
+        if self._items and all(i[1] is not None for i in self._items):
+            self.longest_string = max(len(i[1]) for i in self._items)
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## create a searcher for pexpect expect_loop()
+    def searcher(self):
+        return PatternSetSearcher(self)
+
+## PatternSetSearcher Class
+#
+#  The searcher used by pexpect expect_loop(), see pexpect.expect.searcher_re
+class PatternSetSearcher():
+    def __init__(self, pattern_set):
+        self._items = pattern_set._items
+        self.eof_index = pattern_set.eof_index
+        self.timeout_index = pattern_set.timeout_index
+        if pattern_set.longest_string:
+            self.longest_string = pattern_set.longest_string
+        self.start = None
+        self.end = None
+        self.match = None
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## search the buffer, it returns the index of the pattern matched first in the buffer
+    #  @param buffer The bytes to be searched.
+    #  @param freshlen The length of the new data at the end of the buffer.
+    #  @param searchwindowsize The max length of the tail of the buffer to be searched.
+    def search(self, buffer, freshlen, searchwindowsize=None):
+        first_match = None
+        best_index = -1
+        search_start = 0
+        if searchwindowsize is not None:
+            search_start = max(0, len(buffer) - searchwindowsize)
+        for idx, literal, rx in self._items:
+            if literal is not None:
+                # the literal only needs to be searched in the fresh data and the tail before it
+                pos = max(search_start, len(buffer) - freshlen - len(literal) + 1)
+                found = buffer.find(literal, pos)
+                if found < 0:
+                    continue
+                match = rx.match(buffer, found)
+            else:
+                match = rx.search(buffer, search_start)
+                if not match:
+                    continue
+            if first_match is None or match.start() < first_match.start():
+                first_match = match
+                best_index = idx
+        if first_match is None:
+            return -1
+        self.start = first_match.start()
+        self.end = first_match.end()
+        self.match = first_match
+        return best_index
+
+## get the precompiled pattern set
+#  @param owner The owner of the pattern set, such as the driver class name.
+#  @param patterns A pattern or a list of the patterns.
+@functools.lru_cache(maxsize=1024)
+def _get_pattern_set(owner, patterns):
+    return PatternSet(list(patterns))
+
+def get_pattern_set(owner, patterns):
+    if not isinstance(patterns, (list, tuple)):
+        patterns = [patterns]
+    return _get_pattern_set(owner, tuple(patterns))
+
+## expect a pattern set
+#  @param pexp The pexpect spawn (bytes), or one like that has expect_loop().
+#  @param pattern_set The PatternSet.
+#  @param timeout The timeout in seconds, -1 for the default timeout of the spawn, None to block.
+#  @param searchwindowsize The search window in bytes, None to search the whole buffer.
+#  @return the index of the matched pattern, the same as pexpect.expect()
+def expect_pattern_set(pexp, pattern_set, timeout=-1, searchwindowsize=DEFAULT_SEARCH_WINDOW):
+    if not hasattr(pexp, 'expect_loop'):
+        # not a pexpect spawn, such as a stub
+        return pexp.expect(pattern_set.patterns, timeout=timeout)
+    if timeout == -1:
+        # unlike expect(), expect_loop() takes -1 as it is
+        timeout = pexp.timeout
+    if pattern_set.longest_string:
+        # pexpect searches the tail of the buffer by the length of the longest literal
+        searchwindowsize = None
+    return pexp.expect_loop(pattern_set.searcher(), timeout, searchwindowsize)
+
+if __name__ == '__main__':
+    import unittest
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_pattern_to_literal(self):
+            self.assertEqual(pattern_to_literal("\\(config-if\\)#"), "(config-if)#")
+            self.assertEqual(pattern_to_literal("Signature check passed."), None)
+            self.assertEqual(pattern_to_literal("built-in shell"), "built-in shell")
+            self.assertEqual(pattern_to_literal("root@.*:/#"), None)
+            self.assertEqual(pattern_to_literal("Port[\\s]+Name"), None)
+            self.assertEqual(pattern_to_literal("\\d+"), None)
+
+        def test_search(self):
+            pset = PatternSet(["Entry not found", "root@.*:/#", pexpect.EOF, pexpect.TIMEOUT])
+            self.assertEqual(pset.eof_index, 2)
+            self.assertEqual(pset.timeout_index, 3)
+            self.assertEqual(pset.longest_string, None)
+            s = pset.searcher()
+            buf = b"uci delete network.x\r\nuci: Entry not found\r\nroot@OpenWrt:/# "
+            self.assertEqual(s.search(buf, len(buf)), 0)
+            self.assertEqual(buf[s.start:s.end], b"Entry not found")
+            buf = b"uci commit\r\nroot@OpenWrt:/# "
+            self.assertEqual(s.search(buf, len(buf)), 1)
+            self.assertEqual(s.match.group(0), b"root@OpenWrt:/#")
+            self.assertEqual(s.search(b"abc", 3), -1)
+
+        def test_search_window(self):
+            s = PatternSet(["root@.*:/#"]).searcher()
+            buf = b"root@OpenWrt:/# " + b"x" * 100
+            self.assertEqual(s.search(buf, len(buf), None), 0)
+            self.assertEqual(s.search(buf, len(buf), 50), -1)
+
+        def test_literal(self):
+            pset = PatternSet(["\\(config\\)#", "\\(config-if\\)#"])
+            self.assertEqual(pset.longest_string, len("(config-if)#"))
+            s = pset.searcher()
+            buf = b"interface Gi0/1\r\nsw1(config-if)#"
+            self.assertEqual(s.search(buf, 5), 1)
+            self.assertEqual(s.match.group(0), b"(config-if)#")
+
+        def test_expect(self):
+            import os
+            from pexpect import fdpexpect
+            fd_r, fd_w = os.pipe()
+            try:
+                pexp = fdpexpect.fdspawn(fd_r, timeout=5)
+                os.write(fd_w, b"Password:\r\nswitch1#")
+                self.assertEqual(expect_pattern_set(pexp, get_pattern_set("test", ["\\(config\\)#", "#"])), 1)
+                self.assertEqual(pexp.before, b"Password:\r\nswitch1")
+                os.write(fd_w, b"DISTRIB_RELEASE='22.03.5'\r\nroot@OpenWrt:/# ")
+                self.assertEqual(expect_pattern_set(pexp, get_pattern_set("test", "root@.*:/#")), 0)
+                self.assertEqual(expect_pattern_set(pexp, get_pattern_set("test", ["abc", pexpect.TIMEOUT]), timeout=0.1), 1)
+                self.assertIs(get_pattern_set("test", "root@.*:/#"), get_pattern_set("test", ["root@.*:/#"]))
+            finally:
+                os.close(fd_w)
+                os.close(fd_r)
+
+    unittest.main()
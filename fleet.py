@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# set up many network equipments in parallel from an inventory file
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import os
+import time
+import logging
+import threading
+import concurrent.futures
+
+import pyjson5
+
+import mylog
+L = logging.getLogger('switch')
+
+# the max number of the devices set up at the same time
+DEFAULT_MAX_WORKERS = 8
+
+## get the group of the devices sharing a console server or a serial hub
+#  @param configs The config of the device.
+#  @return the 'fleet_group' in the config if set; the address of the console server for telnet,
+#          'serial' for the local serial ports, the host for ssh and virsh.
+def get_device_group(configs):
+    if ('fleet_group' in configs) and configs['fleet_group']:
+        return configs['fleet_group']
+    if ('ssh_host' in configs) and configs['ssh_host'] and configs['ssh_host'].strip():
+        return configs['ssh_host'].strip()
+    if ('ipaddr' in configs) and configs['ipaddr'] and configs['ipaddr'].strip():
+        return configs['ipaddr'].strip()
+    if ('serial' in configs) and configs['serial'] and configs['serial'].strip():
+        return 'serial'
+    if 'virsh_name' in configs:
+        return configs['virsh_url'].strip() if ('virsh_url' in configs) and configs['virsh_url'] else 'virsh'
+    return 'default'
+
+## FleetDevice Class
+#
+#  A device of the inventory.
+class FleetDevice():
+    def __init__(self, name, configs, command="layout", reset=True, group=None, depends_on=[]):
+        self.name = name
+        self.configs = configs
+        self.command = command
+        self.reset = reset
+        self.group = group if group else get_device_group(configs)
+        # the names of the devices to be set up before this one, such as the main router of an edge switch
+        self.depends_on = list(depends_on)
+
+    def __str__(self):
+        return self.__class__.__name__
+
+## get the dependency tiers of the devices
+#  @param devices The list of FleetDevice.
+#  @return a dict of {name: tier}, the tier is 0 for the devices without dependencies, and 1 + the max tier of the dependencies for others.
+def get_device_tiers(devices):
+    by_name = { i.name: i for i in devices }
+    for dev in devices:
+        for i in dev.depends_on:
+            if not i in by_name:
+                raise ValueError("device '{0}' depends on unknown device '{1}'".format(dev.name, i))
+    tiers = {}
+    visiting = []
+    def visit(dev):
+        if dev.name in tiers:
+            return tiers[dev.name]
+        if dev.name in visiting:
+            raise ValueError("circular dependency: {0}".format(" -> ".join(visiting[visiting.index(dev.name):] + [dev.name])))
+        visiting.append(dev.name)
+        tiers[dev.name] = 1 + max([ visit(by_name[i]) for i in dev.depends_on ], default=-1)
+        visiting.pop()
+        return tiers[dev.name]
+    for dev in devices:
+        visit(dev)
+    return tiers
+
+## Fleet Class
+#
+#  Set up the devices on a worker pool. The devices of the same group, such as the ports of a console server,
+#  are limited by the group limit, so the console server or the serial hub is not overloaded.
+#  A device starts as soon as all of the devices it depends on are done, it doesn't wait for the other devices of its tier;
+#  the device is skipped if any of them failed.
+class Fleet():
+    ## the constructor
+    #  @param devices The list of FleetDevice.
+    #  @param limits The max number of the devices running at the same time for each group, such as {'serial': 2}; no limit if not set.
+    #  @param max_workers The max number of the devices running at the same time, at least 1.
+    #  @param logdir The directory of the per-device logs, '<name>.log', None for no per-device logs.
+    def __init__(self, devices, limits={}, max_workers=DEFAULT_MAX_WORKERS, logdir=None):
+        self.devices = devices
+        self.limits = limits
+        self.max_workers = max_workers
+        self.logdir = logdir
+        if not (isinstance(max_workers, int) and max_workers >= 1):
+            raise ValueError("max_workers should be at least 1: {0}".format(max_workers))
+        names = [ i.name for i in devices ]
+        if len(set(names)) != len(names):
+            raise ValueError("duplicated device names in the inventory: {0}".format(names))
+        self.tiers = get_device_tiers(devices)
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## set up a device, and log it to the per-device log
+    def _run_device(self, func, dev):
+        thread = threading.current_thread()
+        thread_name = thread.name
+        thread.name = "fleet-" + dev.name
+        handler = None
+        if self.logdir:
+            handler = logging.FileHandler(os.path.join(self.logdir, dev.name + ".log"))
+            handler.setFormatter(logging.Formatter(mylog.FMT_LOGGING))
+            # the records of the other devices are logged by the other threads, the sub-threads are named '<thread>-...'
+            handler.addFilter(lambda record, name=thread.name: record.threadName == name or record.threadName.startswith(name + "-"))
+            logging.getLogger().addHandler(handler)
+        result = { 'name': dev.name, 'group': dev.group, 'command': dev.command, 'tier': self.tiers[dev.name], 'ok': False, 'error': None }
+        tm_start = time.monotonic()
+        try:
+            L.info("fleet: start '{0}' ({1})".format(dev.name, dev.command))
+            result['ok'] = bool(func(dev.configs, reset=dev.reset, command=dev.command))
+        except Exception as e:
+            L.exception("fleet: '{0}' failed".format(dev.name))
+            result['error'] = str(e)
+        finally:
+            result['seconds'] = time.monotonic() - tm_start
+            L.info("fleet: '{0}' {1} in {2:.1f} seconds".format(dev.name, "done" if result['ok'] else "FAILED", result['seconds']))
+            if handler:
+                logging.getLogger().removeHandler(handler)
+                handler.close()
+            thread.name = thread_name
+        return result
+
+    ## check if the device can start now
+    def _can_start(self, dev, running_groups, results):
+        if not all(i in results for i in dev.depends_on):
+            return False
+        limit = self.limits.get(dev.group, 0)
+        return limit <= 0 or running_groups.get(dev.group, 0) < limit
+
+    ## get the number of the devices depending on the device directly or indirectly
+    def _count_dependents(self, dev):
+        found = set()
+        todo = [dev.name]
+        while todo:
+            name = todo.pop()
+            for i in self.devices:
+                if name in i.depends_on and not i.name in found:
+                    found.add(i.name)
+                    todo.append(i.name)
+        return len(found)
+
+    ## set up all of the devices
+    #  @param func The function to set up a device, func(configs, reset, command), such as setnetequ.setup_network_equipment().
+    #  @return the list of the result dicts in the order of the devices: {'name', 'group', 'command', 'tier', 'ok', 'error', 'seconds'}
+    def run(self, func):
+        if self.logdir:
+            os.makedirs(self.logdir, exist_ok=True)
+        results = {}
+        # the devices with more dependents start first, so their branches are not delayed by the caps
+        pending = sorted(self.devices, key=lambda dev: -self._count_dependents(dev))
+        running = {}
+        running_groups = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="fleet") as executor:
+            while pending or running:
+                # skip the devices depending on the failed ones
+                for dev in list(pending):
+                    failed = [ i for i in dev.depends_on if (i in results) and not results[i]['ok'] ]
+                    if failed:
+                        L.error("fleet: skip '{0}', it depends on the failed '{1}'".format(dev.name, "', '".join(failed)))
+                        pending.remove(dev)
+                        results[dev.name] = { 'name': dev.name, 'group': dev.group, 'command': dev.command, 'tier': self.tiers[dev.name],
+                            'ok': False, 'error': "skipped, depends on the failed '{0}'".format("', '".join(failed)), 'seconds': 0.0 }
+                if not pending and not running:
+                    break
+                # start the devices whose dependencies are done, skip the ones of the busy groups
+                for dev in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    if not self._can_start(dev, running_groups, results):
+                        continue
+                    pending.remove(dev)
+                    running_groups[dev.group] = running_groups.get(dev.group, 0) + 1
+                    running[executor.submit(self._run_device, func, dev)] = dev
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    dev = running.pop(future)
+                    running_groups[dev.group] -= 1
+                    results[dev.name] = future.result()
+        return [ results[i.name] for i in self.devices ]
+
+## load the inventory file
+#  The inventory is a JSON file:
+#  {
+#    "max_workers": 8,
+#    "limits": { "serial": 2, "192.168.1.5": 4 },
+#    "devices": [
+#      { "config": "config-openwrt-homemain-asus.json", "name": "homemain", "command": "layout", "noreset": false, "group": "hub1" },
+#      { "config": "config-dellpc-edge-1.json", "depends_on": [ "homemain" ] },
+#      ...
+#    ]
+#  }
+#  The config files are relative to the inventory file; the name is the base name of the config file if not set.
+#  @param fn_inventory The inventory file.
+#  @param load The function to load a config file of a device, load(fn_json, name), such as setnetequ.load_config().
+#  @param command The default command of the devices.
+#  @param reset The default of resetting the devices.
+#  @param logdir The directory of the per-device logs, see Fleet().
+def load_inventory(fn_inventory, load, command="layout", reset=True, logdir=None):
+    with open(fn_inventory, "r") as fp:
+        inventory = pyjson5.load(fp)
+    basedir = os.path.dirname(os.path.abspath(fn_inventory))
+    devices = []
+    for item in inventory['devices']:
+        fn_json = os.path.join(basedir, item['config'])
+        name = item['name'] if 'name' in item else os.path.splitext(os.path.basename(fn_json))[0]
+        configs = load(fn_json, name)
+        devices.append(FleetDevice(name, configs,
+            command = item['command'] if 'command' in item else command,
+            reset = (not item['noreset']) if 'noreset' in item else reset,
+            group = item['group'] if 'group' in item else None,
+            depends_on = item['depends_on'] if 'depends_on' in item else []))
+    return Fleet(devices,
+        limits = inventory['limits'] if 'limits' in inventory else {},
+        max_workers = inventory['max_workers'] if 'max_workers' in inventory else DEFAULT_MAX_WORKERS,
+        logdir = logdir)
+
+## format the results of Fleet.run() as a table
+def format_summary(results):
+    lines = [ "{0:<24} {1:<16} {2:<8} {3:>4} {4:<8} {5:>9}".format("DEVICE", "GROUP", "COMMAND", "TIER", "RESULT", "SECONDS") ]
+    for i in results:
+        lines.append("{0:<24} {1:<16} {2:<8} {3:>4} {4:<8} {5:>9.1f}".format(i['name'], i['group'], i['command'], i['tier'], "ok" if i['ok'] else "FAILED", i['seconds']))
+        if i['error']:
+            lines.append("    " + i['error'])
+    total = sum(i['seconds'] for i in results)
+    lines.append("{0} devices, {1} failed, {2:.1f} device-seconds".format(len(results), len([ i for i in results if not i['ok'] ]), total))
+    return "\n".join(lines)
+
+if __name__ == '__main__':
+    import unittest
+    import tempfile
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_get_device_group(self):
+            self.assertEqual(get_device_group({ 'ipaddr': '192.168.1.5', 'port': 6001 }), '192.168.1.5')
+            self.assertEqual(get_device_group({ 'serial': '/dev/ttyUSB0', 'baud': 115200 }), 'serial')
+            self.assertEqual(get_device_group({ 'serial': '/dev/ttyUSB0', 'fleet_group': 'hub1' }), 'hub1')
+            self.assertEqual(get_device_group({ 'ssh_host': '10.1.1.1' }), '10.1.1.1')
+
+        def test_run(self):
+            lock = threading.Lock()
+            running = { 'serial': 0, 'max_serial': 0 }
+            def setup(configs, reset=True, command="layout"):
+                with lock:
+                    if configs['serial']:
+                        running['serial'] += 1
+                        running['max_serial'] = max(running['max_serial'], running['serial'])
+                L.info("setup {0}".format(configs['name']))
+                time.sleep(0.2)
+                with lock:
+                    if configs['serial']:
+                        running['serial'] -= 1
+                if configs['name'] == 'sw3':
+                    raise RuntimeError("no response")
+                return command == 'layout'
+            devices = [ FleetDevice("ap{0}".format(i), { 'name': "ap{0}".format(i), 'ipaddr': '', 'serial': "/dev/ttyUSB{0}".format(i) }) for i in range(4) ]
+            devices += [ FleetDevice("sw{0}".format(i), { 'name': "sw{0}".format(i), 'ipaddr': '192.168.1.5', 'serial': '' }) for i in range(4) ]
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fleet = Fleet(devices, limits={ 'serial': 2 }, logdir=tmpdir)
+                tm_start = time.monotonic()
+                results = fleet.run(setup)
+                # the switches run at the same time, the serial ports run 2 at a time
+                self.assertLess(time.monotonic() - tm_start, 0.7)
+                self.assertEqual(running['max_serial'], 2)
+                self.assertEqual([ i['name'] for i in results ], [ i.name for i in devices ])
+                self.assertEqual([ i['ok'] for i in results ], [True] * 7 + [False])
+                self.assertEqual(results[7]['error'], "no response")
+                with open(os.path.join(tmpdir, "ap1.log")) as fp:
+                    log = fp.read()
+                self.assertIn("setup ap1", log)
+                self.assertNotIn("setup ap2", log)
+                self.assertIn("8 devices, 1 failed", format_summary(results))
+            self.assertRaises(ValueError, Fleet, devices + devices[:1])
+
+        def test_depends_on(self):
+            # main -> edge1 -> ap1; main -> edge2 (slow); lab is independent; sw-x depends on the failed one
+            delays = { 'main': 0.2, 'edge1': 0.1, 'edge2': 0.6, 'ap1': 0.1, 'lab': 0.1, 'bad': 0.1, 'sw-x': 0.1 }
+            events = []
+            lock = threading.Lock()
+            def setup(configs, reset=True, command="layout"):
+                with lock:
+                    events.append(('start', configs['name'], time.monotonic()))
+                time.sleep(delays[configs['name']])
+                with lock:
+                    events.append(('end', configs['name'], time.monotonic()))
+                return configs['name'] != 'bad'
+            def dev(name, depends_on=[]):
+                return FleetDevice(name, { 'name': name, 'ipaddr': "10.0.0.{0}".format(len(name)) }, group=name, depends_on=depends_on)
+            devices = [ dev('ap1', ['edge1']), dev('edge1', ['main']), dev('edge2', ['main']), dev('main'), dev('lab'), dev('sw-x', ['bad']), dev('bad') ]
+            fleet = Fleet(devices)
+            self.assertEqual(fleet.tiers, { 'ap1': 2, 'edge1': 1, 'edge2': 1, 'main': 0, 'lab': 0, 'sw-x': 1, 'bad': 0 })
+            results = { i['name']: i for i in fleet.run(setup) }
+            times = { (i[0], i[1]): i[2] for i in events }
+            self.assertGreaterEqual(times[('start', 'edge1')], times[('end', 'main')])
+            # ap1 doesn't wait for edge2 of the same tier as edge1
+            self.assertGreaterEqual(times[('start', 'ap1')], times[('end', 'edge1')])
+            self.assertLess(times[('start', 'ap1')], times[('end', 'edge2')])
+            # the independent branch doesn't wait
+            self.assertLess(times[('start', 'lab')], times[('end', 'main')])
+            self.assertEqual((results['sw-x']['ok'], ('start', 'sw-x') in times), (False, False))
+            self.assertIn("skipped", results['sw-x']['error'])
+            self.assertEqual([ i for i in results if results[i]['ok'] ], ['ap1', 'edge1', 'edge2', 'main', 'lab'])
+            self.assertRaises(ValueError, Fleet, [ dev('a', ['b']), dev('b', ['a']) ])
+            self.assertRaises(ValueError, Fleet, [ dev('a', ['nosuch']) ])
+            # nothing would ever start
+            self.assertRaises(ValueError, Fleet, [ dev('a') ], max_workers=0)
+
+        def test_load_inventory(self):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with open(os.path.join(tmpdir, "config-ap1.json"), "w") as fp:
+                    fp.write('{ "serial": "/dev/ttyUSB0", "baud": 115200 }')
+                with open(os.path.join(tmpdir, "inventory.json"), "w") as fp:
+                    fp.write('{ "limits": { "serial": 1 }, "devices": [ { "config": "config-ap1.json", "noreset": true }, { "config": "config-ap1.json", "name": "ap1b", "command": "info", "depends_on": ["config-ap1"] } ] }')
+                names = []
+                def load(fn_json, name):
+                    names.append(name)
+                    with open(fn_json) as fp:
+                        return pyjson5.load(fp)
+                fleet = load_inventory(os.path.join(tmpdir, "inventory.json"), load)
+                self.assertEqual([ (i.name, i.command, i.reset, i.group) for i in fleet.devices ],
+                    [ ('config-ap1', 'layout', False, 'serial'), ('ap1b', 'info', True, 'serial') ])
+                # the devices sharing a config file are loaded by their own names
+                self.assertEqual(names, [ 'config-ap1', 'ap1b' ])
+                self.assertEqual((fleet.limits, fleet.max_workers), ({ 'serial': 1 }, DEFAULT_MAX_WORKERS))
+                self.assertEqual(fleet.devices[1].depends_on, ['config-ap1'])
+
+    L.setLevel(logging.INFO)
+    unittest.main()
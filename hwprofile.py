@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the local store of the hardware capability profiles
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import os
+import re
+import json
+import logging as L
+
+## get the local cache directory of the tool, such as ~/.cache/agilenet/<name>
+#  @param name The sub directory name.
+def get_cache_dir(name=""):
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'agilenet', name)
+
+## get the key of a profile
+#  @param board The board info, such as 'ath79/generic/tplink_archer-c7-v2'.
+#  @param version The firmware version, such as '22.03.5'.
+def get_profile_key(board, version):
+    return "{0}@{1}".format(board, version)
+
+## HwProfileStore Class
+#
+#  The hardware capabilities, such as the swconfig/DSA, the VLAN features of the switch chip and the number of WiFi radios,
+#  never change for a given board and firmware. The store keeps them in local JSON files,
+#  so the devices of the same board and firmware will not be probed again.
+#  The profiles loaded are also kept in memory, see preload().
+class HwProfileStore():
+    def __init__(self, path=None):
+        if not path:
+            path = get_cache_dir('profiles')
+        self.path = path
+        # {key: profile}
+        self._cache = {}
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    def _get_filename(self, key):
+        return os.path.join(self.path, re.sub(r'[^A-Za-z0-9._@-]', '_', key) + ".json")
+
+    ## load a profile
+    #  @param key The profile key, see get_profile_key().
+    #  @return a dict of the capabilities, or None if not found.
+    def load(self, key):
+        if key in self._cache:
+            return dict(self._cache[key])
+        filename = self._get_filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, "r") as fp:
+                profile = json.load(fp)
+        except (OSError, ValueError) as e:
+            L.warning("ignore the broken profile '{0}': {1}".format(filename, e))
+            return None
+        if not isinstance(profile, dict):
+            return None
+        self._cache[key] = profile
+        return dict(profile)
+
+    ## load a profile into the memory, such as on the host while the device is busy
+    #  @param key The profile key, see get_profile_key().
+    #  @return True if the profile is found.
+    def preload(self, key):
+        return self.load(key) is not None
+
+    ## save a profile
+    #  @param key The profile key, see get_profile_key().
+    #  @param profile The dict of the capabilities.
+    def save(self, key, profile):
+        filename = self._get_filename(key)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fn_tmp = filename + ".tmp"
+            with open(fn_tmp, "w") as fp:
+                json.dump(profile, fp, indent=2, sort_keys=True)
+            os.replace(fn_tmp, filename)
+        except OSError as e:
+            L.error("unable to save the profile '{0}': {1}".format(filename, e))
+            return False
+        self._cache[key] = dict(profile)
+        return True
+
+    ## remove a profile, used when the profile is out of date
+    #  @param key The profile key, see get_profile_key().
+    def remove(self, key):
+        self._cache.pop(key, None)
+        filename = self._get_filename(key)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+if __name__ == '__main__':
+    import unittest
+    import tempfile
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            self.tmpdir = tempfile.TemporaryDirectory()
+        def tearDown(self):
+            self.tmpdir.cleanup()
+
+        def test_profile_key(self):
+            self.assertEqual(get_profile_key("ath79/generic/tplink_archer-c7-v2", "22.03.5"), "ath79/generic/tplink_archer-c7-v2@22.03.5")
+
+        def test_cache_dir(self):
+            os.environ['XDG_CACHE_HOME'] = self.tmpdir.name
+            self.assertEqual(get_cache_dir('profiles'), os.path.join(self.tmpdir.name, 'agilenet', 'profiles'))
+
+        def test_load_save(self):
+            store = HwProfileStore(os.path.join(self.tmpdir.name, 'profiles'))
+            key = get_profile_key("ath79/generic/tplink_archer-c7-v2", "22.03.5")
+            self.assertEqual(store.load(key), None)
+            profile = { 'swconfig': ['switch0', 'mdio-bus.0'], 'is_dsa': False, 'num_wifi': 2, 'support_vid': True, 'support_vlan4k': False }
+            self.assertEqual(store.save(key, profile), True)
+            self.assertEqual(store.load(key), profile)
+            # the key with '/' is stored in a single file
+            self.assertEqual(os.listdir(store.path), ["ath79_generic_tplink_archer-c7-v2@22.03.5.json"])
+            store.remove(key)
+            self.assertEqual(store.load(key), None)
+
+        def test_preload(self):
+            store = HwProfileStore(self.tmpdir.name)
+            profile = { 'swconfig': [], 'is_dsa': True, 'num_wifi': 1, 'support_vid': False, 'support_vlan4k': False }
+            self.assertEqual(store.preload("x@1"), False)
+            HwProfileStore(self.tmpdir.name).save("x@1", profile)
+            self.assertEqual(store.preload("x@1"), True)
+            # loaded from the memory
+            os.remove(store._get_filename("x@1"))
+            self.assertEqual(store.load("x@1"), profile)
+
+        def test_load_broken(self):
+            store = HwProfileStore(self.tmpdir.name)
+            with open(store._get_filename("x@1"), "w") as fp:
+                fp.write("{ broken")
+            self.assertEqual(store.load("x@1"), None)
+
+    unittest.main()
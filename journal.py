@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the journal of the setup steps done on a device, to resume an interrupted run
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import os
+import re
+import json
+import hashlib
+import logging as L
+
+from hwprofile import get_cache_dir
+
+## get the digest of the inputs of a step
+#  @param inputs The inputs, any of the JSON types; the sets are sorted.
+def get_digest(inputs):
+    def default(obj):
+        if isinstance(obj, (set, frozenset)):
+            return sorted(obj, key=str)
+        return str(obj)
+    data = json.dumps(inputs, sort_keys=True, default=default)
+    return hashlib.sha256(data.encode('UTF-8')).hexdigest()[:16]
+
+## Journal Class
+#
+#  The steps done on a device, in the order they were done, with the digests of their inputs.
+#  When resuming, a step is skipped if it and all of the steps before it were done with the same inputs;
+#  once a step runs, all of the later steps run too, since they were done on the device state it changes.
+#  The journal is kept in a local JSON file for each device, the journal without a key lives in memory only.
+class Journal():
+    def __init__(self, key=None, path=None):
+        if not path:
+            path = get_cache_dir('journal')
+        self.key = key
+        self.path = path
+        # [[step name, digest], ...]
+        self.entries = []
+        # skip the steps done in the last run
+        self.resume = False
+        self._pos = 0
+        self._skipped = 0
+        if key:
+            self.load()
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    def _get_filename(self):
+        return os.path.join(self.path, re.sub(r'[^A-Za-z0-9._@-]', '_', self.key) + ".json")
+
+    ## load the journal of the device
+    def load(self):
+        filename = self._get_filename()
+        if not os.path.exists(filename):
+            return False
+        try:
+            with open(filename, "r") as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError) as e:
+            L.warning("ignore the broken journal '{0}': {1}".format(filename, e))
+            return False
+        if not isinstance(entries, list):
+            return False
+        self.entries = entries
+        return True
+
+    ## save the journal of the device
+    def save(self):
+        if not self.key:
+            return True
+        filename = self._get_filename()
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fn_tmp = filename + ".tmp"
+            with open(fn_tmp, "w") as fp:
+                json.dump(self.entries, fp, indent=2)
+            os.replace(fn_tmp, filename)
+        except OSError as e:
+            L.error("unable to save the journal '{0}': {1}".format(filename, e))
+            return False
+        return True
+
+    ## remove the journal, such as after the run is finished
+    def clear(self):
+        self.entries = []
+        self._pos = 0
+        if self.key and os.path.exists(self._get_filename()):
+            try:
+                os.remove(self._get_filename())
+            except OSError as e:
+                L.error("unable to remove the journal '{0}': {1}".format(self._get_filename(), e))
+                return False
+        return True
+
+    ## run a step, or skip it if it was done with the same inputs
+    #  @param name The name of the step, such as 'set_layout'.
+    #  @param inputs The inputs of the step, see get_digest().
+    #  @param func The function of the step, it's called without arguments; a false value means failure, except None.
+    #  @return True if skipped; otherwise the return value of func.
+    def run(self, name, inputs, func):
+        entry = [name, get_digest(inputs)]
+        if self.resume and self._pos < len(self.entries) and self.entries[self._pos] == entry:
+            L.info("resume: skip the step '{0}', it was done".format(name))
+            self._pos += 1
+            self._skipped += 1
+            return True
+        # the device state of the later steps is changed
+        if self._pos < len(self.entries):
+            del self.entries[self._pos:]
+            self.save()
+        ret = func()
+        if ret or ret is None:
+            self.entries.append(entry)
+            self._pos += 1
+            self.save()
+        return ret
+
+    ## get the number of the steps skipped
+    def get_skipped(self):
+        return self._skipped
+
+if __name__ == '__main__':
+    import unittest
+    import tempfile
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_get_digest(self):
+            self.assertEqual(get_digest({ 'a': 1, 'b': {2, 1} }), get_digest({ 'b': {1, 2}, 'a': 1 }))
+            self.assertNotEqual(get_digest({ 'a': 1 }), get_digest({ 'a': 2 }))
+
+        def test_resume(self):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                calls = []
+                def step(name, ok=True):
+                    def func():
+                        calls.append(name)
+                        return ok
+                    return func
+                packages = [ 'luci-ssl', 'uhttpd', 'ip-full', 'gawk' ]
+                def run_all(journal, fail=None, port_map={ 'WAN': 1 }):
+                    if not journal.run('reset_config', port_map, step('reset_config')):
+                        return False
+                    for pkg in packages:
+                        if not journal.run('opkg install', pkg, step(pkg, pkg != fail)):
+                            return False
+                    return journal.run('set_layout', { 'layout': 1 }, step('set_layout'))
+
+                # fail at the 3rd package
+                self.assertEqual(run_all(Journal('ap1', tmpdir), fail='ip-full'), False)
+                self.assertEqual(calls, [ 'reset_config', 'luci-ssl', 'uhttpd', 'ip-full' ])
+                # resume from the failed one
+                calls.clear()
+                journal = Journal('ap1', tmpdir)
+                journal.resume = True
+                self.assertEqual(run_all(journal), True)
+                self.assertEqual(calls, [ 'ip-full', 'gawk', 'set_layout' ])
+                self.assertEqual(journal.get_skipped(), 3)
+                # the inputs of the first step changed, run all
+                calls.clear()
+                journal = Journal('ap1', tmpdir)
+                journal.resume = True
+                self.assertEqual(run_all(journal, port_map={ 'WAN': 2 }), True)
+                self.assertEqual(calls, [ 'reset_config' ] + packages + [ 'set_layout' ])
+                # not resuming, run all
+                calls.clear()
+                self.assertEqual(run_all(Journal('ap1', tmpdir)), True)
+                self.assertEqual(len(calls), 6)
+                journal = Journal('ap1', tmpdir)
+                self.assertEqual(len(journal.entries), 6)
+                self.assertEqual(journal.clear(), True)
+                self.assertEqual(Journal('ap1', tmpdir).entries, [])
+
+    unittest.main()
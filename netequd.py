@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the service of the network equipments, it keeps the device sessions open and runs the jobs
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import os
+import re
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+import concurrent.futures
+
+import pexpect
+
+import logging
+import mylog
+L = mylog.setup_custom_logger('switch')
+L.setLevel(logging.INFO)
+
+from switchdevice import pexpect_clean_buffer
+from setnetequ import load_config, factory_config_device, start_session, end_session, _setup_network_equipment
+
+# the jobs of the devices
+JOB_NAMES = [ 'info', 'reset', 'layout', 'cmd' ]
+
+## open the session of a device
+#  @param configs The config of the device, see load_config().
+#  @return the ConfigDevice of the device
+def open_device(configs):
+    rt1 = factory_config_device(configs)
+    if not rt1.device.pexp:
+        raise pexpect.EOF("unable to connect to the device")
+    start_session(rt1)
+    return rt1
+
+## close the session of a device
+def close_device(rt1):
+    end_session(rt1)
+    rt1.device.pexp.close()
+
+## run a shell/CLI command on the device
+#  @return (rc, the output); rc is None if the driver doesn't report the exit status
+def run_device_command(device, cmd, timeout=60):
+    if hasattr(device, 'run'):
+        rc, out = device.run(cmd, timeout=timeout)
+        return (rc, out.decode('UTF-8', errors='replace'))
+    if hasattr(device, '_enter_enable'):
+        # leave the config mode or the prompt left by the last job
+        device._enter_enable()
+    # the stale prompts of _enter_enable() are not the end of the output
+    pexpect_clean_buffer(device.pexp)
+    device.pexp.sendline(cmd)
+    if device.expect([re.escape(cmd), pexpect.TIMEOUT], timeout=timeout) != 0:
+        return (None, device.pexp.before.decode('UTF-8', errors='replace'))
+    device.expect([device.console_prompt, pexpect.TIMEOUT], timeout=timeout)
+    return (None, device.pexp.before.decode('UTF-8', errors='replace').strip('\r\n') + "\n")
+
+## DeviceWorker Class
+#
+#  The warm session of a device and the queue of its jobs. The jobs run one by one in the worker thread of the device;
+#  the session is opened by the first job, and reopened if a job lost the connection.
+class DeviceWorker():
+    def __init__(self, name, configs, opener=open_device, closer=close_device):
+        self.name = name
+        self.configs = configs
+        self.opener = opener
+        self.closer = closer
+        self.rt1 = None
+        self.jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="device-" + name, daemon=True)
+        self._thread.start()
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## add a job to the queue
+    #  @param job The dict of the job, such as {'job': 'cmd', 'command': 'uptime'}.
+    #  @return a Future of the result dict
+    def submit(self, job):
+        future = concurrent.futures.Future()
+        self.jobs.put((job, future))
+        return future
+
+    ## stop the worker and close the session
+    def stop(self):
+        self.jobs.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                break
+            job, future = item
+            tm_start = time.monotonic()
+            try:
+                result = self._run_job(job)
+            except (pexpect.EOF, pexpect.TIMEOUT, OSError) as e:
+                # the session will be reopened by the next job
+                L.error("device '{0}': {1}".format(self.name, e))
+                self._close()
+                result = { 'ok': False, 'error': str(e) }
+            except Exception as e:
+                L.exception("device '{0}': job failed".format(self.name))
+                result = { 'ok': False, 'error': str(e) }
+            result['seconds'] = time.monotonic() - tm_start
+            future.set_result(result)
+        self._close()
+
+    def _close(self):
+        if self.rt1:
+            try:
+                self.closer(self.rt1)
+            except Exception as e:
+                L.warning("device '{0}': close: {1}".format(self.name, e))
+            self.rt1 = None
+
+    def _run_job(self, job):
+        name = job.get('job')
+        if name == 'close':
+            self._close()
+            return { 'ok': True }
+        if not name in JOB_NAMES:
+            return { 'ok': False, 'error': "unknown job '{0}'".format(name) }
+        if not self.rt1:
+            L.info("device '{0}': open the session".format(self.name))
+            self.rt1 = self.opener(self.configs)
+        if name == 'info':
+            return { 'ok': bool(self.rt1.show_info()) }
+        if name == 'cmd':
+            rc, out = run_device_command(self.rt1.device, job['command'], timeout=job.get('timeout', 60))
+            return { 'ok': rc in (None, 0), 'rc': rc, 'output': out }
+        # reset or layout changes the device
+        try:
+            ret = _setup_network_equipment(self.rt1, self.configs, reset=not job.get('noreset', False), command=name, force=job.get('force', False))
+        finally:
+            self.rt1.device.invalidate_facts()
+        return { 'ok': bool(ret) }
+
+## JobServer Class
+#
+#  The local Unix socket server of the jobs. Each request and response is a JSON object in a line:
+#  the request {"device": "<name>", "job": "info|reset|layout|cmd|close", "command": "...", "noreset": false, "force": false},
+#  or {"job": "list"} for the device names.
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, workers):
+        self.workers = workers
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, JobHandler)
+        os.chmod(path, 0o600)
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                self._reply({ 'ok': False, 'error': "bad request: {0}".format(e) })
+                continue
+            if job.get('job') == 'list':
+                self._reply({ 'ok': True, 'devices': sorted(self.server.workers.keys()) })
+                continue
+            worker = self.server.workers.get(job.get('device'))
+            if not worker:
+                self._reply({ 'ok': False, 'error': "unknown device '{0}'".format(job.get('device')) })
+                continue
+            self._reply(worker.submit(job).result())
+
+    def _reply(self, result):
+        self.wfile.write((json.dumps(result) + "\n").encode('UTF-8'))
+        self.wfile.flush()
+
+## send a job to the service and wait for the result
+#  @param path The path of the Unix socket.
+#  @param job The dict of the job.
+def send_job(path, job):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall((json.dumps(job) + "\n").encode('UTF-8'))
+        with sock.makefile('rb') as fp:
+            return json.loads(fp.readline())
+
+# the default path of the socket
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'netequd.sock')
+
+def main():
+    parser = argparse.ArgumentParser(description='The service of the network equipments.')
+    parser.add_argument('-S', '--socket', default=DEFAULT_SOCKET, help='The path of the Unix socket')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    parser_serve = subparsers.add_parser('serve', help='Run the service')
+    parser_serve.add_argument('-j', '--json', action='append', required=True, help='The JSON config file of a device, the device name is the "name" in the config or the file name')
+    parser_serve.add_argument('-o', '--outputfile', type=str, dest='fnout', default="/dev/stderr", help='the file save the setup contents')
+    parser_serve.add_argument('-d', '--debug', action='store_true', default=False, help='show debug messages')
+    parser_send = subparsers.add_parser('send', help='Send a job to the service')
+    parser_send.add_argument('device', help='The device name, or "list"')
+    parser_send.add_argument('job', nargs='?', default='info', help='The job: ' + ", ".join(JOB_NAMES + ['close']))
+    parser_send.add_argument('command', nargs='*', help='The command line of the job "cmd"')
+    parser_send.add_argument('-s', '--noreset', action='store_true', default=False, help='do not reset the device before the layout')
+    parser_send.add_argument('-f', '--force', action='store_true', default=False, help='apply the config even if the device has the fingerprint of the same config')
+    args = parser.parse_args()
+
+    if args.action == 'send':
+        if args.device == 'list':
+            job = { 'job': 'list' }
+        else:
+            job = { 'device': args.device, 'job': args.job, 'command': " ".join(args.command), 'noreset': args.noreset, 'force': args.force }
+        result = send_job(args.socket, job)
+        if 'output' in result:
+            sys.stdout.write(result.pop('output'))
+        print(json.dumps(result))
+        return 0 if result.get('ok') else 1
+
+    if args.debug:
+        L.setLevel(logging.DEBUG)
+    workers = {}
+    for fn_json in args.json:
+        conf = load_config(fn_json, content_file=args.fnout)
+        name = conf['name'] if 'name' in conf else os.path.splitext(os.path.basename(fn_json))[0]
+        workers[name] = DeviceWorker(name, conf)
+    server = JobServer(args.socket, workers)
+    L.info("serve {0} devices at '{1}'".format(len(workers), args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        for i in workers.values():
+            i.stop()
+    return 0
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main())
+
+    import unittest
+    import unittest.mock
+    import tempfile
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_service(self):
+            class FakeDevice():
+                def run(self, cmd, timeout=-1):
+                    return (0, "{0}\n".format(cmd).encode())
+                def invalidate_facts(self):
+                    pass
+            class FakeConfigDevice():
+                def __init__(self):
+                    self.device = FakeDevice()
+                def show_info(self):
+                    return True
+            opened = []
+            def opener(configs):
+                if configs['name'] == 'sw-dead':
+                    raise pexpect.EOF("no response")
+                opened.append(configs['name'])
+                return FakeConfigDevice()
+            workers = {
+                'ap1': DeviceWorker('ap1', { 'name': 'ap1' }, opener=opener, closer=lambda rt1: None),
+                'sw-dead': DeviceWorker('sw-dead', { 'name': 'sw-dead' }, opener=opener, closer=lambda rt1: None),
+                }
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'netequd.sock')
+                server = JobServer(path, workers)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                try:
+                    self.assertEqual(send_job(path, { 'job': 'list' })['devices'], ['ap1', 'sw-dead'])
+                    self.assertEqual(send_job(path, { 'device': 'ap1', 'job': 'info' })['ok'], True)
+                    result = send_job(path, { 'device': 'ap1', 'job': 'cmd', 'command': 'uptime' })
+                    self.assertEqual((result['ok'], result['rc'], result['output']), (True, 0, "uptime\n"))
+                    # the session is kept open between the jobs
+                    self.assertEqual(opened, ['ap1'])
+                    self.assertEqual(send_job(path, { 'device': 'sw-dead', 'job': 'info' }), { 'ok': False, 'error': 'no response', 'seconds': unittest.mock.ANY })
+                    self.assertEqual(send_job(path, { 'device': 'nosuch', 'job': 'info' })['ok'], False)
+                    self.assertEqual(send_job(path, { 'device': 'ap1', 'job': 'format' })['ok'], False)
+                    self.assertEqual(send_job(path, { 'device': 'ap1', 'job': 'close' })['ok'], True)
+                    send_job(path, { 'device': 'ap1', 'job': 'info' })
+                    self.assertEqual(opened, ['ap1', 'ap1'])
+                finally:
+                    server.shutdown()
+                    server.server_close()
+                    for i in workers.values():
+                        i.stop()
+
+        def test_run_device_command(self):
+            import pexpect.spawnbase
+            from switchdevice import Switch
+            # replay the output of the console
+            class ReplaySpawn(pexpect.spawnbase.SpawnBase):
+                def __init__(self, data):
+                    super().__init__(timeout=1)
+                    self.data = data
+                def read_nonblocking(self, size=1, timeout=-1):
+                    if not self.data:
+                        raise pexpect.EOF("end of the replay")
+                    ret, self.data = self.data[:size], self.data[size:]
+                    return ret
+                def send(self, s):
+                    return len(s)
+                def sendline(self, s=''):
+                    return self.send(s + '\n')
+                def discard_pending(self):
+                    return 0
+            class MySwitch(Switch):
+                def _enter_enable(self):
+                    self.entered = True
+            sw = MySwitch()
+            # the stale prompts of _enter_enable() arrive after the buffer is cleared
+            sw.pexp = ReplaySpawn(b"\r\r\nSwitch#\r\r\nSwitch#show clock\r\r\n*10:01:02.003 UTC Mon Mar 1 2021\r\nSwitch#")
+            self.assertEqual(run_device_command(sw, 'show clock'), (None, "*10:01:02.003 UTC Mon Mar 1 2021\n"))
+            self.assertEqual(sw.entered, True)
+
+    unittest.main()
@@ -15,13 +15,19 @@ import sys
 import random
 import logging as L
 import time
+import functools
 
 import re
+import gzip
+import base64
+import hashlib
 import pexpect
 
-from switchdevice import Switch, port_vlan_to_lists, pexpect_clean_buffer
+from switchdevice import Switch, port_vlan_to_lists, pexpect_clean_buffer, cached_fact, parse_config_fingerprint, FINGERPRINT_PREFIX
 from parseclock import parse_clock_openwrt
 from configutil import get_network_addr, interfaces_has_subnet_ips
+from hwprofile import HwProfileStore, get_profile_key
+from retrypolicy import RetryPolicy, RETRY_DONE, RETRY_AGAIN, RETRY_FAIL
 
 try:
     FileNotFoundError # python 3
@@ -154,6 +160,108 @@ def parse_swconfig_support_vlan4k_line(str_line):
         return True
     return False
 
+## parse the output of OpenwrtSwitch.run()
+#  @param before The bytes before the closing frame, which includes the echo of the command line.
+#  @param after The bytes of the closing frame, such as b'x1a2b3c4d_E:0'.
+#  @param tag The nonce of the frame.
+#  @return (rc, stdout_bytes)
+def parse_run_output(before, after, tag):
+    rc = None
+    search_item = re.search(tag.encode() + rb'_E:(\d+)', after)
+    if search_item:
+        rc = int(search_item.group(1))
+    marker = tag.encode() + b'_B'
+    idx = before.rfind(marker)
+    if idx < 0:
+        return (rc, before)
+    out = before[idx + len(marker):]
+    if out.startswith(b'\r\n'):
+        out = out[2:]
+    elif out.startswith(b'\n'):
+        out = out[1:]
+    return (rc, out)
+
+# the shell snippet to probe all of the facts of the device in one round trip, see parse_facts()
+CMD_GET_FACTS = 'grep -e DISTRIB_RE -e DISTRIB_TARGET /etc/openwrt_release ; ' \
+    'echo "board_name=$(cat /tmp/sysinfo/board_name)" ; echo "model=$(cat /tmp/sysinfo/model)" ; ' \
+    'echo "hostname=$(uci -q get system.@system[0].hostname)" ; echo "swconfig=$(swconfig list 2>/dev/null)" ; ' \
+    'echo "num_wifi=$(iw dev 2>/dev/null | grep -c phy#)"'
+
+"""# sample:
+DISTRIB_RELEASE='19.07.7'
+DISTRIB_REVISION='r11306-c4a6851c72'
+DISTRIB_TARGET='ath79/generic'
+board_name=tplink,archer-c7-v2
+model=TP-Link Archer C7 v2
+hostname=OpenWrt
+swconfig=Found: switch0 - mdio-bus.0
+num_wifi=2
+"""
+# the facts returned by parse_facts()
+FACT_NAMES = [ 'version', 'target', 'board', 'model', 'hostname', 'swconfig', 'is_dsa', 'num_wifi' ]
+
+## parse the output of CMD_GET_FACTS
+#  @return a dict with keys 'version', 'target', 'board', 'model', 'hostname', 'swconfig', 'is_dsa', 'num_wifi'
+def parse_facts(str_output):
+    search_item = re.search('get_facts_begin[\s\n]+(.*)', str_output, re.S)
+    if search_item:
+        str_output = search_item.group(1)
+    values = {}
+    for ln in str_output.splitlines():
+        items = ln.split('=', 1)
+        if len(items) == 2:
+            values[items[0].strip()] = items[1].strip()
+
+    facts = {}
+    facts['version'] = parse_version(str_output)
+    facts['target'] = parse_target(str_output)
+    facts['board'] = facts['target'] + "/" + values.get('board_name', '').replace(",", "_")
+    facts['model'] = values.get('model', '')
+    facts['hostname'] = values.get('hostname', None)
+    facts['swconfig'] = parse_swconfig_line(values.get('swconfig', ''))
+    facts['is_dsa'] = not facts['swconfig']
+    num_wifi = values.get('num_wifi', '0')
+    facts['num_wifi'] = int(num_wifi) if num_wifi.isdigit() else 0
+    return facts
+
+# the shell snippet to list the configs changed since the last reload_config, the same way as /sbin/reload_config;
+# the exit status is not 0 if there's no snapshot of the configs (/var/run/config.md5)
+CMD_GET_CONFIG_CHANGES = 'mkdir -p /var/run/config.check && for f in /etc/config/*; do uci show ${f##*/} > /var/run/config.check/${f##*/}; done ; ' \
+    '[ -f /var/run/config.md5 ] && md5sum -c /var/run/config.md5 2>/dev/null | grep FAILED | cut -d: -f1'
+CMD_UPDATE_CONFIG_SNAPSHOT = 'md5sum /var/run/config.check/* > /var/run/config.md5 ; rm -rf /var/run/config.check'
+
+# the file of the config fingerprint, see Switch.get_config_fingerprint(); it's removed by firstboot with the configs
+FINGERPRINT_FILE = '/etc/agilenet.fingerprint'
+
+"""# sample:
+/var/run/config.check/firewall
+/var/run/config.check/dhcp
+"""
+## parse the output of CMD_GET_CONFIG_CHANGES
+#  @return a list of the changed config packages, such as ['firewall', 'dhcp']
+def parse_config_changes(str_output):
+    packages = []
+    for ln in str_output.splitlines():
+        ln = ln.strip()
+        if not ln.startswith('/var/run/config.check/'):
+            continue
+        pkg = os.path.basename(ln)
+        if not pkg in packages:
+            packages.append(pkg)
+    return packages
+
+# the services to be reloaded for the changed config packages, the service of the same name is used if not listed
+SERVICES_OF_CONFIG = {
+    'network': [ 'network' ],
+    'wireless': [ 'network' ],
+    'firewall': [ 'firewall' ],
+    'dhcp': [ 'dnsmasq', 'odhcpd' ],
+    'system': [ 'system' ],
+}
+
+# the HW capabilities stored in the profile, see OpenwrtSwitch.get_hw_profile()
+HW_PROFILE_NAMES = [ 'swconfig', 'is_dsa', 'num_wifi', 'support_vid', 'support_vlan4k' ]
+
 ################################################################################
 
 # get the config for the interface ip/mask
@@ -1030,22 +1138,98 @@ EOF
 """
     return cmd_intf
 
+## check the output of the pipelined uci batch chunks, see execute_uci_command_list()
+#  @param str_output The output of all of the chunks.
+#  @param tag The nonce of the chunk markers.
+#  @param num_chunks The number of chunks.
+#  @return a list of (chunk index, exit status, error message) of the failed chunks; the exit status is None if the marker was not found.
+def parse_uci_batch_markers(str_output, tag, num_chunks):
+    failed = []
+    pos = 0
+    for idx in range(0, num_chunks):
+        search_item = re.compile(re.escape(tag) + "_{0}:([0-9]+)".format(idx)).search(str_output, pos)
+        if not search_item:
+            failed.append((idx, None, "marker not found"))
+            continue
+        # the errors of the chunk are printed between the marker of the previous chunk and its own marker
+        str_chunk = str_output[pos:search_item.start()]
+        rc = int(search_item.group(1))
+        errors = re.findall(r'^.*Entry not found.*$', str_chunk, re.M)
+        if rc != 0 or errors:
+            failed.append((idx, rc, "; ".join(i.strip() for i in errors)))
+        pos = search_item.end()
+    return failed
+
 #execute_uci_command_list(pexp, [], cmd_list)
-def execute_uci_command_list(pexp, prompt, cmd_list):
+#  @param pipelined Send all of the chunks back-to-back, each one followed by a numbered marker with its exit status,
+#    and check all of the markers and errors at once after the last one, instead of waiting for the prompt after each chunk.
+#  @param timeout The timeout of the pipelined mode to wait for the last marker, -1 for the default timeout of the connection.
+def execute_uci_command_list(pexp, prompt, cmd_list, pipelined=False, timeout=-1):
     #L.debug(f"try to setup cmd_list={cmd_list}")
-    for i in cmd_list:
-        L.debug("interface cmd=" + i)
-        pexp.sendline("uci batch << EOF\n" + i + "\nEOF\n\n")
-        L.debug("expect: " + str(prompt))
-        ret = pexp.expect(["Entry not found"] + prompt)
-        if (ret == 0):
-            L.error("execute_uci_command_list() command not execed successfully")
+    if pipelined:
+        if not execute_uci_command_list_pipelined(pexp, cmd_list, timeout=timeout):
             return False
+    else:
+        for i in cmd_list:
+            L.debug("interface cmd=" + i)
+            pexp.sendline("uci batch << EOF\n" + i + "\nEOF\n\n")
+            L.debug("expect: " + str(prompt))
+            ret = pexp.expect(["Entry not found"] + prompt)
+            if (ret == 0):
+                L.error("execute_uci_command_list() command not execed successfully")
+                return False
 
     L.debug("uci commit ...")
     pexp.sendline("uci commit")
     return True
 
+def execute_uci_command_list_pipelined(pexp, cmd_list, timeout=-1):
+    if len(cmd_list) < 1:
+        return True
+    tag = "u{0:08x}".format(random.getrandbits(32))
+    for idx, i in enumerate(cmd_list):
+        L.debug("interface cmd[{0}]={1}".format(idx, i))
+        pexp.sendline(getconf_uci_batch_chunk(i, tag, idx))
+    ret = pexp.expect([tag + "_{0}:[0-9]+\r?\n".format(len(cmd_list) - 1), pexpect.TIMEOUT], timeout=timeout)
+    str_output = pexp.before
+    if ret == 0:
+        str_output += pexp.after
+    return check_uci_batch_output(str_output, tag, cmd_list)
+
+## get a uci batch chunk followed by a numbered marker with its exit status, see parse_uci_batch_markers()
+def getconf_uci_batch_chunk(cmd, tag, idx):
+    # the marker is split by the quotes, so the echo of the command line would not match it
+    return "uci batch << EOF\n" + cmd + "\nEOF\n" + 'echo "{0}_""{1}:$?"'.format(tag, idx)
+
+## check the markers in the output of the uci batch chunks, and log the failed chunks
+#  @return True if all of the chunks succeeded
+def check_uci_batch_output(str_output, tag, cmd_list):
+    failed = parse_uci_batch_markers(str_output.decode('UTF-8', errors='replace'), tag, len(cmd_list))
+    for idx, rc, msg in failed:
+        L.error("execute_uci_command_list() chunk {0} failed (rc={1}): {2}".format(idx, rc, msg))
+        L.error("execute_uci_command_list() chunk {0}:\n{1}".format(idx, cmd_list[idx]))
+    return len(failed) == 0
+
+## compress a shell script for the upload, see OpenwrtSwitch.run_script()
+#  @param script The shell script.
+#  @param chunk_size The max size of each chunk of the base64 text.
+#  @return (the md5 of the gzip data, a list of the base64 chunks)
+def encode_script(script, chunk_size=1024):
+    data = gzip.compress(script.encode('UTF-8'), mtime=0)
+    chunks = []
+    lines = []
+    size = 0
+    for ln in base64.encodebytes(data).decode('ascii').splitlines():
+        if lines and size + len(ln) + 1 > chunk_size:
+            chunks.append("\n".join(lines))
+            lines = []
+            size = 0
+        lines.append(ln)
+        size += len(ln) + 1
+    if lines:
+        chunks.append("\n".join(lines))
+    return (hashlib.md5(data).hexdigest(), chunks)
+
 ################################################################################
 ## generate the port list for vlan
 class VlanPortGenerator():
@@ -1116,49 +1300,249 @@ class VlanPortGenerator():
                     str_ports += " {0}".format(self.port_map[self.port_list[i]][0])
         return str_ports.strip()
 
+# the retry policies of the device operations, see retrypolicy.py
+# ping until the Internet is accessible, the time budget is set by _wait_connected()
+RETRY_PING = RetryPolicy('ping', max_attempts=0, base_delay=0.5, max_delay=4, retry_on=(pexpect.TIMEOUT,))
+# opkg update/install, the download errors are retried
+RETRY_OPKG = RetryPolicy('opkg', max_attempts=8, max_elapsed=600, base_delay=1, max_delay=30, retry_on=(pexpect.TIMEOUT,))
+# delete the uci sections, the children are deleted in the next round if their parents were deleted first
+RETRY_UCI_DELETE = RetryPolicy('uci delete', max_attempts=10, base_delay=0.1, max_delay=1, jitter=0)
+
 ################################################################################
 class OpenwrtSwitch(Switch):
     def __init__(self):
         super().__init__()
+        # the local store of the HW capabilities, set to None to always probe the device
+        self.profile_store = HwProfileStore()
+        # send the uci batch chunks back-to-back, see execute_uci_command_list()
+        self.uci_pipelined = False
+        # set if some of the services were failed to reload
+        self._reboot_required = False
+        # turn off the tty echo of the shell during the session, see begin_session()
+        self.echo_off = False
+        self._echo_suppressed = False
+        # upload the generated scripts gzipped and base64 encoded, see run_script()
+        self.compressed_upload = False
+        self.upload_chunk_size = 1024
+
+    ## get the SSH transport of the connection, see sshtransport.py; None for the consoles
+    def _get_transport(self):
+        return getattr(self.pexp, 'transport', None)
+
+    ## run a shell command on the device
+    #  If the device is connected by SSH, the command runs in its own channel, otherwise it runs in the shell, see _run_shell().
+    #  @param cmd The shell command, it may have multiple lines, such as a heredoc.
+    #  @param timeout The timeout in seconds, -1 for the default timeout of the connection.
+    #  @return (rc, stdout_bytes); rc is None if timeout.
+    def run(self, cmd, timeout=-1):
+        if self._get_transport():
+            if timeout == -1:
+                timeout = self.pexp.timeout
+            return self.pexp.exec_command(cmd, timeout=timeout)
+        return self._run_shell(cmd, timeout=timeout)
+
+    ## run() with the learned timeout of the class, the latency is recorded if the command finished in time
+    #  @param name The class of the operation, such as 'show' and 'commit', see Switch.get_timeout().
+    #  @param cmd The shell command.
+    #  @param default The timeout if the device has no history of the class.
+    def _run_timed(self, name, cmd, default=None):
+        tm_start = time.monotonic()
+        rc, out = self.run(cmd, timeout=self.get_timeout(name, default))
+        if rc is not None:
+            self.record_latency(name, time.monotonic() - tm_start)
+        return (rc, out)
+
+    ## run a shell command in the shell of the console
+    #  The output is framed by a per-call nonce, and the exit status is appended to the closing frame,
+    #  so only one expect is needed and there's no need to match the prompt or the error messages.
+    #  @return (rc, stdout_bytes); rc is None if not found the closing frame before timeout.
+    def _run_shell(self, cmd, timeout=-1):
+        tag = "x{0:08x}".format(random.getrandbits(32))
+        # the markers are split by the quotes, so the echo of the command line would not match them
+        self.pexp.sendline('echo "{0}_""B" ; {1}\necho "{0}""_E:$?"'.format(tag, cmd))
+        # the line end, so the exit status is not matched before all of its digits arrive
+        ret = self.expect([tag + r'_E:(\d+)\r?\n', pexpect.TIMEOUT], timeout=timeout)
+        if ret != 0:
+            L.error("run() timeout: {0}".format(cmd))
+            return (None, self.pexp.before)
+        return parse_run_output(self.pexp.before, self.pexp.after, tag)
+
+    ## check if the busybox applets for the compressed upload exist
+    def _support_compressed_upload(self):
+        def probe():
+            rc, out = self.run('which base64 gunzip md5sum')
+            if rc != 0:
+                L.warning("not found base64/gunzip/md5sum, upload the scripts in plain text")
+            return rc == 0
+        return self.get_fact('compressed_upload', probe)
+
+    ## run a generated shell script on the device
+    #  If compressed_upload is set, the script is gzipped and sent base64 encoded in chunks to /tmp,
+    #  then it's verified by md5 and run by 'base64 -d | gunzip | sh' on the device.
+    #  @param script The shell script.
+    #  @param timeout The timeout in seconds of running the script.
+    #  @return (rc, stdout_bytes) of the script, see run()
+    def run_script(self, script, timeout=-1):
+        if self._get_transport():
+            # the script is sent to the stdin of the shell of a new channel
+            if timeout == -1:
+                timeout = self.pexp.timeout
+            return self.pexp.exec_command("sh -s", input=script.encode('UTF-8'), timeout=timeout)
+        if not (self.compressed_upload and self._support_compressed_upload()):
+            return self.run(script, timeout=timeout)
+
+        md5, chunks = encode_script(script, self.upload_chunk_size)
+        file_name = "/tmp/agilenet-{0}.b64".format(md5[:8])
+        L.info("upload the script of {0} bytes in {1} bytes ...".format(len(script), sum(len(i) + 1 for i in chunks)))
+        rc, out = self.run(": > {0}".format(file_name))
+        for i in chunks:
+            if rc != 0:
+                L.error("run_script() unable to upload '{0}': {1}".format(file_name, out))
+                return (rc, out)
+            rc, out = self.run("cat >> {0} << 'EOF'\n{1}\nEOF".format(file_name, i))
+        rc, out = self.run("base64 -d {0} | md5sum".format(file_name))
+        if rc != 0 or not md5.encode() in out:
+            L.error("run_script() the checksum of '{0}' mismatch: {1}".format(file_name, out))
+            self.run("rm -f {0}".format(file_name))
+            return (None, out)
+        ret = self.run("base64 -d {0} | gunzip | sh".format(file_name), timeout=timeout)
+        self.run("rm -f {0}".format(file_name))
+        return ret
+
+    ## send a generated script, see run_script()
+    #  @return True if the script was sent in plain text, or it was run without the error 'Entry not found'
+    def _send_script(self, script):
+        if not self.compressed_upload:
+            self.pexp.sendline(script)
+            return True
+        rc, out = self.run_script(script)
+        if rc != 0 or b'Entry not found' in out:
+            L.error("the script failed (rc={0}): {1}".format(rc, out))
+            return False
+        return True
+
+    ## execute the uci batch chunks, see execute_uci_command_list()
+    def _execute_uci_command_list(self, prompt, cmd_list):
+        if not self.compressed_upload:
+            return execute_uci_command_list(self.pexp, prompt, cmd_list, pipelined=self.uci_pipelined)
+        # all of the chunks are run in one script
+        tag = "u{0:08x}".format(random.getrandbits(32))
+        script = "\n".join(getconf_uci_batch_chunk(i, tag, idx) for idx, i in enumerate(cmd_list))
+        rc, out = self.run_script(script)
+        if not check_uci_batch_output(out, tag, cmd_list):
+            return False
+        L.debug("uci commit ...")
+        self.run("uci commit")
+        return True
+
+    ## change the speed of the tty of the shell
+    def _send_console_speed(self, baud):
+        self.pexp.sendline("stty {0}".format(baud))
+        return True
 
-    # save the current config to disk
+    ## start a session, turn off the tty echo if echo_off is set
+    #  All of the expects should not depend on the echo of the command lines.
+    def begin_session(self):
+        if self.echo_off:
+            self._set_echo(False)
+        return True
+
+    ## end the session, restore the tty echo
+    def end_session(self):
+        if self._echo_suppressed:
+            self._set_echo(True)
+        return True
+
+    def _set_echo(self, enable):
+        rc, out = self._run_shell('stty echo' if enable else 'stty -echo')
+        if rc != 0:
+            L.warning("unable to change the tty echo: {0}".format(out))
+            return False
+        self._echo_suppressed = not enable
+        L.debug("tty echo {0}".format("on" if enable else "off"))
+        return True
+
+    # save the current config to disk, and reload the services of the changed configs
     def save_config(self):
-        self.pexp.sendline("uci commit\r\n")
-        self.pexp.sendline('/etc/init.d/network restart')
-        time.sleep(2)
-        prompt = [ "root@.*:/#" ]
-        ret = self.pexp.expect(["Entry not found"] + prompt)
-        #self.pexp.expect('br-lan: link becomes ready')
-        self.pexp.sendline('/etc/init.d/firewall restart')
-        time.sleep(2)
-        prompt = [ "root@.*:/#" ]
-        ret = self.pexp.expect(["Entry not found"] + prompt)
-        #self.pexp.expect("* Running script '/etc/firewall.user'")
-        self.pexp.sendline('/etc/init.d/dnsmasq restart')
-        time.sleep(2)
-        prompt = [ "root@.*:/#" ]
-        ret = self.pexp.expect(["Entry not found"] + prompt)
-        #self.pexp.expect("udhcpc: lease of")
-        self.pexp.sendline("/etc/init.d/system reload\n")
-        time.sleep(2)
-        prompt = [ "root@.*:/#" ]
-        ret = self.pexp.expect(["Entry not found"] + prompt)
-        if (ret == 0):
-            L.error("save_config() command not execed successfully")
+        rc, out = self._run_timed('commit', "uci commit")
+        if rc != 0:
+            L.error("save_config() uci commit error: {0}".format(out))
+            return False
+
+        action = 'reload'
+        rc, out = self.run(CMD_GET_CONFIG_CHANGES)
+        if rc == 0:
+            packages = parse_config_changes(out.decode('UTF-8'))
+            L.info("save_config() changed configs: {0}".format(packages))
+        else:
+            # no snapshot of the configs to compare with, such as the first save after boot (/var/run is tmpfs),
+            # restart the services of all of the configs
+            L.warning("save_config() unable to get the changed configs, restart the services of all of the configs")
+            rc, out = self.run("ls /etc/config")
+            if rc != 0:
+                L.error("save_config() unable to list the configs: {0}".format(out))
+                self._reboot_required = True
+                return False
+            packages = out.decode('UTF-8').split()
+            action = 'restart'
+        services = []
+        for i in packages:
+            for j in SERVICES_OF_CONFIG.get(i, [i]):
+                if not j in services:
+                    services.append(j)
+        ret_val = True
+        for i in services:
+            if not self._reload_service(i, action=action):
+                ret_val = False
+        # update the snapshot for the next reload_config
+        self.run(CMD_UPDATE_CONFIG_SNAPSHOT)
+        return ret_val
+
+    # reload/restart a service, it returns when the init script finished
+    def _reload_service(self, service, action='reload'):
+        L.info("{0} service '{1}' ...".format(action, service))
+        rc, out = self._run_timed('service', '[ ! -x /etc/init.d/{0} ] || /etc/init.d/{0} {1}'.format(service, action))
+        if rc != 0:
+            L.error("save_config() {0} service '{1}' error (rc={2})".format(action, service, rc))
+            self._reboot_required = True
             return False
         return True
 
+    ## check if the device need to reboot to make the saved config take effect
+    def needs_reboot(self):
+        return self._reboot_required
+
     # reboot system
-    def reboot(self, wait_network=True):
+    #  The console speed raised by upshift_console() is restored before the reboot and raised again after it,
+    #  such as for the reboot of reset_config().
+    #  @param name The class of the operation to learn the timeout, 'firstboot' for the reboot after the factory reset.
+    def reboot(self, wait_network=True, name='reboot'):
+        if self._get_transport():
+            # the boot messages are on the console only, and the SSH connection is closed by the reboot
+            L.error("reboot() is not supported over SSH, use the console or reboot the device by hand")
+            return False
+        # the device boots at the original console speed
+        upshifted = self.console_upshifted
+        if upshifted:
+            self.restore_console(force=True)
+        self._reboot(wait_network, name)
+        if upshifted:
+            self.upshift_console()
+        return True
+
+    def _reboot(self, wait_network, name):
+        self.invalidate_facts()
+        self._reboot_required = False
         L.info("reboot -f ...")
+        tm_start = time.monotonic()
         self.pexp.sendline('sync')
         self.pexp.sendline('reboot -f')
-        self.pexp.expect([ 'reboot: Restarting system', 'U-Boot' ])
+        self.expect([ 'reboot: Restarting system', 'U-Boot' ])
         L.info("reboot starting ...")
-        self.pexp.expect('Please press Enter to activate this console.')
+        self.timed_expect(name, 'Please press Enter to activate this console.', tm_start=tm_start)
         L.info("enter to console ...")
         self.pexp.sendline('\r\n\r\n')
-        self.pexp.expect('built-in shell')
+        self.expect('built-in shell')
         L.info("got a shell")
         if wait_network:
             L.info("waiting for network link ready ...")
@@ -1170,30 +1554,29 @@ class OpenwrtSwitch(Switch):
                 pexpect.EOF,
                 pexpect.TIMEOUT
                 ]
-            self.pexp.expect(responses, timeout=60)
+            self.timed_expect('link', responses)
             L.info("brought the network interfaces up.")
         time.sleep(2)
+        if self._echo_suppressed:
+            # the new shell starts with echo on
+            self._set_echo(False)
 
     def _is_dsa0(self):
         # if grep -sq DEVTYPE=dsa /sys/class/net/*/uevent; then echo "IsDSA"; else echo "NotDSA"; fi
         #self.pexp.sendcontrol('c')
         self.pexp.sendline("\r\n")
         self.pexp.sendline('\nif grep -sq DEVTYPE=dsa /sys/class/net/*/uevent; then echo "Is""DSA"; else echo "Not""DSA"; fi\r\n')
-        ret = self.pexp.expect(['IsDSA', 'NotDSA'])
+        ret = self.expect(['IsDSA', 'NotDSA'])
         #L.debug(f"is_dsa?ret={ret}")
         return (ret == 0)
 
     def _is_dsa(self):
-        swconf = self.get_swconfig()
-        if swconf:
-            return False
-        return True
+        return self.get_hw_profile()['is_dsa']
 
     # get swconfig config
+    @cached_fact('swconfig')
     def get_swconfig(self):
-        #self.pexp.sendcontrol('c')
-        self.pexp.sendline("\r\n")
-        self.pexp.sendline('\necho -n -e "get_swconfig_""begin\\n" ; swconfig list ; echo "get_swconfig_""end"\r\n')
+        rc, out = self.run('swconfig list')
         # sample output:
 
         # Asus RT-N56U
@@ -1211,43 +1594,69 @@ class OpenwrtSwitch(Switch):
         # Ubiquiti UniFi6 Lite
         # /bin/ash: swconfig: not found
 
-        self.pexp.expect('get_swconfig_begin')
-        self.pexp.expect('get_swconfig_end')
-        ln_before = self.pexp.before.decode('UTF-8')
-        #ln_after = self.pexp.after.decode('UTF-8')
-        L.debug("get_swconfig ln_before=" + str(ln_before))
-        #L.debug("get_swconfig ln_after=" + str(ln_after))
+        ln_before = out.decode('UTF-8')
+        L.debug("get_swconfig rc={0} ln_before={1}".format(rc, ln_before))
+        if rc != 0:
+            return None
         return parse_swconfig_line(ln_before)
 
     ## detect if HW support vid
     def swconfig_support_vid(self):
-        # swconfig dev switch0 help | grep -A 3 -- '--vlan'
-        #self.pexp.sendcontrol('c')
-        self.pexp.sendline("\r\n")
-        self.pexp.sendline("swconfig dev switch0 help\n")
-        self.pexp.sendline('\necho -n -e "swconfig_support_vid_""begin\\n" ; swconfig dev switch0 help ; echo "swconfig_support_vid_""end"\r\n')
-
-        self.pexp.expect('swconfig_support_vid_begin')
-        self.pexp.expect('swconfig_support_vid_end')
-        ln_before = self.pexp.before.decode('UTF-8')
-        L.debug("swconfig_support_vid ln_before=" + str(ln_before))
-        return parse_swconfig_support_vid_line(ln_before)
+        return self.get_hw_profile()['support_vid']
 
     ## detect if HW support vlan4k
     def swconfig_support_vlan4k(self):
-        # swconfig dev switch0 help | grep -A 3 -- '--vlan'
-        #self.pexp.sendcontrol('c')
-        self.pexp.sendline("\r\n")
-        self.pexp.sendline("swconfig dev switch0 help\n")
-        self.pexp.sendline('\necho -n -e "swconfig_support_vlan4k_""begin\\n" ; swconfig dev switch0 help ; echo "swconfig_support_vlan4k_""end"\r\n')
+        return self.get_hw_profile()['support_vlan4k']
 
-        self.pexp.expect('swconfig_support_vlan4k_begin')
-        self.pexp.expect('swconfig_support_vlan4k_end')
-        ln_before = self.pexp.before.decode('UTF-8')
-        L.debug("swconfig_support_vlan4k ln_before=" + str(ln_before))
-        return parse_swconfig_support_vlan4k_line(ln_before)
+    # get the help of the switch, which lists the features of the switch chip
+    def _get_swconfig_help(self, switch_name):
+        # swconfig dev switch0 help | grep -A 3 -- '--vlan'
+        rc, out = self.run('swconfig dev {0} help'.format(switch_name))
+        ln_before = out.decode('UTF-8')
+        L.debug("swconfig_help rc={0} ln_before={1}".format(rc, ln_before))
+        return ln_before
+
+    ## get the HW capabilities (swconfig/DSA, VLAN features, number of WiFi radios)
+    #  The capabilities are loaded from the local profile store if a device of the same board and firmware was probed before.
+    #  @return a dict with keys 'swconfig', 'is_dsa', 'num_wifi', 'support_vid', 'support_vlan4k'
+    def get_hw_profile(self):
+        return self.get_fact('hw_profile', self._load_hw_profile)
+
+    def _load_hw_profile(self):
+        facts = self.collect_facts()
+        key = get_profile_key(facts['board'], facts['version'])
+        if self.profile_store:
+            profile = self.profile_store.load(key)
+            if profile and all(i in profile for i in HW_PROFILE_NAMES):
+                L.info("use the HW profile of '{0}'".format(key))
+                return profile
+
+        profile = self._probe_hw_profile(facts)
+        if self.profile_store:
+            self.profile_store.save(key, profile)
+        return profile
+
+    def _probe_hw_profile(self, facts):
+        profile = {
+            'swconfig': facts['swconfig'],
+            'is_dsa': facts['is_dsa'],
+            'num_wifi': facts['num_wifi'],
+            'support_vid': False,
+            'support_vlan4k': False,
+            }
+        if facts['swconfig']:
+            str_help = self._get_swconfig_help(facts['swconfig'][0])
+            profile['support_vid'] = parse_swconfig_support_vid_line(str_help)
+            profile['support_vlan4k'] = parse_swconfig_support_vlan4k_line(str_help)
+        L.debug("probe HW profile={0}".format(profile))
+        return profile
 
     def reset_config(self, port_map):
+        if self._get_transport():
+            # firstboot removes the SSH keys and the IP address, the device can't be reached by SSH after the reboot
+            L.error("reset_config() the factory reset is not supported over SSH, use the console")
+            return False
+        self.invalidate_facts()
         ret_val = True
         #self.pexp.sendcontrol('c')
         L.debug("cd /")
@@ -1269,13 +1678,13 @@ class OpenwrtSwitch(Switch):
 
             L.info("firstboot -y ...")
             self.pexp.sendline('firstboot -y')
-            #self.pexp.expect('This will erase all settings and remove any installed packages. Are you sure? [N/y]')
-            self.pexp.expect(['only erasing files', 'will be erased on next mount'])
+            #self.expect('This will erase all settings and remove any installed packages. Are you sure? [N/y]')
+            self.expect(['only erasing files', 'will be erased on next mount'])
 
-            self.reboot()
+            self.reboot(name='firstboot')
 
             self.pexp.sendline('ip a s dev br-lan | grep "inet "')
-            ret = self.pexp.expect(['    inet 192.168.1.1/24 brd 192.168.1.255 scope global br-lan', 'scope global br-lan', "ip: can't find device"])
+            ret = self.expect(['    inet 192.168.1.1/24 brd 192.168.1.255 scope global br-lan', 'scope global br-lan', "ip: can't find device"])
             L.debug(f"ip a return {ret}")
 
         if ret > 0:
@@ -1298,83 +1707,83 @@ class OpenwrtSwitch(Switch):
             L.info("try to reset device by reconfig to default with command line ...")
             ret_val = self.reset_config_sim(prompt, port_map, ifname_gen=ifname_gen)
 
+        self.invalidate_facts()
         L.info("reset_config DONE, ret={0}".format(ret_val))
         return ret_val
 
+    @cached_fact('version')
     def get_version(self):
-        self.pexp.sendline('\necho "get_version_""begin" ; cat /etc/openwrt_release | grep DISTRIB_RE ; echo "get_version_""end"\n')
-        #self.pexp.expect('get_version_begin')
-        self.pexp.expect('get_version_end')
-        ln_before = self.pexp.before.decode('UTF-8')
-        #ln_after = self.pexp.after.decode('UTF-8')
+        rc, out = self.run('grep DISTRIB_RE /etc/openwrt_release')
+        ln_before = out.decode('UTF-8')
         #L.debug("get_version ln_before=" + str(ln_before))
-        #L.debug("get_version ln_after=" + str(ln_after))
         return parse_version(ln_before)
 
     def _get_target(self):
-        self.pexp.sendline('\necho "get_target_""begin" ; cat /etc/openwrt_release | grep DISTRIB_TARGET ; echo "get_target_""end"\n')
-        #self.pexp.expect('get_target_begin')
-        self.pexp.expect('get_target_end')
-        ln_before = self.pexp.before.decode('UTF-8')
-        #ln_after = self.pexp.after.decode('UTF-8')
+        rc, out = self.run('grep DISTRIB_TARGET /etc/openwrt_release')
+        ln_before = out.decode('UTF-8')
         #L.debug("get_target ln_before=" + str(ln_before))
-        #L.debug("get_target ln_after=" + str(ln_after))
         return parse_target(ln_before) # ath79/generic
 
     def _get_board(self):
-        self.pexp.sendline("\r\n")
         # cat /tmp/sysinfo/board_name
         #tplink,archer-c7-v2
         # cat /tmp/sysinfo/model
         #TP-Link Archer C7 v2
-        self.pexp.sendline('\necho -n -e "get_board_""begin" ; cat /tmp/sysinfo/board_name ; echo "get_board_""end"\r\n')
-        self.pexp.expect('get_board_begin')
-        self.pexp.expect('get_board_end')
-        ln_before = self.pexp.before.decode('UTF-8')
-        #ln_after = self.pexp.after.decode('UTF-8')
+        rc, out = self.run('cat /tmp/sysinfo/board_name')
+        ln_before = out.decode('UTF-8')
         #L.debug("get_board_name ln_before=" + str(ln_before))
-        #L.debug("get_board_name ln_after=" + str(ln_after))
         return parse_board_line(ln_before) #tplink,archer-c7-v2
 
+    @cached_fact('board')
     def get_board(self):
         target = self._get_target()
         board = self._get_board()
         return target + "/" + board.replace(",", "_")
 
+    @cached_fact('model')
     def get_model_name(self):
         #L.debug("serial isalive? {0}".format(self.pexp.isalive()))
         assert(self.pexp.isalive())
-        #self.pexp.sendcontrol('c')
-        self.pexp.sendline("\r\n")
         # cat /tmp/sysinfo/model
         #TP-Link Archer C7 v2
-        self.pexp.sendline('\necho -n -e "get_model_""begin" ; cat /tmp/sysinfo/model ; echo "get_model_""end"\r\n')
-        self.pexp.expect('get_model_begin')
-        self.pexp.expect('get_model_end')
-        ln_before = self.pexp.before.decode('UTF-8')
-        #ln_after = self.pexp.after.decode('UTF-8')
+        rc, out = self.run('cat /tmp/sysinfo/model')
+        ln_before = out.decode('UTF-8')
         #L.debug("get_model_name ln_before=" + str(ln_before))
-        #L.debug("get_model_name ln_after=" + str(ln_after))
         return parse_model_line(ln_before)
 
+    @cached_fact('hostname')
     def get_hostname(self):
         # uci -p get system.@system[0].hostname
-        self.pexp.sendline('\necho "get_hostname_""begin" ; uci show system | grep "hostname=" ; echo "get_hostname_""end"\n')
-        #self.pexp.expect('get_hostname_begin')
-        if 0 == self.pexp.expect(['get_hostname_end']):
-            ln_before = self.pexp.before.decode('UTF-8')
-            return parse_hostname(ln_before)
+        rc, out = self.run('uci show system | grep "hostname="')
+        if rc == 0:
+            return parse_hostname(out.decode('UTF-8'))
         return None
 
+    ## get the version, board, model, hostname, swconfig and WiFi info in one round trip
+    #  @return a dict, see parse_facts()
+    def collect_facts(self):
+        return self.get_facts(FACT_NAMES, self._probe_facts)
+
+    def _probe_facts(self):
+        rc, out = self._run_timed('show', CMD_GET_FACTS)
+        ln_before = out.decode('UTF-8')
+        #L.debug("collect_facts ln_before=" + str(ln_before))
+        facts = parse_facts(ln_before)
+        L.debug("collect_facts facts={0}".format(facts))
+        return facts
+
     def set_hostname(self, hostname):
         #self.pexp.sendcontrol('c')
         self.pexp.sendline("\ncd /\n")
 
         L.info("set_hostname({0}) ...".format(hostname))
+        self.invalidate_facts('hostname')
         self.pexp.sendline("uci set system.@system[0].hostname='{0}'".format(hostname))
         self.pexp.sendline("hostname '{0}'".format(hostname))
-        self.pexp.sendline("uci get system.@system[0].hostname")
-        self.pexp.expect(hostname)
+        rc, out = self.run("uci get system.@system[0].hostname")
+        if rc != 0 or out.decode('UTF-8').strip() != hostname:
+            L.error("set_hostname({0}) error: {1}".format(hostname, out))
+            return False
 
         self.pexp.sendline("uci commit system")
         self.pexp.sendline("/etc/init.d/system reload")
@@ -1443,13 +1852,13 @@ set network.@device[-1].name='{0}'
 set network.@device[-1].type='bridge'
 """.format('br-lan')
             prompt = [ "root@OpenWrt:/#", "root@.*:/#" ]
-            execute_uci_command_list(self.pexp, prompt, [ str_conf ])
+            self._execute_uci_command_list(prompt, [ str_conf ])
 
         # restore the 'br_trunk': (or 'br-lan' if the two are equal)
         str_conf = _getconf_trunk_bridge_device(port_map, port_list, self.br_trunk, has_subnet_ips)
         L.debug("_getconf_trunk_bridge_device() return {}".format(str_conf))
         prompt = [ "root@OpenWrt:/#", "root@.*:/#" ]
-        execute_uci_command_list(self.pexp, prompt, [ str_conf ])
+        self._execute_uci_command_list(prompt, [ str_conf ])
 
     # vlan_set: the set of vlan id
     # vlan_list: the vlan id list for each port, -1 -- ignore, 0 -- trunk, 1-1024 -- vlan id
@@ -1477,7 +1886,7 @@ set network.@device[-1].type='bridge'
 
                 switch_name = swconf[0]
                 str_conf = getconf_vlans_swconfig(port_map, port_list, vlan_list, vlan_set, swconf[0], support_vid=support_vid, support_vlan4k=support_vlan4k)
-                self.pexp.sendline(str_conf)
+                self._send_script(str_conf)
 
         elif self._is_dsa():
             # TODO: get the device name 'br-lan'
@@ -1490,7 +1899,7 @@ set network.@device[-1].type='bridge'
             str_conf = getconf_vlan_dsa(port_map, port_list, vlan_list, vlan_set, self.br_trunk, has_subnet_ips=has_subnet_ips)
             #hostname = self.get_hostname(); prompt = [ "root@{0}:/#".format(hostname) ]
             prompt = [ "root@OpenWrt:/#", "root@.*:/#" ]
-            execute_uci_command_list(self.pexp, prompt, [ str_conf ])
+            self._execute_uci_command_list(prompt, [ str_conf ])
         else:
             L.info("system won't support either swconfig or DSA")
 
@@ -1522,17 +1931,11 @@ set network.@device[-1].type='bridge'
 
     def get_clock(self):
         #L.debug("get_clock() ...")
-        #self.pexp.sendline('\necho "get_clock_""begin" ; date -Isecond ; echo "get_clock_""end"\n')
-        self.pexp.sendline('\necho "get_clock_""begin" ; date -R ; echo "get_clock_""end"\n')
-        #self.pexp.expect('get_clock_begin')
-        ret = self.pexp.expect(['get_clock_end'])
-        #L.debug("clock exp ret={0}".format(ret))
-        ln_before = self.pexp.before.decode('UTF-8')
-        #ln_after = self.pexp.after.decode('UTF-8')
-        #L.debug("get_clock ln_before=" + str(ln_before))
-        #L.debug("get_clock ln_after=" + str(ln_after))
-        if 0 == ret:
-            return parse_clock_openwrt(ln_before)
+        #rc, out = self.run('date -Isecond')
+        rc, out = self.run('date -R')
+        #L.debug("clock rc={0}".format(rc))
+        if 0 == rc:
+            return parse_clock_openwrt(out.decode('UTF-8'))
         return None
     root_passwd = None
     def set_root_passwd(self, new_passwd):
@@ -1542,20 +1945,33 @@ set network.@device[-1].type='bridge'
         self.pexp.sendline("\ncd /\n")
 
         self.pexp.sendline('passwd')
-        self.pexp.expect('New password:')
+        self.expect('New password:')
         self.pexp.sendline(new_passwd)
-        self.pexp.expect('Retype password:')
+        self.expect('Retype password:')
         self.pexp.sendline(new_passwd)
-        self.pexp.expect('password for root changed by root')
+        self.expect('password for root changed by root')
         return True
 
+    def get_config_fingerprint(self):
+        rc, out = self.run('cat {0} 2>/dev/null'.format(FINGERPRINT_FILE))
+        if rc != 0 or not out:
+            return None
+        return parse_config_fingerprint(out.decode('UTF-8'))
+
+    def set_config_fingerprint(self, digest):
+        if digest:
+            cmd = 'echo {0}{1} > {2} && sync'.format(FINGERPRINT_PREFIX, digest, FINGERPRINT_FILE)
+        else:
+            cmd = 'rm -f {0}'.format(FINGERPRINT_FILE)
+        rc, out = self.run(cmd)
+        return rc == 0
+
     def _check_setup_wan(self):
         # TODO:
         # check if the wan exist (Unifi 6 Lite has no wan)
         #uci get network.wan
-        self.pexp.sendline('uci get network.wan')
-        ret = self.pexp.expect(['interface', 'uci: Entry not found'])
-        if ret == 0:
+        rc, out = self.run('uci get network.wan')
+        if rc == 0 and b'interface' in out:
             return True
         L.info("Not found 'wan', try to setup the local proto to DHCP")
         # if no, create one on the first LAN?
@@ -1572,31 +1988,25 @@ commit network
 
         hostname = self.get_hostname()
         prompt = [ "root@{0}:/#".format(hostname) ]
-        execute_uci_command_list(self.pexp, prompt, uci_conf_list)
+        self._execute_uci_command_list(prompt, uci_conf_list)
         # self.save_config()
         self.pexp.sendline('/etc/init.d/network restart')
 
     def _wait_connected(self, timeout = 10):
-        from datetime import datetime, timedelta
-
         self._check_setup_wan()
-        delta = timedelta(seconds=timeout)
-        tm_start = datetime.now()
-        while True:
+        url_test = "openwrt.org"
+        expect_list = ['2 packets transmitted, 2 packets received,', '2 packets transmitted, 1 packets received', 'ping: sendto: Permission denied', "ping: bad address '{0}'".format(url_test), 'ping: sendto: Network unreachable', '2 packets transmitted, 0 packets received']
+        def ping():
             L.info("_wait_connected() ping ...")
-            url_test = "openwrt.org"
             self.pexp.sendline('ping -c 2 {0}'.format(url_test))
-            expect_list = ['2 packets transmitted, 2 packets received,', '2 packets transmitted, 1 packets received', 'ping: sendto: Permission denied', "ping: bad address '{0}'".format(url_test), 'ping: sendto: Network unreachable']
-            ret = self.pexp.expect(expect_list)
+            ret = self.expect(expect_list, timeout=20)
             L.debug(f"ping return [{ret}]={expect_list[ret]}")
-            if ret < 2:
-                return True
-            if tm_start + delta <= datetime.now():
-                L.error("can not access Internet")
-                break
-            time.sleep(1)
-
-        return False
+            return ret
+        # the WAN, the DNS and the firewall may not be ready, all of the errors are transient
+        ok, ret = self.retry(RETRY_PING.replace(max_elapsed=timeout), ping, lambda ret: RETRY_DONE if ret < 2 else RETRY_AGAIN)
+        if not ok:
+            L.error("can not access Internet")
+        return ok
 
     def change_to_https(self):
         # redirect to SSL port
@@ -1610,11 +2020,31 @@ commit network
         L.info("restart services")
         self.pexp.sendline('/etc/init.d/uhttpd restart && sleep 3 && ps | grep uhttpd')
         time.sleep(5)
-        self.pexp.expect("/usr/sbin/uhttpd")
+        self.expect("/usr/sbin/uhttpd")
         L.info("done upgrade softwares.")
         return True
 
-    def update_softwares(self, packages=[]):
+    ## run a command and find the messages in the output, like the expect() of the messages
+    #  @param name The class of the operation to learn the timeout, see Switch.get_timeout(); the timeout is fixed if not set.
+    #  @return the index of the message found first in the output, or the number of the messages if none is found
+    def _run_find(self, cmd, messages, timeout=600, name=None):
+        tm_start = time.monotonic()
+        if name:
+            timeout = self.get_timeout(name, timeout)
+        rc, out = self.run(cmd, timeout=timeout)
+        if name and rc is not None:
+            self.record_latency(name, time.monotonic() - tm_start)
+        ret = len(messages)
+        pos_first = -1
+        for idx, msg in enumerate(messages):
+            pos = out.find(msg.encode('UTF-8'))
+            if pos >= 0 and (pos_first < 0 or pos < pos_first):
+                pos_first = pos
+                ret = idx
+        return ret
+
+    ## check the connection and update the package lists
+    def _opkg_update(self):
         #self.pexp.sendcontrol('c')
         self.pexp.sendline("\ncd /\n")
 
@@ -1624,54 +2054,80 @@ commit network
             return False
 
         L.info("opkg update")
-        count = 60
-        while count > 0:
+        expect_list = ['Updated list of available packages in /var/opkg-lists/openwrt_telephony', 'Failed to download the package list from', 'available on filesystem /overlay,', 'Cannot install package']
+        def opkg_update():
+            if self._get_transport():
+                # opkg runs in its own channel of SSH
+                return self._run_find('opkg update', expect_list, name='opkg')
+            pexpect_clean_buffer(self.pexp)
             self.pexp.sendline('opkg update')
-            expect_list = ['Updated list of available packages in /var/opkg-lists/openwrt_telephony', 'Failed to download the package list from', 'available on filesystem /overlay,', 'Cannot install package']
-            ret = self.pexp.expect(expect_list)
-            if ret > 0:
-                L.error("unable to update, no connection? ret={}, msg={}".format(ret, expect_list[ret]))
-                L.debug("read before=" + str(self.pexp.before))
-                L.debug("read after=" + str(self.pexp.after))
-                pexpect_clean_buffer(self.pexp)
-            else:
-                break
-            count -= 1
-            L.debug("count={}".format(count))
-            time.sleep(5)
-        if count < 1:
+            return self.timed_expect('opkg', expect_list)
+        def classify_update(ret):
+            if ret == 0:
+                return RETRY_DONE
+            L.error("unable to update, ret={}, msg={}".format(ret, expect_list[ret] if ret < len(expect_list) else "not found"))
+            # no space on the device or a broken package, it won't be fixed by retrying
+            if ret in (2, 3):
+                return RETRY_FAIL
+            return RETRY_AGAIN
+        ok, ret = self.retry(RETRY_OPKG, opkg_update, classify_update)
+        if not ok:
             L.error("Error in update")
             return False
-        self.pexp.expect('Signature check passed.')
+        if not self._get_transport():
+            self.expect('Signature check passed.')
 
+        return True
+
+    ## install a package, the package lists are updated before
+    def _opkg_install(self, pkg):
+        L.info("opkg install {0} ...".format(pkg))
+
+        expect_list = ['Configuring {0}.'.format(pkg), 'installed in root is up to date.', 'Cannot install package', 'Unknown package', 'Failed to download', 'available on filesystem /overlay,']
+        def opkg_install():
+            if self._get_transport():
+                return self._run_find('opkg install {0}'.format(pkg), expect_list, name='opkg')
+            pexpect_clean_buffer(self.pexp)
+            self.pexp.sendline('opkg install {0}'.format(pkg))
+            return self.timed_expect('opkg', expect_list)
+        def classify_install(ret):
+            if ret < 1:
+                return RETRY_DONE
+            if ret < 3:
+                # the package is skipped
+                L.warning(f"Warning: pkg={pkg}: {expect_list[ret]}")
+                return RETRY_DONE
+            # no such package or no space on the device, it won't be fixed by retrying
+            if ret in (3, 5):
+                L.error("unable to install '{}': {}".format(pkg, expect_list[ret]))
+                return RETRY_FAIL
+            L.error("unable to install '{}', no connection? ret={}".format(pkg, ret))
+            return RETRY_AGAIN
+        ok, ret = self.retry(RETRY_OPKG, opkg_install, classify_install)
+        if not ok:
+            L.error("Error in install package {}".format(pkg))
+            return False
+        return True
+
+    ## install the packages
+    #  The installed packages are recorded in the journal, the run resumed skips them;
+    #  the package lists are updated only if there's a package to install.
+    def update_softwares(self, packages=[]):
+        updated = False
+        def install(pkg):
+            nonlocal updated
+            if not updated:
+                if not self._opkg_update():
+                    return False
+                updated = True
+            return self._opkg_install(pkg)
         #self.pexp.sendline('opkg list_installed > /tmp/opkg-installed.txt')
         #self.pexp.sendline('cat /tmp/opkg-installed.txt | gawk '{print $1}' | xargs -n 1 opkg upgrade')
         for i in packages:
             pkg = i.strip()
-            L.info("opkg install {0} ...".format(pkg))
-
-            count = 60
-            while count > 0:
-                pexpect_clean_buffer(self.pexp)
-                self.pexp.sendline('opkg install {0}'.format(pkg))
-                expect_list = ['Configuring {0}.'.format(pkg), 'installed in root is up to date.', 'Cannot install package', 'Unknown package', 'Failed to download']
-                ret = self.pexp.expect(expect_list)
-                if ret < 1:
-                    break
-                elif ret < 4:
-                    L.warning(f"Warning: pkg={pkg}: {expect_list[ret]}")
-                    break
-                else:
-                    L.error("unable to install '{}', no connection? ret={}, msg={}".format(pkg, ret, expect_list[ret]))
-                    L.debug("read before=" + str(self.pexp.before))
-                    L.debug("read after=" + str(self.pexp.after))
-                count -= 1
-                L.debug("count={}".format(count))
-                time.sleep(5)
-            if count < 1:
-                L.error("Error in install package {}".format(pkg))
+            if not self.journal.run('opkg install', pkg, functools.partial(install, pkg)):
                 return False
-        return self.change_to_https()
+        return self.journal.run('change_to_https', None, self.change_to_https)
 
     # fix mesh driver problem
     # ref: https://cgomesu.com/blog/Mesh-networking-openwrt-batman/#hardware
@@ -1698,9 +2154,9 @@ commit network
         # TODO: the dhcp need to be adjusted before replacing the odhcpd-ipv6only!!
         self.pexp.sendline('mount -o remount,rw /')
         self.pexp.sendline('opkg remove odhcpd-ipv6only && opkg install hnet-full luci-compat')
-        self.pexp.expect(['Configuring hnet-full.', 'Package luci-compat .* installed in root is up to date.'])
+        self.expect(['Configuring hnet-full.', 'Package luci-compat .* installed in root is up to date.'])
         self.pexp.sendline('opkg install ipset ip tcpdump strace')
-        self.pexp.expect(['Configuring ipset.', 'Package strace .* installed in root is up to date.'])
+        self.expect(['Configuring ipset.', 'Package strace .* installed in root is up to date.'])
 
 
     def show_network(self):
@@ -1724,40 +2180,20 @@ head -n -0 /etc/resolv.* /tmp/resolv.*
 
     # uci remove items filtered by filter in section
     def _remove_section_filter(self, section, filter):
-        cmd = "echo 'remove_config_''begin' && uci show " + \
+        cmd = "uci show " + \
             str(section) + " |  awk -F. '{print $2}' | grep = | awk -F= '{print $1}' | grep '" + \
             str(filter) + "' | sort -r | uniq | while read a; do uci delete " + \
             str(section) + ".$a; done"
 
         #L.info("cmd=" + cmd)
-        prompt = [ "root@OpenWrt:/#", "root@.*:/#" ]
-
-        while True:
-            self.pexp.sendline('\n' + cmd + "\n")
-            time.sleep(1)
-            ret = self.pexp.expect('remove_config_begin')
-            #ln_before = self.pexp.before.decode('UTF-8')
-            #ln_after = self.pexp.after.decode('UTF-8')
-            #L.debug("rm sec ln_before=" + str(ln_before))
-            #L.debug("rm sec ln_after=" + str(ln_after))
-            ret = self.pexp.expect(['Entry not found'] + prompt)
-            #ln_before = self.pexp.before.decode('UTF-8')
-            ln_after = self.pexp.after.decode('UTF-8')
-            #L.debug("rm sec 2 ln_before=" + str(ln_before))
-            #L.debug("rm sec 2 ln_after=" + str(ln_after))
-            if not re.search('Entry not found', ln_after):
-                break
-            time.sleep(1)
+        # the deletion of some of the entries may fail if their parents were deleted first, try again
+        ok, ret = self.retry(RETRY_UCI_DELETE, lambda: self.run(cmd), lambda ret: RETRY_AGAIN if b'Entry not found' in ret[1] else RETRY_DONE)
+        return ok
 
     def check_file_exist(self, file_name):
         #L.debug(f"check_file_exist({file_name}) ...")
-        prompt = [ "root@OpenWrt:/#", "root@.*:/#" ]
-        self.pexp.sendline(f'\necho "check_file_exist_""is_begin" ; if [ -f "{file_name}" ]; then echo EXIST; else echo None ; fi ; echo "check_file_exist_""end"\n')
-        ret = self.pexp.expect('check_file_exist_is_')
-        ret = self.pexp.expect([f'begin{file_name}', 'No such file or directory'] + prompt)
-        ln_before = self.pexp.before.decode('UTF-8').strip()
-        #L.debug("check_file_exist ln_before=" + str(ln_before))
-        if "EXIST" in ln_before:
+        rc, out = self.run(f'[ -f "{file_name}" ]')
+        if rc == 0:
             #L.debug(f"file exist: {file_name}")
             return True
         #L.debug(f"file NOT exist: {file_name}")
@@ -1794,7 +2230,7 @@ head -n -0 /etc/resolv.* /tmp/resolv.*
             if swconf:
                 support_vlan4k=self.swconfig_support_vlan4k()
                 cmd_intf = getconf_default_vlan_swconfig(port_map, swconf[0], support_vlan4k=support_vlan4k)
-                self.pexp.sendline(cmd_intf)
+                self._send_script(cmd_intf)
             else:
                 L.warning("not found swconfig! ignore default VLAN")
 
@@ -1806,12 +2242,17 @@ head -n -0 /etc/resolv.* /tmp/resolv.*
 
         cmd_intf = getconf_default_network(cb_vlan_ifname, dev_lan=dev_lan, dev_wan=dev_wan, dns_resolv_file=dns_resolv_file)
         #L.debug("default net cmd=" + cmd_intf)
-        self.pexp.sendline(cmd_intf)
-        #L.debug("expect: " + str(prompt))
-        ret = self.pexp.expect(["Entry not found"] + prompt)
-        if (ret == 0):
-            L.error("reset_config_sim() command not execed successfully")
-            return False
+        if self.compressed_upload:
+            if not self._send_script(cmd_intf):
+                L.error("reset_config_sim() command not execed successfully")
+                return False
+        else:
+            self.pexp.sendline(cmd_intf)
+            #L.debug("expect: " + str(prompt))
+            ret = self.expect(["Entry not found"] + prompt)
+            if (ret == 0):
+                L.error("reset_config_sim() command not execed successfully")
+                return False
         L.info("end of reset_config_sim")
         return True
 
@@ -1823,13 +2264,12 @@ head -n -0 /etc/resolv.* /tmp/resolv.*
             return False
         #self.setup_br_trunk(port_list, vlan_list)
 
-        hostname = self.get_hostname()
+        facts = self.collect_facts()
+        hw_profile = self.get_hw_profile()
+        hostname = facts['hostname']
         prompt = [ "root@{0}:/#".format(hostname) ]
         # prompt = [ "root@{0}:/#".format(hostname), "root@.*:/#" ]
 
-        version = self.get_version()
-        ver = int(version.split(".")[0])
-
         def cb_vlan_ifname1(vlanid):
             return ifname_gen.get_port_list_ifname(vlanid)
         cb_vlan_ifname = None
@@ -1844,21 +2284,7 @@ head -n -0 /etc/resolv.* /tmp/resolv.*
         cmd = """uci show network | awk -F= '{print $1}' | awk -F. '{print $1 "." $2}' | sort | uniq | grep -v switch | grep -v device | grep -v bridge-vlan | grep -v network.loopback | grep -v network.lan | grep -v network.wan | grep -v network.globals | while read a; do uci delete $a; done"""
         self.pexp.sendline(cmd)
 
-        num_wifi = 0
-        self.pexp.sendline('iw dev')
-        iw_exp = ["Interface wlan0", "iw: not found"]
-        ret = self.pexp.expect(iw_exp)
-        if ret == 0:
-            self.pexp.sendline('echo "get_wifi_""begin" ; iw dev ; echo "get_wifi_""end"')
-            self.pexp.expect('get_wifi_end')
-            ln_before = self.pexp.before.decode('UTF-8')
-            #ln_after = self.pexp.after.decode('UTF-8')
-            #L.debug("wifi ln_before=" + str(ln_before))
-            #L.debug("wifi ln_after=" + str(ln_after))
-            num_wifi = get_hw_wifi_number(ln_before)
-        else:
-            L.warning("cant find iw dev {0}: '{1}'".format(ret, iw_exp[ret]))
-
+        num_wifi = hw_profile['num_wifi']
         if num_wifi > 0:
             L.info("WiFi devices detected")
         else:
@@ -1877,18 +2303,17 @@ head -n -0 /etc/resolv.* /tmp/resolv.*
             create_wan = True
             # if not exist wan:
             #     create_wan = True
-        hostname = self.get_hostname()
 
         # TP-Link Archer C7 v2 and TP-Link Archer C6 v2 (US) / A6 v2 (US/TW)
         # the isolated network can't be accassed by WiFi,
         # need to add a forward firewall policy from the network to a null(lan) network to make the WiFi works.
         isolate_to_lan = False
-        if "tplink_archer-c" in self.get_model_name():
+        if "tplink_archer-c" in facts['model']:
             isolate_to_lan = True
 
         #L.debug(f"try to setup ipaddr_lan={ipaddr_lan}; interface_config={interface_config}; cb_vlan_ifname={cb_vlan_ifname}; num_wifi={num_wifi}")
-        cmd_list = getconf_list_interfaces(hostname, ipaddr_lan, interface_config, port_map, cb_vlan_ifname, num_wifi, is_dsa=self._is_dsa(), isolate_to_lan=isolate_to_lan, create_wan=create_wan, has_subnet_ips=has_subnet_ips, default_passwd=self.root_passwd, trunk_bridge_device_name = self.br_trunk)
-        return execute_uci_command_list(self.pexp, prompt, cmd_list)
+        cmd_list = getconf_list_interfaces(hostname, ipaddr_lan, interface_config, port_map, cb_vlan_ifname, num_wifi, is_dsa=hw_profile['is_dsa'], isolate_to_lan=isolate_to_lan, create_wan=create_wan, has_subnet_ips=has_subnet_ips, default_passwd=self.root_passwd, trunk_bridge_device_name = self.br_trunk)
+        return self._execute_uci_command_list(prompt, cmd_list)
 
 
     # add a domain name
@@ -3302,6 +3727,417 @@ get_hostname_end
 """
             self.assertEqual(parse_hostname(input), 'homemain-gns3')
 
+        def test_parse_facts(self):
+            input="""root@OpenWrt:/# echo "get_facts_""begin" ; grep -e DISTRIB_RE -e DISTRIB_TARGET /etc/openwrt_release ; ...
+get_facts_begin\r
+DISTRIB_RELEASE='19.07.7'\r
+DISTRIB_REVISION='r11306-c4a6851c72'\r
+DISTRIB_TARGET='ath79/generic'\r
+board_name=tplink,archer-c7-v2\r
+model=TP-Link Archer C7 v2\r
+hostname=homemain\r
+swconfig=Found: switch0 - mdio-bus.0\r
+num_wifi=2\r
+"""
+            facts = parse_facts(input)
+            self.assertEqual(facts['version'], '19.07.7')
+            self.assertEqual(facts['target'], 'ath79/generic')
+            self.assertEqual(facts['board'], 'ath79/generic/tplink_archer-c7-v2')
+            self.assertEqual(facts['model'], 'TP-Link Archer C7 v2')
+            self.assertEqual(facts['hostname'], 'homemain')
+            self.assertEqual(facts['swconfig'], ['switch0', 'mdio-bus.0'])
+            self.assertEqual(facts['is_dsa'], False)
+            self.assertEqual(facts['num_wifi'], 2)
+
+            # Ubiquiti UniFi6 Lite, DSA and no swconfig
+            input="""get_facts_begin
+DISTRIB_RELEASE='SNAPSHOT'
+DISTRIB_REVISION='r15475-c625c821d1'
+DISTRIB_TARGET='ramips/mt7621'
+board_name=ubnt,unifi-6-lite
+model=Ubiquiti UniFi 6 Lite
+hostname=OpenWrt
+swconfig=
+num_wifi=0
+"""
+            facts = parse_facts(input)
+            self.assertEqual(facts['version'], 'r15475-c625c821d1')
+            self.assertEqual(facts['board'], 'ramips/mt7621/ubnt_unifi-6-lite')
+            self.assertEqual(facts['swconfig'], None)
+            self.assertEqual(facts['is_dsa'], True)
+            self.assertEqual(facts['num_wifi'], 0)
+
+        def test_parse_run_output(self):
+            before = b'echo "x0000beef_""B" ; uci -q get system.@system[0].hostname ; echo "x0000beef""_E:$?"\r\nx0000beef_B\r\nOpenWrt\r\n'
+            self.assertEqual(parse_run_output(before, b'x0000beef_E:0', 'x0000beef'), (0, b'OpenWrt\r\n'))
+            self.assertEqual(parse_run_output(b'x0000beef_B\r\n', b'x0000beef_E:1', 'x0000beef'), (1, b''))
+
+        def test_run(self):
+            class FakePexpect():
+                before = b''
+                after = b''
+                def sendline(self, cmd):
+                    self.cmd = cmd
+                def expect(self, patterns, timeout=-1):
+                    tag = re.search(r'echo "(x[0-9a-f]+)_""B"', self.cmd).group(1)
+                    self.before = (self.cmd + '\r\n' + tag + '_B\r\n/tmp/resolv.conf.auto\r\n').encode()
+                    self.after = (tag + '_E:1').encode()
+                    return 0
+            sw = OpenwrtSwitch()
+            sw.pexp = FakePexpect()
+            self.assertEqual(sw.run('ls /tmp/resolv.conf.auto'), (1, b'/tmp/resolv.conf.auto\r\n'))
+            self.assertEqual(sw.check_file_exist('/tmp/resolv.conf.auto'), False)
+
+        def test_run_slow_console(self):
+            import pexpect.spawnbase
+            # the console output arrives one byte at a time
+            class SlowSpawn(pexpect.spawnbase.SpawnBase):
+                def __init__(self):
+                    super().__init__(timeout=1)
+                    self.data = b''
+                def read_nonblocking(self, size=1, timeout=-1):
+                    if not self.data:
+                        raise pexpect.TIMEOUT("no more output")
+                    ret, self.data = self.data[:1], self.data[1:]
+                    return ret
+                def sendline(self, s=''):
+                    tag = re.search(r'echo "(x[0-9a-f]+)_""B"', s).group(1)
+                    self.data = (tag + '_B\r\nnot found\r\n' + tag + '_E:127\r\nroot@OpenWrt:/# ').encode()
+            sw = OpenwrtSwitch()
+            sw.pexp = SlowSpawn()
+            self.assertEqual(sw.run('nosuch'), (127, b'not found\r\n'))
+            # the rest of the closing frame is not left for the next expect
+            self.assertEqual(sw.pexp.data, b'root@OpenWrt:/# ')
+
+        def test_reset_ssh(self):
+            class FakeWrapper():
+                transport = True
+                def sendline(self, line):
+                    raise AssertionError("sent to the device: {0}".format(line))
+            sw = OpenwrtSwitch()
+            sw.pexp = FakeWrapper()
+            self.assertEqual(sw.reset_config({ 'WAN': 1 }), False)
+            self.assertEqual(sw.reboot(), False)
+
+        def test_reboot_console_speed(self):
+            calls = []
+            class MyOpenwrtSwitch(OpenwrtSwitch):
+                def restore_console(self, force=False):
+                    calls.append(('restore_console', force))
+                    self._console_baud_orig = None
+                    return True
+                def upshift_console(self, baud=0):
+                    calls.append('upshift_console')
+                    return True
+                def _reboot(self, wait_network, name):
+                    calls.append(('reboot', name, self.console_upshifted))
+            sw = MyOpenwrtSwitch()
+            self.assertEqual(sw.reboot(name='firstboot'), True)
+            self.assertEqual(calls, [ ('reboot', 'firstboot', False) ])
+            # the device boots at the original speed
+            calls.clear()
+            sw._console_baud_orig = 9600
+            self.assertEqual(sw.reboot(name='firstboot'), True)
+            self.assertEqual(calls, [ ('restore_console', True), ('reboot', 'firstboot', False), 'upshift_console' ])
+
+        def test_run_ssh(self):
+            class FakeWrapper():
+                timeout = 600
+                transport = True
+                def __init__(self):
+                    self.cmds = []
+                def exec_command(self, cmd, input=None, timeout=None):
+                    self.cmds.append((cmd, input, timeout))
+                    if cmd.startswith('opkg install'):
+                        return (0, b'Installing tcpdump (4.9.3-4) to root...\nConfiguring tcpdump.\n')
+                    return (0, b'OpenWrt\n')
+            sw = OpenwrtSwitch()
+            sw.pexp = FakeWrapper()
+            self.assertEqual(sw.run('uci get system.@system[0].hostname'), (0, b'OpenWrt\n'))
+            self.assertEqual(sw.run_script("uci set system.@system[0].hostname=ap1\nuci commit\n", timeout=30), (0, b'OpenWrt\n'))
+            self.assertEqual(sw.pexp.cmds, [ ('uci get system.@system[0].hostname', None, 600),
+                ('sh -s', b"uci set system.@system[0].hostname=ap1\nuci commit\n", 30) ])
+            self.assertEqual(sw._run_find('opkg install tcpdump', ['Configuring tcpdump.', 'installed in root is up to date.', 'Installing']), 2)
+            self.assertEqual(sw._run_find('opkg install tcpdump', ['Unknown package']), 1)
+
+        def test_config_fingerprint(self):
+            class MyOpenwrtSwitch(OpenwrtSwitch):
+                def __init__(self):
+                    super().__init__()
+                    self.cmds = []
+                    self.content = None
+                def run(self, cmd, timeout=-1):
+                    self.cmds.append(cmd)
+                    if cmd.startswith('cat '):
+                        return (0, self.content) if self.content else (1, b'')
+                    if cmd.startswith('echo '):
+                        self.content = cmd.split()[1].encode() + b'\n'
+                    else:
+                        self.content = None
+                    return (0, b'')
+            sw = MyOpenwrtSwitch()
+            self.assertEqual(sw.get_config_fingerprint(), None)
+            self.assertEqual(sw.set_config_fingerprint('0123456789abcdef'), True)
+            self.assertEqual(sw.cmds[-1], 'echo agilenet-config-0123456789abcdef > /etc/agilenet.fingerprint && sync')
+            self.assertEqual(sw.get_config_fingerprint(), '0123456789abcdef')
+            self.assertEqual(sw.set_config_fingerprint(None), True)
+            self.assertEqual(sw.get_config_fingerprint(), None)
+
+        def test_retry(self):
+            class FakePexpect():
+                def sendline(self, line):
+                    pass
+            class MyOpenwrtSwitch(OpenwrtSwitch):
+                def __init__(self, outputs):
+                    super().__init__()
+                    self.pexp = FakePexpect()
+                    self.outputs = outputs
+                def _get_transport(self):
+                    return True
+                def _wait_connected(self, timeout=10):
+                    return True
+                def run(self, cmd, timeout=-1):
+                    return (0, self.outputs.pop(0))
+            sleeps = (RETRY_UCI_DELETE.sleep, RETRY_OPKG.sleep)
+            RETRY_UCI_DELETE.sleep = RETRY_OPKG.sleep = lambda delay: None
+            try:
+                sw = MyOpenwrtSwitch([b'uci: Entry not found\n', b'uci: Entry not found\n', b''])
+                self.assertEqual(sw._remove_section_filter('network', 'switch_vlan'), True)
+                self.assertEqual(sw.get_retry_stats()['uci delete'], { 'attempts': 3, 'retries': 2, 'failures': 0 })
+                # the download error is retried, no space on the device fails at once
+                sw.outputs = [b'Failed to download the package list from https://downloads.openwrt.org\n',
+                    b'Only have 12kb available on filesystem /overlay, pkg gawk needs 372\n']
+                self.assertEqual(sw.update_softwares(['gawk']), False)
+                self.assertEqual(sw.get_retry_stats()['opkg'], { 'attempts': 2, 'retries': 1, 'failures': 1 })
+                # the install fails at once if the package is unknown or there's no space
+                for out in [ b'Unknown package \'gawk2\'.\nCollected errors:\n * opkg_install_cmd: Cannot install package gawk2.\n',
+                        b'Only have 12kb available on filesystem /overlay, pkg gawk needs 372\nCannot install package gawk.\n' ]:
+                    sw = MyOpenwrtSwitch([b'Updated list of available packages in /var/opkg-lists/openwrt_telephony\n', out])
+                    self.assertEqual(sw.update_softwares(['gawk']), False)
+                    self.assertEqual(sw.get_retry_stats()['opkg'], { 'attempts': 2, 'retries': 0, 'failures': 1 })
+                # the download error of the install is retried
+                sw = MyOpenwrtSwitch([b'Updated list of available packages in /var/opkg-lists/openwrt_telephony\n',
+                    b'Failed to download gawk\n', b'Configuring gawk.\n', b''])
+                self.assertEqual(sw._opkg_update() and sw._opkg_install('gawk'), True)
+                self.assertEqual(sw.get_retry_stats()['opkg'], { 'attempts': 3, 'retries': 1, 'failures': 0 })
+            finally:
+                RETRY_UCI_DELETE.sleep, RETRY_OPKG.sleep = sleeps
+
+        def test_resume_opkg(self):
+            import tempfile
+            from journal import Journal
+            class FakePexpect():
+                def sendline(self, line):
+                    pass
+            class MyOpenwrtSwitch(OpenwrtSwitch):
+                def __init__(self, broken=()):
+                    super().__init__()
+                    self.pexp = FakePexpect()
+                    self.broken = broken
+                    self.cmds = []
+                def _get_transport(self):
+                    return True
+                def _wait_connected(self, timeout=10):
+                    return True
+                def change_to_https(self):
+                    self.cmds.append('https')
+                    return True
+                def run(self, cmd, timeout=-1):
+                    self.cmds.append(cmd)
+                    if cmd == 'opkg update':
+                        return (0, b'Updated list of available packages in /var/opkg-lists/openwrt_telephony\n')
+                    pkg = cmd.split()[-1]
+                    if pkg in self.broken:
+                        return (0, b'Only have 12kb available on filesystem /overlay, pkg ' + pkg.encode() + b' needs 372\n')
+                    return (0, 'Configuring {0}.\n'.format(pkg).encode())
+            packages = [ 'luci-ssl', 'uhttpd', 'ip-full', 'gawk' ]
+            sleeps = []
+            sleep = RETRY_OPKG.sleep
+            RETRY_OPKG.sleep = sleeps.append
+            try:
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    sw = MyOpenwrtSwitch(broken=['ip-full'])
+                    sw.set_journal(Journal('ap1', tmpdir))
+                    self.assertEqual(sw.update_softwares(packages), False)
+                    # resume from the failed package
+                    sw = MyOpenwrtSwitch()
+                    sw.set_journal(Journal('ap1', tmpdir))
+                    sw.journal.resume = True
+                    self.assertEqual(sw.update_softwares(packages), True)
+                    self.assertEqual(sw.cmds, [ 'opkg update', 'opkg install ip-full', 'opkg install gawk', 'https' ])
+                    # all done, the package lists are not updated
+                    sw = MyOpenwrtSwitch()
+                    sw.set_journal(Journal('ap1', tmpdir))
+                    sw.journal.resume = True
+                    self.assertEqual(sw.update_softwares(packages), True)
+                    self.assertEqual(sw.cmds, [])
+            finally:
+                RETRY_OPKG.sleep = sleep
+            # no space on the device is not retried
+            self.assertEqual(sleeps, [])
+
+        def test_parse_uci_batch_markers(self):
+            output = """uci batch << EOF
+set network.office=interface
+EOF
+echo "u00c0ffee_""0:$?"
+uci batch << EOF
+delete network.nosuch
+EOF
+echo "u00c0ffee_""1:$?"
+u00c0ffee_0:0
+uci: Entry not found
+u00c0ffee_1:0
+u00c0ffee_2:1
+"""
+            self.assertEqual(parse_uci_batch_markers(output, "u00c0ffee", 3), [(1, 0, "uci: Entry not found"), (2, 1, "")])
+            self.assertEqual(parse_uci_batch_markers(output, "u00c0ffee", 4)[-1], (3, None, "marker not found"))
+            self.assertEqual(parse_uci_batch_markers(output, "u00c0ffee", 1), [])
+
+        def test_execute_uci_command_list_pipelined(self):
+            class FakePexpect():
+                before = b''
+                after = b''
+                def __init__(self):
+                    self.cmds = []
+                def sendline(self, cmd):
+                    self.cmds.append(cmd)
+                def expect(self, patterns, timeout=-1):
+                    # the device output of all of the chunks, the second one failed
+                    tag = re.search(r'echo "(u[0-9a-f]+)_""', self.cmds[0]).group(1)
+                    self.before = (tag + '_0:0\r\nuci: Entry not found\r\n' + tag + '_1:1\r\n').encode()
+                    self.after = (tag + '_2:0').encode()
+                    return 0
+            pexp = FakePexpect()
+            self.assertEqual(execute_uci_command_list(pexp, [], ["set a.b=c", "delete a.x", "set a.d=e"], pipelined=True), False)
+            # all of the chunks are sent before waiting for the result
+            self.assertEqual(len(pexp.cmds), 3)
+
+        def test_parse_config_changes(self):
+            output = "/var/run/config.check/firewall\r\n/var/run/config.check/dhcp\r\n"
+            self.assertEqual(parse_config_changes(output), ['firewall', 'dhcp'])
+            self.assertEqual(parse_config_changes(""), [])
+
+        def test_save_config(self):
+            class MyOpenwrtSwitch(OpenwrtSwitch):
+                def run(self, cmd, timeout=-1):
+                    self.cmds.append(cmd)
+                    if cmd == CMD_GET_CONFIG_CHANGES:
+                        return (0, b"/var/run/config.check/firewall\r\n/var/run/config.check/dhcp\r\n")
+                    return (0, b"")
+            sw = MyOpenwrtSwitch()
+            sw.cmds = []
+            self.assertEqual(sw.save_config(), True)
+            self.assertEqual([i for i in sw.cmds if "/etc/init.d/" in i], [
+                '[ ! -x /etc/init.d/firewall ] || /etc/init.d/firewall reload',
+                '[ ! -x /etc/init.d/dnsmasq ] || /etc/init.d/dnsmasq reload',
+                '[ ! -x /etc/init.d/odhcpd ] || /etc/init.d/odhcpd reload',
+                ])
+            self.assertEqual(sw.needs_reboot(), False)
+            self.assertEqual(sw.cmds[-1], CMD_UPDATE_CONFIG_SNAPSHOT)
+
+        def test_save_config_no_snapshot(self):
+            class MyOpenwrtSwitch(OpenwrtSwitch):
+                def run(self, cmd, timeout=-1):
+                    self.cmds.append(cmd)
+                    if cmd == CMD_GET_CONFIG_CHANGES:
+                        return (1, b"")
+                    if cmd == "ls /etc/config":
+                        return (0, b"dhcp\r\ndropbear\r\nuhttpd\r\nwireless\r\n")
+                    return (0, b"")
+            sw = MyOpenwrtSwitch()
+            sw.cmds = []
+            self.assertEqual(sw.save_config(), True)
+            self.assertEqual([i for i in sw.cmds if "/etc/init.d/" in i], [
+                '[ ! -x /etc/init.d/dnsmasq ] || /etc/init.d/dnsmasq restart',
+                '[ ! -x /etc/init.d/odhcpd ] || /etc/init.d/odhcpd restart',
+                '[ ! -x /etc/init.d/dropbear ] || /etc/init.d/dropbear restart',
+                '[ ! -x /etc/init.d/uhttpd ] || /etc/init.d/uhttpd restart',
+                '[ ! -x /etc/init.d/network ] || /etc/init.d/network restart',
+                ])
+            # the snapshot is written, the next save reloads the changed configs only
+            self.assertEqual(sw.cmds[-1], CMD_UPDATE_CONFIG_SNAPSHOT)
+
+        def test_echo_session(self):
+            class MyOpenwrtSwitch(OpenwrtSwitch):
+                def _run_shell(self, cmd, timeout=-1):
+                    self.cmds.append(cmd)
+                    return (0, b"")
+            sw = MyOpenwrtSwitch()
+            sw.cmds = []
+            sw.begin_session()
+            sw.end_session()
+            self.assertEqual(sw.cmds, [])
+            sw.echo_off = True
+            sw.begin_session()
+            sw.end_session()
+            self.assertEqual(sw.cmds, ['stty -echo', 'stty echo'])
+
+        def test_encode_script(self):
+            script = getconf_default_network(dev_lan='eth1', dev_wan='eth0')
+            md5, chunks = encode_script(script, chunk_size=128)
+            self.assertTrue(all(len(i) <= 128 for i in chunks))
+            data = base64.b64decode("".join(chunks))
+            self.assertEqual(hashlib.md5(data).hexdigest(), md5)
+            self.assertEqual(gzip.decompress(data).decode('UTF-8'), script)
+
+        def test_run_script(self):
+            # simulate the shell of the device
+            class MyOpenwrtSwitch(OpenwrtSwitch):
+                def run(self, cmd, timeout=-1):
+                    self.cmds.append(cmd)
+                    search_item = re.match(r"cat >> (\S+) << 'EOF'\n(.*)\nEOF$", cmd, re.S)
+                    if search_item:
+                        self.files[search_item.group(1)] += search_item.group(2) + "\n"
+                        return (0, b"")
+                    search_item = re.match(r": > (\S+)$", cmd)
+                    if search_item:
+                        self.files[search_item.group(1)] = ""
+                        return (0, b"")
+                    search_item = re.match(r"base64 -d (\S+) \| md5sum$", cmd)
+                    if search_item:
+                        data = base64.b64decode(self.files[search_item.group(1)])
+                        return (0, (hashlib.md5(data).hexdigest() + "  -\r\n").encode())
+                    search_item = re.match(r"base64 -d (\S+) \| gunzip \| sh$", cmd)
+                    if search_item:
+                        # return the script as the output
+                        return (0, gzip.decompress(base64.b64decode(self.files[search_item.group(1)])))
+                    return (0, b"")
+            sw = MyOpenwrtSwitch()
+            sw.cmds = []
+            sw.files = {}
+            sw.compressed_upload = True
+            sw.upload_chunk_size = 256
+            script = getconf_default_network(dev_lan='eth1', dev_wan='eth0')
+            self.assertEqual(sw.run_script(script), (0, script.encode('UTF-8')))
+            self.assertEqual(sw.cmds[0], 'which base64 gunzip md5sum')
+            self.assertEqual(sw.cmds[-1].startswith('rm -f /tmp/agilenet-'), True)
+            # the upload is smaller than the plain text
+            self.assertLess(sum(len(i) for i in sw.cmds), len(script))
+
+        def test_hw_profile(self):
+            import tempfile
+            class MyOpenwrtSwitch(OpenwrtSwitch):
+                probe_count = 0
+                def collect_facts(self):
+                    return { 'version': '22.03.5', 'board': 'ath79/generic/tplink_archer-c7-v2', 'swconfig': ['switch0', 'mdio-bus.0'], 'is_dsa': False, 'num_wifi': 2 }
+                def _get_swconfig_help(self, switch_name):
+                    self.probe_count += 1
+                    return "--vlan\n\tAttribute 1 (int): vid (VLAN ID (0-4094))\n"
+            with tempfile.TemporaryDirectory() as tmpdir:
+                sw1 = MyOpenwrtSwitch()
+                sw1.profile_store = HwProfileStore(tmpdir)
+                self.assertEqual(sw1.swconfig_support_vid(), True)
+                self.assertEqual(sw1.swconfig_support_vlan4k(), False)
+                self.assertEqual(sw1._is_dsa(), False)
+                self.assertEqual(sw1.probe_count, 1)
+
+                # the second device of the same board and firmware
+                sw2 = MyOpenwrtSwitch()
+                sw2.profile_store = HwProfileStore(tmpdir)
+                self.assertEqual(sw2.get_hw_profile(), sw1.get_hw_profile())
+                self.assertEqual(sw2.probe_count, 0)
+
 
         # example:
         #   swconfig list
@@ -21,11 +21,19 @@ PEXPECT LICENSE
 
 """
 
+import os
+import time
+import collections
 import serial
 from pexpect import spawn
-from pexpect.exceptions import ExceptionPexpect
+from pexpect.exceptions import ExceptionPexpect, TIMEOUT
 
-__all__ = ['SerialSpawn']
+__all__ = ['SerialSpawn', 'SerialDropError']
+
+
+class SerialDropError(ExceptionPexpect):
+    """Raised by send() if the device keeps dropping the input, see
+    SerialSpawn.set_pacing()."""
 
 
 class SerialSpawn(spawn):
@@ -33,6 +41,20 @@ class SerialSpawn(spawn):
     pyserial."""
     ptyproc = { 'flag_eof': None }
 
+    # the write pacing, see send(); 0 to write the whole string at once
+    pace_chunk_size = 0
+    pace_min_chunk = 8
+    pace_max_chunk = 1024
+    # wait for the echo of each chunk before sending the next one
+    pace_wait_echo = False
+    pace_echo_timeout = 1.0
+    # the times to send a chunk again if its echo is broken
+    pace_max_retries = 3
+    # the seconds to wait after each chunk was transmitted, if not waiting for the echo
+    pace_delay = 0.0
+    # the latency timer in ms of the USB serial adapters (FTDI) in the low latency mode
+    low_latency_timer = 1
+
     def __init__(self, ser, args=None, **kwargs):
         """This takes a serial of pyserial as input. Please make sure the serial is open
         before creating SerialSpawn."""
@@ -52,6 +74,103 @@ class SerialSpawn(spawn):
         self.name = '<serial port %s>' % self.ser.port
         self.child_fd = self.ser.fileno()
         self.closed = False
+        self._init_tx_stats()
+
+    def _init_tx_stats(self):
+        self.tx_bytes = 0
+        self.tx_seconds = 0.0
+        self.tx_drops = 0
+        # the seconds from the last send() to the match of each expect
+        self.latencies = collections.deque(maxlen=1000)
+        self._tm_send = None
+
+    def set_low_latency(self, enable=True):
+        """Set the Linux ASYNC_LOW_LATENCY flag of the port, and the
+        latency timer of the FTDI adapters (16 ms by default) in sysfs.
+        The settings not supported, such as on a pty, are skipped.
+        Return the list of the settings applied."""
+        applied = []
+        try:
+            self.ser.set_low_latency_mode(enable)
+            applied.append('ASYNC_LOW_LATENCY')
+        except (ValueError, NotImplementedError, OSError):
+            pass
+        # the symlinks such as /dev/ttyRT1ow are resolved to ttyUSBx
+        name = os.path.basename(os.path.realpath(self.ser.port))
+        fn_timer = '/sys/bus/usb-serial/devices/{0}/latency_timer'.format(name)
+        if os.path.exists(fn_timer):
+            try:
+                with open(fn_timer, 'w') as fp:
+                    fp.write(str(self.low_latency_timer if enable else 16))
+                applied.append('latency_timer')
+            except OSError:
+                pass
+        # read the data as soon as it arrives, in large pieces
+        self.maxread = 4096 if enable else 2000
+        return applied
+
+    def _record_latency(self):
+        if self._tm_send is not None:
+            self.latencies.append(time.monotonic() - self._tm_send)
+            self._tm_send = None
+
+    def expect_list(self, pattern_list, timeout=-1, searchwindowsize=-1, async_=False, **kw):
+        try:
+            ret = super().expect_list(pattern_list, timeout, searchwindowsize, async_, **kw)
+        except Exception:
+            self._tm_send = None
+            raise
+        if not (async_ or kw.get('async')):
+            self._record_latency()
+        return ret
+
+    def expect_loop(self, searcher, timeout=-1, searchwindowsize=-1):
+        try:
+            ret = super().expect_loop(searcher, timeout, searchwindowsize)
+        except Exception:
+            self._tm_send = None
+            raise
+        self._record_latency()
+        return ret
+
+    def get_latency_stats(self):
+        """Return the count, mean, median, 95th percentile and max of the
+        latencies in ms from the last send() to the match of expect()."""
+        if not self.latencies:
+            return { 'count': 0, 'mean': 0, 'p50': 0, 'p95': 0, 'max': 0 }
+        values = sorted(self.latencies)
+        return { 'count': len(values), 'mean': sum(values) * 1000 / len(values),
+            'p50': values[len(values) // 2] * 1000, 'p95': values[min(len(values) - 1, len(values) * 95 // 100)] * 1000,
+            'max': values[-1] * 1000 }
+
+    def set_pacing(self, chunk_size, wait_echo=False, delay=0.0):
+        """Send in chunks of chunk_size bytes. If wait_echo is set, wait for
+        the echo of each chunk. If the echo is broken (the device dropped
+        some of the input), the partial line is killed (Ctrl-U) and the
+        rest of the chunk from the first line not echoed is sent again at
+        the half size; SerialDropError is raised if it's still broken after
+        pace_max_retries times. The chunk size grows again while the echo
+        comes back. The chunk is not checked if its beginning is not
+        echoed, such as a password. Otherwise wait for the chunk to be transmitted and for
+        delay seconds. chunk_size 0 turns off the pacing."""
+        self.pace_chunk_size = chunk_size
+        self.pace_wait_echo = wait_echo
+        self.pace_delay = delay
+
+    def get_tx_stats(self):
+        """Return the counters of send(): the bytes, the seconds, the
+        effective bytes per second, the current chunk size and the number
+        of the chunks not echoed back."""
+        return { 'bytes': self.tx_bytes, 'seconds': self.tx_seconds,
+            'bytes_per_second': (self.tx_bytes / self.tx_seconds) if self.tx_seconds > 0 else 0,
+            'chunk_size': self.pace_chunk_size, 'drops': self.tx_drops }
+
+    def get_baudrate(self):
+        return self.ser.baudrate
+
+    def set_baudrate(self, baud):
+        """Change the baud rate of the open serial port."""
+        self.ser.baudrate = baud
 
     def close(self):
         """Close the serial port.
@@ -75,4 +194,208 @@ class SerialSpawn(spawn):
         self._log(s, 'send')
 
         b = self._encoder.encode(s, final=False)
-        return self.ser.write(b)
+        tm_start = time.monotonic()
+        if self.pace_chunk_size <= 0:
+            ret = self.ser.write(b)
+        else:
+            ret = self._send_paced(b)
+        tm_end = time.monotonic()
+        self.tx_bytes += len(b)
+        self.tx_seconds += tm_end - tm_start
+        self._tm_send = tm_end
+        return ret
+
+    def _send_paced(self, b):
+        pos = 0
+        retries = 0
+        while pos < len(b):
+            chunk = b[pos:pos + self.pace_chunk_size]
+            self.ser.write(chunk)
+            # wait until the chunk is transmitted
+            self.ser.flush()
+            if not self.pace_wait_echo:
+                pos += len(chunk)
+                if self.pace_delay > 0:
+                    time.sleep(self.pace_delay)
+                continue
+            echoed = self._wait_echo(chunk)
+            if echoed is None or echoed == len(chunk):
+                # not echoed, such as a password, it can't be checked
+                pos += len(chunk)
+                retries = 0
+                if echoed is not None:
+                    self.pace_chunk_size = min(self.pace_max_chunk, self.pace_chunk_size + max(1, self.pace_chunk_size // 4))
+                continue
+            self.tx_drops += 1
+            self.pace_chunk_size = max(self.pace_min_chunk, self.pace_chunk_size // 2)
+            retries += 1
+            if retries > self.pace_max_retries:
+                raise SerialDropError('the device dropped the input {0} times: {1!r}'.format(retries, chunk))
+            # kill the partial line, and send the lines not echoed again
+            self.ser.write(b'\x15')
+            self.ser.flush()
+            pos += echoed
+        return len(b)
+
+    @staticmethod
+    def _get_echoed(chunk, received):
+        """Return the bytes of the chunk echoed in order in the received
+        data: the whole chunk, or its lines up to the first one not echoed.
+        The output between the lines, such as the prompts, and the CRs
+        are ignored."""
+        received = received.replace(b'\r', b'')
+        pos = 0
+        echoed = 0
+        for line in chunk.splitlines(True):
+            idx = received.find(line, pos)
+            if idx < 0:
+                break
+            pos = idx + len(line)
+            echoed += len(line)
+        return echoed
+
+    def _wait_echo(self, chunk):
+        """Wait for the echo of the chunk, see _get_echoed(). Return the
+        bytes of the chunk echoed, or None if the beginning of the chunk is
+        not echoed, such as the device doesn't echo a password. The device
+        drops the input when its buffer is full, so the beginning of a
+        chunk is not dropped. The data read is kept in the buffer for the
+        next expect()."""
+        if not chunk.strip():
+            return len(chunk)
+        received = b''
+        tm_end = time.monotonic() + self.pace_echo_timeout
+        while True:
+            remain = tm_end - time.monotonic()
+            if remain <= 0:
+                break
+            try:
+                data = self.read_nonblocking(self.maxread, remain)
+            except TIMEOUT:
+                break
+            # the same as the expect loop does with the new data
+            self._before.write(data)
+            self._buffer.write(data)
+            received += data if isinstance(data, bytes) else data.encode('utf-8', errors='replace')
+            if self._get_echoed(chunk, received) == len(chunk):
+                return len(chunk)
+        if not chunk[:4] in received.replace(b'\r', b''):
+            return None
+        return self._get_echoed(chunk, received)
+
+if __name__ == '__main__':
+    import os
+    import tty
+    import threading
+    import unittest
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            # the pty pair stands in for the serial port, the master is the device side
+            self.fd_master, self.fd_slave = os.openpty()
+            tty.setraw(self.fd_master)
+            self.pexp = SerialSpawn(os.ttyname(self.fd_slave), 115200, timeout=5)
+            tty.setraw(self.pexp.child_fd)
+        def tearDown(self):
+            self.pexp.close()
+            os.close(self.fd_master)
+            os.close(self.fd_slave)
+
+        def _device(self, echo, drop):
+            # a device of the line editor, it echoes the input with a prompt after each line;
+            # the bytes 10 to 20 of the first input are dropped
+            self.lines = []
+            line = b''
+            first = True
+            while self.lines[-1:] != [b'end']:
+                data = os.read(self.fd_master, 4096)
+                if first and drop and len(data) >= 20:
+                    first = False
+                    data = data[:10] + data[20:]
+                output = b''
+                for c in data:
+                    c = bytes([c])
+                    if c == b'\x15':
+                        line = b''
+                        continue
+                    output += c
+                    if c == b'\n':
+                        self.lines.append(line)
+                        line = b''
+                    else:
+                        line += c
+                if echo:
+                    os.write(self.fd_master, output.replace(b'\n', b'\r\nSwitch(config)#'))
+            if not echo:
+                os.write(self.fd_master, b'\r\nSwitch(config)#')
+
+        def test_send(self):
+            self.assertEqual(self.pexp.sendline('show version'), len('show version\n'))
+            self.assertEqual(os.read(self.fd_master, 100), b'show version\n')
+            self.assertEqual(self.pexp.get_tx_stats()['bytes'], len('show version\n'))
+
+        def test_low_latency(self):
+            # not supported by pty
+            self.assertEqual(self.pexp.set_low_latency(True), [])
+            self.assertEqual(self.pexp.maxread, 4096)
+            self.assertEqual(self.pexp.get_latency_stats()['count'], 0)
+            for i in range(5):
+                self.pexp.sendline('show clock')
+                os.read(self.fd_master, 100)
+                os.write(self.fd_master, b'12:00:00 UTC\r\nSwitch#')
+                self.pexp.expect('Switch#')
+            stats = self.pexp.get_latency_stats()
+            self.assertEqual(stats['count'], 5)
+            self.assertTrue(0 < stats['p50'] <= stats['max'])
+
+        def test_get_echoed(self):
+            chunk = b"interface gi0/1\n switchport acce"
+            self.assertEqual(SerialSpawn._get_echoed(chunk, b"interface gi0/1\r\nSwitch(config-if)# switchport acce"), len(chunk))
+            self.assertEqual(SerialSpawn._get_echoed(chunk, b"interface gi0/1\r\nSwitch(config-if)# switchport"), 16)
+            # the dropped bytes in the middle, the last byte echoed is not enough
+            self.assertEqual(SerialSpawn._get_echoed(b"vlan 10\nvlan 20\n", b"vlan 10\r\nvan 20\r\n"), 8)
+
+        def test_send_paced(self):
+            block = "".join("interface gi0/{0}\n switchport access vlan 10\n".format(i) for i in range(1, 9)) + "end"
+            self.pexp.set_pacing(32, wait_echo=True)
+            self.pexp.pace_echo_timeout = 0.2
+            th = threading.Thread(target=self._device, args=(True, True))
+            th.start()
+            self.pexp.sendline(block)
+            th.join()
+            # the lines dropped are sent again
+            self.assertEqual(self.lines, [ i.encode() for i in block.split("\n") ])
+            stats = self.pexp.get_tx_stats()
+            self.assertEqual(stats['drops'], 1)
+            self.assertEqual(stats['bytes'], len(block) + 1)
+            self.assertGreater(stats['bytes_per_second'], 0)
+            # the echo read by send() is kept for expect()
+            self.pexp.expect('end\r\nSwitch\\(config\\)#')
+            self.assertTrue(self.pexp.before.endswith(b'interface gi0/8\r\nSwitch(config)# switchport access vlan 10\r\nSwitch(config)#'))
+
+        def test_send_paced_no_echo(self):
+            block = "secret\nend"
+            self.pexp.set_pacing(4, wait_echo=True)
+            self.pexp.pace_echo_timeout = 0.1
+            th = threading.Thread(target=self._device, args=(False, False))
+            th.start()
+            self.pexp.sendline(block)
+            th.join()
+            self.assertEqual(self.lines, [b'secret', b'end'])
+            self.assertEqual(self.pexp.get_tx_stats()['drops'], 0)
+
+        def test_send_paced_fail(self):
+            self.pexp.set_pacing(32, wait_echo=True)
+            self.pexp.pace_echo_timeout = 0.1
+            def device():
+                # echo the input without its last 2 bytes
+                try:
+                    while True:
+                        data = os.read(self.fd_master, 4096)
+                        os.write(self.fd_master, data[:-2])
+                except OSError:
+                    pass
+            threading.Thread(target=device, daemon=True).start()
+            self.assertRaises(SerialDropError, self.pexp.sendline, "switchport access vlan 10")
+            self.assertEqual(self.pexp.get_tx_stats()['drops'], self.pexp.pace_max_retries + 1)
+
+    unittest.main()
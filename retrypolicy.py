@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the retry policy of the device operations
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import time
+import random
+import logging as L
+
+# the outcomes of an attempt, returned by the classify function of RetryPolicy.run()
+RETRY_DONE = 'done'     # succeeded, stop
+RETRY_AGAIN = 'again'   # a transient error, such as the network is not ready
+RETRY_FAIL = 'fail'     # a hopeless error, such as no space on the device, stop at once
+
+## RetryPolicy Class
+#
+#  Run an operation until it succeeds, with the exponential backoff and the jitter between the attempts.
+#  It stops when the operation fails with a hopeless error, or when it runs out of the attempts or the time budget.
+class RetryPolicy():
+    ## the constructor
+    #  @param name The name of the operation in the logs and the counters.
+    #  @param max_attempts The max number of the attempts, 0 for no limit.
+    #  @param max_elapsed The max seconds from the first attempt, 0 for no limit; no new attempt is started after that.
+    #  @param base_delay The delay in seconds after the first failure.
+    #  @param max_delay The max delay in seconds.
+    #  @param multiplier The delay is multiplied after each failure.
+    #  @param jitter The fraction of the delay to be randomized, so the devices don't retry at the same time.
+    #  @param retry_on The exception types to be retried, such as (pexpect.TIMEOUT,); other exceptions are raised.
+    def __init__(self, name='', max_attempts=5, max_elapsed=0, base_delay=0.5, max_delay=10, multiplier=2.0, jitter=0.5, retry_on=()):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.max_elapsed = max_elapsed
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on)
+        # for the tests
+        self.sleep = time.sleep
+        self.clock = time.monotonic
+        self.random = random.random
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## get a copy of the policy with some of the settings changed
+    def replace(self, **kwargs):
+        policy = RetryPolicy(self.name, self.max_attempts, self.max_elapsed, self.base_delay, self.max_delay, self.multiplier, self.jitter, self.retry_on)
+        for k, v in kwargs.items():
+            if not hasattr(policy, k):
+                raise AttributeError("unknown retry setting '{0}'".format(k))
+            setattr(policy, k, v)
+        return policy
+
+    ## get the delay before the next attempt
+    #  @param failures The number of the failed attempts so far, 1 for the first failure.
+    def get_delay(self, failures):
+        delay = min(self.base_delay * (self.multiplier ** (failures - 1)), self.max_delay)
+        return delay * (1.0 - self.jitter * self.random())
+
+    ## run the operation
+    #  @param func The operation, it's called without arguments.
+    #  @param classify The function to get the outcome from the return value of func: RETRY_DONE, RETRY_AGAIN or RETRY_FAIL;
+    #         func succeeds if it returns a true value if not set.
+    #  @param stats The dict to add the counters 'attempts', 'retries' and 'failures', such as Switch.get_retry_stats().
+    #  @return (True, the last return value) if succeeded, (False, the last return value or the exception) if not.
+    def run(self, func, classify=None, stats=None):
+        if classify is None:
+            classify = lambda ret: RETRY_DONE if ret else RETRY_AGAIN
+        if stats is None:
+            stats = {}
+        for k in ('attempts', 'retries', 'failures'):
+            stats.setdefault(k, 0)
+        tm_start = self.clock()
+        failures = 0
+        while True:
+            stats['attempts'] += 1
+            try:
+                ret = func()
+                outcome = classify(ret)
+            except self.retry_on as e:
+                ret = e
+                outcome = RETRY_AGAIN
+            if outcome == RETRY_DONE:
+                return (True, ret)
+            failures += 1
+            if outcome == RETRY_FAIL:
+                L.error("{0}: failed: {1}".format(self.name, ret))
+                stats['failures'] += 1
+                return (False, ret)
+            if self.max_attempts > 0 and failures >= self.max_attempts:
+                L.error("{0}: failed after {1} attempts: {2}".format(self.name, failures, ret))
+                stats['failures'] += 1
+                return (False, ret)
+            delay = self.get_delay(failures)
+            if self.max_elapsed > 0 and self.clock() + delay - tm_start > self.max_elapsed:
+                L.error("{0}: failed in {1:.1f} seconds: {2}".format(self.name, self.clock() - tm_start, ret))
+                stats['failures'] += 1
+                return (False, ret)
+            L.info("{0}: retry in {1:.1f} seconds ({2})".format(self.name, delay, ret))
+            stats['retries'] += 1
+            self.sleep(delay)
+
+if __name__ == '__main__':
+    import unittest
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            self.now = 0.0
+            self.delays = []
+        def tearDown(self):
+            pass
+
+        def _get_policy(self, **kwargs):
+            policy = RetryPolicy('test', **kwargs)
+            def sleep(delay):
+                self.delays.append(delay)
+                self.now += delay
+            policy.sleep = sleep
+            policy.clock = lambda: self.now
+            policy.random = lambda: 1.0
+            return policy
+
+        def test_backoff(self):
+            policy = self._get_policy(max_attempts=6, base_delay=1, max_delay=5, jitter=0.5)
+            self.assertEqual([policy.get_delay(i) for i in range(1, 6)], [0.5, 1.0, 2.0, 2.5, 2.5])
+            results = iter([False, False, False, True])
+            stats = {}
+            self.assertEqual(policy.run(lambda: next(results), stats=stats), (True, True))
+            self.assertEqual(self.delays, [0.5, 1.0, 2.0])
+            self.assertEqual(stats, { 'attempts': 4, 'retries': 3, 'failures': 0 })
+
+        def test_budgets(self):
+            stats = {}
+            policy = self._get_policy(max_attempts=3, base_delay=1, jitter=0)
+            self.assertEqual(policy.run(lambda: 1, lambda ret: RETRY_AGAIN, stats), (False, 1))
+            self.assertEqual(stats, { 'attempts': 3, 'retries': 2, 'failures': 1 })
+            # the elapsed time
+            self.delays = []
+            policy = self._get_policy(max_attempts=0, max_elapsed=10, base_delay=1, jitter=0)
+            self.assertEqual(policy.run(lambda: False)[0], False)
+            self.assertEqual(self.delays, [1, 2, 4])
+            # the hopeless error
+            stats = {}
+            self.assertEqual(policy.run(lambda: 2, lambda ret: RETRY_FAIL, stats), (False, 2))
+            self.assertEqual(stats, { 'attempts': 1, 'retries': 0, 'failures': 1 })
+
+        def test_exceptions(self):
+            policy = self._get_policy(max_attempts=3, retry_on=(TimeoutError,))
+            results = iter([TimeoutError("timeout"), 5])
+            def func():
+                ret = next(results)
+                if isinstance(ret, Exception):
+                    raise ret
+                return ret
+            self.assertEqual(policy.run(func), (True, 5))
+            def fail():
+                raise ValueError("bad value")
+            self.assertRaises(ValueError, policy.run, fail)
+            self.assertEqual(policy.replace(max_attempts=9).max_attempts, 9)
+            self.assertRaises(AttributeError, policy.replace, attempts=9)
+
+    unittest.main()
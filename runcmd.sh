@@ -52,6 +52,9 @@ run_telnet() {
 }
 
 
+DN_EXEC="$(dirname "$(readlink -f "$0")")"
+FN_BROKER_PID=/tmp/agilenet-consolebroker.pid
+
 ARG_CMD=$1
 shift
 
@@ -78,14 +81,25 @@ EOF
   ;;
 
 svrstart)
-  socat TCP-LISTEN:6000,fork,reuseaddr  FILE:/dev/ttyRT1ow,b115200,raw,echo=0 & # OpenWrt
-  socat TCP-LISTEN:6001,fork,reuseaddr FILE:/dev/ttySW1cisco,b9600,raw,echo=0 & # Cisco C2960 WS-C2960-8TC-L
-  socat TCP-LISTEN:6002,fork,reuseaddr  FILE:/dev/ttySW2dell,b9600,raw,echo=0 & # Dell PowerConnect 5324
-  socat TCP-LISTEN:6003,fork,reuseaddr FILE:/dev/ttySW3aruba,b9600,raw,echo=0 & # HP/Aruba J9727A 2920-24G-PoE+ Switch (speedsense,default 9600)
+  # all of the serial ports are shared by one broker process, see consolebroker.py
+  python3 "${DN_EXEC}/consolebroker.py" \
+    -p /dev/ttyRT1ow:115200:6000 \
+    -p /dev/ttySW1cisco:9600:6001 \
+    -p /dev/ttySW2dell:9600:6002 \
+    -p /dev/ttySW3aruba:9600:6003 \
+    &
+  echo $! > "${FN_BROKER_PID}"
+  # 6000: OpenWrt
+  # 6001: Cisco C2960 WS-C2960-8TC-L
+  # 6002: Dell PowerConnect 5324
+  # 6003: HP/Aruba J9727A 2920-24G-PoE+ Switch (speedsense,default 9600)
   ;;
 
 svrstop)
-  ps -ef | grep "socat TCP-LISTEN:600" | awk '{print $2}' | xargs -n 1 kill -9
+  if [ -f "${FN_BROKER_PID}" ]; then
+    kill -TERM $(cat "${FN_BROKER_PID}")
+    rm -f "${FN_BROKER_PID}"
+  fi
   ;;
 
 pingdns)
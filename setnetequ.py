@@ -21,11 +21,15 @@ from datetime import datetime
 from datetime import timedelta
 import ipaddress
 import time
+import functools
 import pyjson5
 
 import pexpect
 import serial
 from pexpect_serial import SerialSpawn
+from consoledrain import DrainedSpawn, DrainedSerialSpawn
+from telnetspawn import TelnetSpawn
+from sshtransport import SshTransport
 
 import logging
 import mylog
@@ -37,6 +41,10 @@ from openwrtuci import OpenwrtSwitch, VlanPortGenerator
 from ciscoios import CiscoSwitch
 from dellpc import DellSwitch
 from arubacli import ArubaSwitch
+from hwprofile import HwProfileStore, get_profile_key
+from timeoutmodel import TimeoutModel
+from journal import Journal, get_digest
+from stepgraph import StepGraph
 
 try:
     FileNotFoundError # python 3
@@ -55,6 +63,33 @@ PROGRAM_PREFIX = os.path.basename(__file__).split('.')[0]
 #    'driver': 'ciscoios',
 #    #'arg_has_hw_switch': True, # ignored
 #}
+## get the name of the connection, such as '/dev/ttyUSB0', '192.168.1.1:23'
+def get_connection_key(config_connect):
+    for i in [ 'ssh_host', 'ipaddr', 'serial', 'virsh_name' ]:
+        if (i in config_connect) and config_connect[i] and config_connect[i].strip():
+            if i == 'ipaddr':
+                return "{0}:{1}".format(config_connect[i].strip(), config_connect['port'])
+            return config_connect[i].strip()
+    return config_connect['name'] if 'name' in config_connect else 'unknown'
+
+# the keys of the config not applied to the device: the connection, the local files, and how the config is sent
+LOCAL_CONFIG_KEYS = { 'name', 'content_file', 'console_logfile', 'fleet_group', 'baud', 'console_drain', 'ipaddr', 'port', 'rest', 'telnet_binary',
+    'arg_journal', 'arg_timeout_history', 'arg_profile_cache', 'arg_console_baud', 'arg_console_restore', 'arg_echo_off', 'arg_compressed_upload', 'arg_uci_pipelined' }
+LOCAL_CONFIG_PREFIXES = ( 'serial', 'ssh_', 'virsh_' )
+# the secrets of the config, not even their digests are stored on the device
+SECRET_CONFIG_KEYS = { 'admin_password' }
+
+## get the part of the config applied to the device, without the local settings
+def get_applied_config(configs):
+    return { k: v for k, v in configs.items() if not (k in LOCAL_CONFIG_KEYS or k.startswith(LOCAL_CONFIG_PREFIXES)) }
+
+## get the fingerprint of the config applied by the command, it's stored on the device, see Switch.get_config_fingerprint()
+#  The local settings, such as the connection, are not part of it, so the device reached in another way has the same fingerprint.
+#  The secrets are not part of it either, the fingerprint may be read by the others, such as by SNMP.
+def get_config_fingerprint(configs, command="layout", reset=True):
+    config = { k: v for k, v in get_applied_config(configs).items() if not k in SECRET_CONFIG_KEYS }
+    return get_digest({ 'version': __version__, 'command': command, 'reset': reset or command == "reset", 'config': config })
+
 def factory_device(config_device):
     device = None
     if config_device['driver'] == 'ciscoios':
@@ -88,6 +123,42 @@ def factory_device(config_device):
         else:
             device.is_gns3 = False
 
+        # the local store of the HW capability profiles: a directory, or false to always probe the device
+        if ('arg_profile_cache' in config_device) and hasattr(device, 'profile_store'):
+            if config_device['arg_profile_cache']:
+                device.profile_store = HwProfileStore(config_device['arg_profile_cache'])
+            else:
+                device.profile_store = None
+
+        if ('arg_uci_pipelined' in config_device) and hasattr(device, 'uci_pipelined'):
+            device.uci_pipelined = bool(config_device['arg_uci_pipelined'])
+
+        if ('arg_echo_off' in config_device) and hasattr(device, 'echo_off'):
+            device.echo_off = bool(config_device['arg_echo_off'])
+
+        if ('arg_compressed_upload' in config_device) and hasattr(device, 'compressed_upload'):
+            device.compressed_upload = bool(config_device['arg_compressed_upload'])
+
+        # the latency history to learn the timeouts: a directory, or false to use the default timeouts
+        if (not 'arg_timeout_history' in config_device) or config_device['arg_timeout_history']:
+            path = config_device['arg_timeout_history'] if 'arg_timeout_history' in config_device else None
+            if not isinstance(path, str):
+                path = None
+            device.set_timeout_model(TimeoutModel("{0}-{1}".format(config_device['driver'], get_connection_key(config_device)), path))
+
+        # the journal of the steps done to resume an interrupted run: a directory, or false to keep it in memory only
+        if (not 'arg_journal' in config_device) or config_device['arg_journal']:
+            path = config_device['arg_journal'] if 'arg_journal' in config_device else None
+            if not isinstance(path, str):
+                path = None
+            device.set_journal(Journal("{0}-{1}".format(config_device['driver'], get_connection_key(config_device)), path))
+
+        # raise the console speed after login, see Switch.upshift_console()
+        if ('arg_console_baud' in config_device) and config_device['arg_console_baud']:
+            device.console_baud = int(config_device['arg_console_baud'])
+        if 'arg_console_restore' in config_device:
+            device.console_restore = bool(config_device['arg_console_restore'])
+
     return device
 
 
@@ -95,10 +166,14 @@ class PexpectWrapper():
     def __del__(self):
         if self._fp != sys.stdout:
             self._fp.close()
+        if self.transport:
+            self.transport.stop()
 
-    def __init__(self, pexp, filename):
+    def __init__(self, pexp, filename, transport=None):
         #add properties etc.
         self._pexp = pexp
+        # the SshTransport to run the commands in their own channels, None for the consoles
+        self.transport = transport
         self._fp = None
         if filename == "/dev/stderr":
             self._fp = sys.stdout
@@ -116,6 +191,19 @@ class PexpectWrapper():
     def expect(self, a, timeout=None):
         return self._pexp.expect(a,timeout=timeout)
 
+    # run a command in a channel of the transport, see SshTransport.exec()
+    def exec_command(self, cmd, input=None, timeout=None):
+        self._fp.write(cmd); self._fp.write("\n")
+        self._fp.flush()
+        return self.transport.exec(cmd, input=input, timeout=timeout)
+
+    def expect_loop(self, searcher, timeout=-1, searchwindowsize=-1):
+        return self._pexp.expect_loop(searcher, timeout, searchwindowsize)
+
+    def get_timeout(self):
+        return self._pexp.timeout
+    timeout = property(get_timeout)
+
     def isalive(self):
         return self._pexp.isalive()
 
@@ -137,6 +225,33 @@ class PexpectWrapper():
     def read_nonblocking(self, a, timeout=None):
         return self._pexp.read_nonblocking(a,timeout=timeout)
 
+    # drop the received data, see ConsoleDrainMixin.discard_pending(); return None if not supported
+    def discard_pending(self):
+        if not hasattr(self._pexp, 'discard_pending'):
+            return None
+        return self._pexp.discard_pending()
+
+    # the baud rate of the serial port; return None if not a serial port
+    def get_baudrate(self):
+        if not hasattr(self._pexp, 'get_baudrate'):
+            return None
+        return self._pexp.get_baudrate()
+
+    def set_baudrate(self, baud):
+        return self._pexp.set_baudrate(baud)
+
+    # the latencies of the expects, see SerialSpawn.get_latency_stats(); return None if not supported
+    def get_latency_stats(self):
+        if not hasattr(self._pexp, 'get_latency_stats'):
+            return None
+        return self._pexp.get_latency_stats()
+
+    # the counters of the serial writes, see SerialSpawn.get_tx_stats(); return None if not supported
+    def get_tx_stats(self):
+        if not hasattr(self._pexp, 'get_tx_stats'):
+            return None
+        return self._pexp.get_tx_stats()
+
 # example config_connect
 #config_connect_1 = {
 #    'serial': '/dev/ttyUSB0', 'baud': 115200,
@@ -145,14 +260,42 @@ class PexpectWrapper():
 #}
 def factory_pexpect(config_connect, output):
     pexp = None
-    if ('ipaddr' in config_connect) and (config_connect['ipaddr']) and (not (config_connect['ipaddr'].strip() == '')):
+    transport = None
+    if ('ssh_host' in config_connect) and (config_connect['ssh_host']) and (not (config_connect['ssh_host'].strip() == '')):
+        transport = SshTransport(config_connect['ssh_host'].strip(),
+            port = config_connect['ssh_port'] if 'ssh_port' in config_connect else 22,
+            user = config_connect['ssh_user'] if 'ssh_user' in config_connect else 'root',
+            identity = config_connect['ssh_identity'] if 'ssh_identity' in config_connect else None,
+            options = config_connect['ssh_options'] if 'ssh_options' in config_connect else None)
+        if not transport.start():
+            L.error("unable to start the ssh connection: " + config_connect['ssh_host'])
+            return None
+        pexp = transport.spawn_shell(timeout=600)
+
+    elif ('ipaddr' in config_connect) and (config_connect['ipaddr']) and (not (config_connect['ipaddr'].strip() == '')):
         L.info("telnet to '{0}:{1}':".format(config_connect['ipaddr'], config_connect['port']))
-        pexp = pexpect.spawn("telnet " + config_connect['ipaddr'].strip() + " " + str(config_connect['port']) , timeout=600)
+        if ('telnet_binary' in config_connect) and config_connect['telnet_binary']:
+            pexp = DrainedSpawn("telnet " + config_connect['ipaddr'].strip() + " " + str(config_connect['port']) , timeout=600)
+        else:
+            try:
+                pexp = TelnetSpawn(config_connect['ipaddr'].strip(), int(config_connect['port']), timeout=600)
+            except pexpect.EOF as e:
+                L.error("unable to telnet: {0}".format(e))
+                return None
 
     elif ('serial' in config_connect) and (config_connect['serial']) and (not (config_connect['serial'].strip() == '')):
         L.info("use serial port '{0}' and baud '{1}':".format(config_connect['serial'], config_connect['baud']))
-        pexp = SerialSpawn(config_connect['serial'], config_connect['baud'], timeout=600)
+        pexp = DrainedSerialSpawn(config_connect['serial'], config_connect['baud'], timeout=600)
         assert(pexp.isalive())
+        # the low latency settings of the serial port and the USB adapter
+        if ('serial_low_latency' in config_connect) and config_connect['serial_low_latency']:
+            applied = pexp.set_low_latency(True)
+            L.info("serial low latency: {0}".format(", ".join(applied) if applied else "not supported"))
+        # send the long lines in chunks, for the devices which drop the input at a low baud rate
+        if ('serial_chunk' in config_connect) and config_connect['serial_chunk']:
+            pexp.set_pacing(int(config_connect['serial_chunk']),
+                wait_echo = config_connect['serial_wait_echo'] if 'serial_wait_echo' in config_connect else False,
+                delay = float(config_connect['serial_delay']) if 'serial_delay' in config_connect else 0.0)
 
     elif ('virsh_name' in config_connect):
         cmd = "virsh"
@@ -163,7 +306,7 @@ def factory_pexpect(config_connect, output):
             cmd += f" -c {url}"
         cmd += f" console {config_connect['virsh_name'].strip()}"
         L.debug(f"CMD={cmd}")
-        pexp = pexpect.spawn(cmd, timeout=600)
+        pexp = DrainedSpawn(cmd, timeout=600)
         pexp.sendline("\r\n")
         ret = pexp.expect(['Escape character', 'failed to connect to the hypervisor'])
         if (ret != 0):
@@ -177,9 +320,13 @@ def factory_pexpect(config_connect, output):
 
     pexp.logfile = output
 
+    # read the console in background, set 'console_drain' to false to read it only in expect()
+    if (not 'console_drain' in config_connect) or config_connect['console_drain']:
+        pexp.start_drain()
+
     assert(pexp.isalive())
 
-    return PexpectWrapper(pexp, config_connect['content_file'].strip())
+    return PexpectWrapper(pexp, config_connect['content_file'].strip(), transport)
 
 ################################################################################
 class StdoutWrapper(io.TextIOWrapper):
@@ -198,11 +345,20 @@ class ConfigDevice():
     def __init__(self, config_device, config_connect):
         self.device = factory_device(config_device)
         assert (isinstance(self.device, Switch))
-        self.device.pexp = factory_pexpect(config_connect, self.stdout_wrapper)
+        # the console output of the device, to the standard output if 'console_logfile' is not set
+        self.console_log = None
+        output = self.stdout_wrapper
+        if ('console_logfile' in config_connect) and config_connect['console_logfile']:
+            self.console_log = open(config_connect['console_logfile'], "ab")
+            output = self.console_log
+        self.device.pexp = factory_pexpect(config_connect, output)
 
     def __del__(self):
         #self.device.pexp.close()
-        self.stdout_wrapper.close()
+        # the stdout wrapper is shared by the devices in the same process
+        self.stdout_wrapper.flush()
+        if self.console_log:
+            self.console_log.close()
         #sys.stdout = sys.stdout.detach()
 
     def _show_info(self):
@@ -222,27 +378,56 @@ class ConfigDevice():
         #L.debug("ConfigDevice::show_info done")
         return True
 
-    def _reset(self, config_reset):
+    #  @param packages The software packages to install, see get_packages(); get them from the config if not set.
+    def _reset(self, config_reset, packages=None):
         port_map = config_reset['arg_port_map']
         L.debug("ConfigDevice::_reset device reset_config ...")
-        self.device.reset_config(port_map)
+        self.device.journal.run('reset_config', port_map, lambda: self.device.reset_config(port_map) or True)
 
         return True
 
-    def reset(self, config_reset):
-        if not self._reset(config_reset):
+    def reset(self, config_reset, packages=None):
+        if not self._reset(config_reset, packages):
             L.error("ConfigDevice::reset _reset error")
             return False
         L.debug("ConfigDevice::reset device save_config ...")
-        self.device.save_config()
+        self.device.journal.run('save_config', None, lambda: self.save_config() or True)
         L.debug("ConfigDevice::reset done")
         return True
 
     def reboot(self, wait_network=True):
-        self.device.reboot(wait_network)
+        # the device boots at the original console speed
+        upshifted = self.device.console_upshifted
+        if upshifted:
+            self.device.restore_console(force=True)
+        if self.device.reboot(wait_network) is False:
+            L.error("ConfigDevice::reboot error")
+            return False
+        if upshifted:
+            self.device.upshift_console()
         L.debug("ConfigDevice::reboot done")
         return True
 
+    # save the config, without the console speed raised by upshift_console()
+    def save_config(self):
+        upshifted = self.device.console_upshifted and self.device.console_speed_saved
+        if upshifted:
+            self.device.restore_console(force=True)
+        ret = self.device.save_config()
+        if upshifted:
+            self.device.upshift_console()
+        return ret
+
+    ## store the fingerprint of the config applied, see Switch.set_config_fingerprint()
+    #  @param digest The digest of the config, None to remove the fingerprint from the running config.
+    def set_config_fingerprint(self, digest):
+        if not self.device.set_config_fingerprint(digest):
+            return False
+        if digest:
+            # without the console speed raised by upshift_console()
+            self.save_config()
+        return True
+
     # setup the device config with the specified interface/vlan layout
     #example of config_layout:
     #config_layout_1 = {
@@ -254,35 +439,25 @@ class ConfigDevice():
     #    'arg_interface_config': interface_config_netlab, # the openwrt interface config
     #    'arg_local_addr': "192.168.5.0/24", # the ip blocks for LAN
     #}
-    def _set_layout(self, config_layout):
+    #  @param plan The VLAN layout, see get_layout_plan(); get it from the config if not set.
+    def _set_layout(self, config_layout, plan=None):
+        if not plan:
+            plan = get_layout_plan(config_layout)
+            if not plan:
+                return False
 
         L.info("ConfigDevice::_set_layout set hostname")
         self.device.set_hostname(config_layout['arg_hostname'])
 
-        # get all of the VLAN IDs from the interface config
-        interface_config_homemain=config_layout["arg_interface_config"]
-        vlan_set_homemain = {1,2}.union({ interface_config_homemain[i][0] for i in interface_config_homemain })
-        L.debug("vlan_set_homemain=" + str(vlan_set_homemain))
-
-        if 'arg_port_vlan' in config_layout:
-            port_vlan = config_layout['arg_port_vlan']
-            [port_list, vlan_list] = port_vlan_to_lists(port_vlan)
-        elif ('arg_port_list' in config_layout) and ('arg_vlan_list' in config_layout):
-            vlan_list = config_layout['arg_vlan_list']
-            port_list = config_layout['arg_port_list']
-        else:
-            L.error('not found config of port map')
-            return False
-
-        if not self.device.set_vlans(config_layout['arg_port_map'], port_list, vlan_list, vlan_set_homemain, interface_config = interface_config_homemain):
+        if not self.device.set_vlans(config_layout['arg_port_map'], plan['port_list'], plan['vlan_list'], plan['vlan_set'], interface_config = config_layout["arg_interface_config"]):
             return False
         return True
 
-    def set_layout(self, config_layout):
-        if not self._set_layout(config_layout):
+    def set_layout(self, config_layout, plan=None):
+        if not self._set_layout(config_layout, plan):
             L.error("ConfigDevice::set_layout _set_layout error")
             return False
-        self.device.save_config()
+        self.save_config()
         L.debug("ConfigDevice::set_layout done")
         return True
 
@@ -291,30 +466,36 @@ class ConfigOpenwrt(ConfigDevice):
         super().__init__(config_device, config_connect)
 
     def _show_info(self):
-        L.debug("ConfigOpenwrt::_show_info super()._show_info ...")
-        L.info("swconfig: '{0}'".format(self.device.get_swconfig()))
+        # get all of the info in one round trip, super()._show_info() will read them from the facts cache
+        facts = self.device.collect_facts()
+        L.info("swconfig: '{0}'".format(facts['swconfig']))
+        L.info("WiFi: '{0}'".format(facts['num_wifi']))
         #self.device.show_network()
+        L.debug("ConfigOpenwrt::_show_info super()._show_info ...")
         if not super()._show_info():
             L.error("ConfigOpenwrt::_show_info super()._show_info error")
             return False
         return True
 
-    def _reset(self, config_reset):
+    def _reset(self, config_reset, packages=None):
+        if self.device._get_transport():
+            L.error("ConfigOpenwrt::_reset the factory reset is not supported over SSH, use the console or the option '-s' (no reset)")
+            return False
 
-        if not super()._reset(config_reset):
+        if not super()._reset(config_reset, packages):
             L.error("ConfigDevice::_reset super()._reset error")
             return False
 
         L.info("ConfigOpenwrt::reset set timezone")
-        self.device.set_timezone()
+        self.device.journal.run('set_timezone', None, lambda: self.device.set_timezone() or True)
 
-        self.device.save_config() # save config before update the softwares
+        # save config before update the softwares
+        self.device.journal.run('save_config', None, lambda: self.device.save_config() or True)
 
         L.info("ConfigOpenwrt::reset update softwares")
-        extra = [ "luci-ssl", "uhttpd", "ip-full", "ip-bridge", "gawk" ]
-        if "extra_packets" in config_reset:
-            extra = config_reset["extra_packets"]
-        if not self.device.update_softwares(extra):
+        if packages is None:
+            packages = get_packages(config_reset)
+        if not self.device.update_softwares(packages):
             L.error("ConfigOpenwrt::reset error in update_softwares")
             return False
 
@@ -322,8 +503,12 @@ class ConfigOpenwrt(ConfigDevice):
         return True
 
     # setup a openwrt router, 5 ports
-    def _set_layout(self, config_layout):
-        if not super()._set_layout(config_layout):
+    def _set_layout(self, config_layout, plan=None):
+        if not plan:
+            plan = get_layout_plan(config_layout)
+            if not plan:
+                return False
+        if not super()._set_layout(config_layout, plan):
             L.error("ConfigOpenwrt::_set_layout error in super()._set_layout")
             return False
 
@@ -332,14 +517,8 @@ class ConfigOpenwrt(ConfigDevice):
         self.device.change_to_https()
 
         port_map = config_layout['arg_port_map']
-
-        if 'arg_port_vlan' in config_layout:
-            port_vlan = config_layout['arg_port_vlan']
-            port_list = sorted(port_vlan)
-            vlan_list = [port_vlan[i] for i in port_list]
-        else:
-            vlan_list = config_layout['arg_vlan_list']
-            port_map = config_layout['arg_port_map']
+        port_list = plan['port_list']
+        vlan_list = plan['vlan_list']
 
         L.info("ConfigOpenwrt::_set_layout set interfaces")
         ifname_gen=None
@@ -359,8 +538,8 @@ class ConfigOpenwrtHomemain(ConfigOpenwrt):
         super().__init__(config_device, config_connect)
 
     # setup a openwrt router, 5 ports
-    def _set_layout(self, config_layout):
-        if not super()._set_layout(config_layout):
+    def _set_layout(self, config_layout, plan=None):
+        if not super()._set_layout(config_layout, plan):
             L.error("ConfigOpenwrtHomemain::_set_layout error in super()._set_layout")
             return False
 
@@ -389,6 +568,54 @@ class ConfigOpenwrtHomemain(ConfigOpenwrt):
         return True
 
 
+# the software packages installed by the reset of OpenWRT
+DEFAULT_PACKAGES = [ "luci-ssl", "uhttpd", "ip-full", "ip-bridge", "gawk" ]
+
+## get the software packages to install from the config, it runs on the host only
+#  @param config_reset The config of the device, the packages are in 'extra_packets'.
+#  @return the list of the package names, without the empty and duplicated ones
+def get_packages(config_reset):
+    packages = DEFAULT_PACKAGES
+    if "extra_packets" in config_reset:
+        packages = config_reset["extra_packets"]
+    ret = []
+    for i in packages:
+        pkg = i.strip()
+        if pkg and not pkg in ret:
+            ret.append(pkg)
+    return ret
+
+## get the VLAN layout from the config, it runs on the host only
+#  @param config_layout The config of the device, see ConfigDevice._set_layout().
+#  @return a dict of {'vlan_set', 'port_list', 'vlan_list'}, or None if the config is not valid
+def get_layout_plan(config_layout):
+    for i in [ 'arg_hostname', 'arg_port_map', 'arg_interface_config' ]:
+        if not i in config_layout:
+            L.error("not found '{0}' in the config".format(i))
+            return None
+
+    # get all of the VLAN IDs from the interface config
+    interface_config = config_layout["arg_interface_config"]
+    vlan_set = {1,2}.union({ interface_config[i][0] for i in interface_config })
+    L.debug("vlan_set=" + str(vlan_set))
+
+    if ('arg_port_vlan' in config_layout) and config_layout['arg_port_vlan']:
+        [port_list, vlan_list] = port_vlan_to_lists(config_layout['arg_port_vlan'])
+    elif ('arg_port_list' in config_layout) and ('arg_vlan_list' in config_layout):
+        vlan_list = config_layout['arg_vlan_list']
+        port_list = config_layout['arg_port_list']
+    else:
+        L.error('not found config of port map')
+        return None
+    if len(port_list) != len(vlan_list):
+        L.error("the port list and the vlan list are not of the same size: {0}, {1}".format(port_list, vlan_list))
+        return None
+    for i in port_list:
+        if not i in config_layout['arg_port_map']:
+            L.error("the port '{0}' is not in the port map".format(i))
+            return None
+    return { 'vlan_set': vlan_set, 'port_list': port_list, 'vlan_list': vlan_list }
+
 def factory_config_device(config_device):
     device = None
     if config_device['driver'] == 'openwrtuci':
@@ -400,42 +627,147 @@ def factory_config_device(config_device):
     return device
 
 
-def setup_network_equipment(configs, reset=True, command="layout"):
+## start the session of the device, it's called once the connection is established
+def start_session(rt1):
+    rt1.device.begin_session()
+    if rt1.device.console_baud:
+        rt1.device.upshift_console()
+
+## end the session of the device, and log the statistics of the session
+def end_session(rt1):
+    rt1.device.restore_console()
+    rt1.device.end_session()
+    rt1.device.timeouts.save()
+    for name, stats in sorted(rt1.device.timeouts.get_stats().items()):
+        L.info("timeout '{0}': {1} samples, p95 {2:.1f} s, timeout {3:.0f} s".format(name, stats['count'], stats['p95'], stats['timeout']))
+    for name, stats in sorted(rt1.device.get_retry_stats().items()):
+        L.info("retry '{0}': {1} attempts, {2} retries, {3} failures".format(name, stats['attempts'], stats['retries'], stats['failures']))
+    if rt1.device.journal.get_skipped():
+        L.info("journal: {0} steps done by the interrupted run are skipped".format(rt1.device.journal.get_skipped()))
+    stats = rt1.device.get_facts_stats()
+    L.info("facts cache: {0} hits (device round trips saved), {1} misses".format(stats['hits'], stats['misses']))
+    stats = rt1.device.pexp.get_tx_stats()
+    if stats:
+        L.info("serial: sent {0} bytes in {1:.1f} seconds, {2:.0f} bytes/s, chunk size {3}, {4} chunks dropped".format(
+            stats['bytes'], stats['seconds'], stats['bytes_per_second'], stats['chunk_size'], stats['drops']))
+    stats = rt1.device.pexp.get_latency_stats()
+    if stats:
+        L.info("serial: {0} expects, latency mean {1:.1f} ms, p50 {2:.1f} ms, p95 {3:.1f} ms, max {4:.1f} ms".format(
+            stats['count'], stats['mean'], stats['p50'], stats['p95'], stats['max']))
+
+## set up the device
+#  @param resume True to skip the steps done by the interrupted run with the same inputs, see journal.py.
+#  @param force True to apply the config even if the device has the fingerprint of the same config.
+def setup_network_equipment(configs, reset=True, command="layout", resume=False, force=False):
 
     #import json
     #L.debug("use config:\n" + json.dumps(configs, indent=4))
 
     rt1 = factory_config_device(configs)
-
-    rt1.show_info()
+    rt1.device.journal.resume = resume
+    start_session(rt1)
+    try:
+        return _setup_network_equipment(rt1, configs, reset=reset, command=command, force=force)
+    finally:
+        end_session(rt1)
+
+## get the graph of the setup steps
+#  The device steps run in order: show_info, reset, root_passwd, set_layout, reboot;
+#  the host steps run while the device is busy: validating the config and getting the VLAN layout,
+#  getting the package list of the reset, and loading the HW profile of the device from the local store,
+#  which overlaps the reboot of the factory reset.
+#  The device steps changing the device are recorded in the journal of the device, the reset records its own steps;
+#  root_passwd always runs, since the password is not kept in the journal.
+def get_setup_steps(rt1, configs, reset=True, command="layout"):
+    graph = StepGraph()
+    profile_store = getattr(rt1.device, 'profile_store', None)
+    def do_show_info():
+        rt1.show_info()
+        # the facts are read by show_info(), they are in the facts cache
+        return rt1.device.collect_facts() if profile_store else True
+    graph.add_step('show_info', do_show_info, outputs=['info'])
     if command == "info":
-        L.info("get info completed")
-        return True
+        return graph
     if command == "reset":
         reset = True
-
+    if command != "reset":
+        graph.add_step('plan', lambda configs: get_layout_plan(configs) or False, inputs=['configs'], outputs=['plan'], host=True)
+
+    if profile_store:
+        def load_hw_profile(info):
+            # the profile is used by the layout after the reset, the firmware is not changed by the reset
+            if not profile_store.preload(get_profile_key(info['board'], info['version'])):
+                L.info("no HW profile of '{0}', the device will be probed".format(info['board']))
+            return True
+        graph.add_step('hw_profile', load_hw_profile, inputs=['info'], outputs=['hw_profile'], host=True)
+
+    last = 'info'
     if reset:
-        L.info("reset ...")
-        ret = rt1.reset(configs)
-        if not ret:
-            L.error("reset error")
-            return False
+        has_packages = isinstance(rt1, ConfigOpenwrt)
+        if has_packages:
+            graph.add_step('packages', lambda configs: get_packages(configs), inputs=['configs'], outputs=['packages'], host=True)
+        def do_reset(packages=None, **kwargs):
+            L.info("reset ...")
+            return rt1.reset(configs, packages)
+        # the config is validated before the device is reset
+        graph.add_step('reset', do_reset, inputs=[last] + (['plan'] if command != "reset" else []) + (['packages'] if has_packages else []), outputs=['reset'])
+        last = 'reset'
 
     if ('admin_password' in configs):
-        L.info("ConfigOpenwrt::reset setup root pw")
-        rt1.device.set_root_passwd(configs['admin_password'])
+        def do_root_passwd(**kwargs):
+            L.info("ConfigOpenwrt::reset setup root pw")
+            # the password is not kept in the journal, not even its digest, so the step is not journaled and always runs
+            rt1.device.set_root_passwd(configs['admin_password'])
+            return True
+        graph.add_step('root_passwd', do_root_passwd, inputs=[last], outputs=['root_passwd'])
+        last = 'root_passwd'
 
     if command == "reset":
-        L.info("reset completed")
+        return graph
+
+    def do_set_layout(plan, **kwargs):
+        inputs = { 'plan': plan, 'configs': { k: v for k, v in get_applied_config(configs).items() if not k in SECRET_CONFIG_KEYS } }
+        return rt1.device.journal.run('set_layout', inputs, lambda: rt1.set_layout(configs, plan))
+    graph.add_step('set_layout', do_set_layout, inputs=['plan', last], outputs=['layout'])
+
+    # reboot if the device can't apply the config without reboot, or if it's required by the config
+    def do_reboot(layout):
+        reboot = rt1.device.needs_reboot()
+        if 'arg_reboot_after_layout' in configs:
+            reboot = configs['arg_reboot_after_layout']
+        if reboot:
+            return rt1.device.journal.run('reboot', None, lambda: rt1.reboot(wait_network=False))
         return True
-
-    ret = rt1.set_layout(configs)
+    graph.add_step('reboot', do_reboot, inputs=['layout'], outputs=['rebooted'])
+    return graph
+
+def _setup_network_equipment(rt1, configs, reset=True, command="layout", force=False):
+    digest = None
+    if command != "info":
+        # the device has the fingerprint of the config applied by the last run
+        digest = get_config_fingerprint(configs, command, reset)
+        applied = rt1.device.get_config_fingerprint()
+        if applied == digest and not force:
+            L.info("the config {0} is applied already, skip the {1} (use --force to apply it again)".format(digest, command))
+            return True
+        if applied:
+            # the device won't have the config of the fingerprint if the run is interrupted
+            rt1.set_config_fingerprint(None)
+
+    graph = get_setup_steps(rt1, configs, reset=reset, command=command)
+    ret = graph.run({ 'configs': configs })
+    L.info("setup steps:\n" + graph.get_report())
     if not ret:
-        L.error("set_layout error")
+        L.error("{0} error".format(command))
         return False
-
-    rt1.reboot(wait_network=False)
-    L.info("layout completed")
+    if command == "info":
+        L.info("get info completed")
+    else:
+        if not rt1.set_config_fingerprint(digest):
+            L.warning("unable to store the config fingerprint on the device")
+        # nothing to resume
+        rt1.device.journal.clear()
+        L.info("{0} completed".format(command))
     return True
 
 ################################################################################
@@ -470,6 +802,7 @@ if __name__ == '__main__':
                 'name': 'OpenWrt-netlab-tplinkac1200',
                 'driver': 'openwrtuci',
                 'arg_has_hw_switch': True,
+                'arg_port_map': { 'CPU': 6, 'WAN': 1, 'LAN1': 2 },
             })
             self.assertEqual(isinstance(device, Switch), True)
             self.assertEqual(isinstance(device, OpenwrtSwitch), True)
@@ -479,6 +812,7 @@ if __name__ == '__main__':
         def test_factory_pexpect(self):
             pass
 
+        @unittest.skip("the layouts are in the JSON configs of config-examples")
         def test_constant1(self):
             self.assertEqual(vlan_set_homemain, {5,6,10,20,30,40,50,60,70,80,90,100,110,120})
             self.assertEqual(vlan_set_netlab, {6,20,60,90,100,110})
@@ -488,7 +822,66 @@ if __name__ == '__main__':
                 1,2,5,6, 0,0,0,0
                 ])
 
-    #unittest.main()
+        def test_get_config_fingerprint(self):
+            configs = { 'driver': 'openwrtuci', 'arg_hostname': 'ap1', 'arg_port_map': { 'WAN': 1 }, 'admin_password': 'secret1' }
+            digest = get_config_fingerprint(configs)
+            self.assertRegex(digest, r'^[0-9a-f]{16}$')
+            # the connection, the local settings and the secrets are not part of it
+            self.assertEqual(get_config_fingerprint(dict(configs, serial='/dev/ttyUSB1', ssh_host='192.168.1.1', arg_journal=True, admin_password='secret2')), digest)
+            self.assertNotEqual(get_config_fingerprint(dict(configs, arg_hostname='ap2')), digest)
+            self.assertNotEqual(get_config_fingerprint(configs, command="reset"), digest)
+            self.assertNotEqual(get_config_fingerprint(configs, reset=False), digest)
+            self.assertEqual(get_config_fingerprint(configs, command="reset", reset=False), get_config_fingerprint(configs, command="reset"))
+
+        def test_get_packages(self):
+            self.assertEqual(get_packages({}), DEFAULT_PACKAGES)
+            self.assertEqual(get_packages({ 'extra_packets': [ ' gawk', 'tcpdump ', '', 'gawk' ] }), [ 'gawk', 'tcpdump' ])
+
+        def test_get_setup_steps(self):
+            import tempfile
+            calls = []
+            class MySwitch(Switch):
+                def collect_facts(self):
+                    return { 'board': 'ath79/generic/tplink_archer-c7-v2', 'model': 'Archer C7', 'version': '22.03.5', 'hostname': 'ap1' }
+                def set_root_passwd(self, root_pw):
+                    calls.append('root_passwd')
+            class MyConfig(ConfigOpenwrt):
+                def __init__(self, device):
+                    self.device = device
+                    self.console_log = None
+                def show_info(self):
+                    calls.append('show_info')
+                    return True
+                def reset(self, config_reset, packages=None):
+                    calls.append(('reset', packages))
+                    return True
+                def set_layout(self, config_layout, plan=None):
+                    calls.append(('set_layout', plan['port_list']))
+                    return True
+                def reboot(self, wait_network=True):
+                    calls.append('reboot')
+                    return True
+            configs = { 'arg_hostname': 'ap1', 'arg_port_map': { 'WAN': 1, 'LAN1': 2 }, 'arg_interface_config': { 'lan': [ 10, '192.168.10.1/24' ] },
+                'arg_port_vlan': { 'LAN1': 10 }, 'extra_packets': [ 'gawk' ], 'admin_password': 'secret', 'arg_reboot_after_layout': True }
+            with tempfile.TemporaryDirectory() as tmpdir:
+                device = MySwitch()
+                device.profile_store = HwProfileStore(tmpdir)
+                rt1 = MyConfig(device)
+                graph = get_setup_steps(rt1, configs)
+                self.assertEqual([ i.name for i in graph.steps if i.host ], [ 'plan', 'hw_profile', 'packages' ])
+                self.assertEqual(graph.run({ 'configs': configs }), True)
+                self.assertEqual(calls, [ 'show_info', ('reset', [ 'gawk' ]), 'root_passwd', ('set_layout', [ 'LAN1' ]), 'reboot' ])
+
+                # the device is not reset if the config is not valid
+                calls.clear()
+                graph = get_setup_steps(rt1, dict(configs, arg_port_vlan={ 'LAN9': 10 }))
+                self.assertEqual(graph.run({ 'configs': dict(configs, arg_port_vlan={ 'LAN9': 10 }) }), False)
+                self.assertEqual(calls, [ 'show_info' ])
+
+                # the info only
+                self.assertEqual([ i.name for i in get_setup_steps(rt1, configs, command="info").steps ], [ 'show_info' ])
+                # no package list if not reset
+                self.assertEqual([ i.name for i in get_setup_steps(rt1, configs, reset=False).steps if i.host ], [ 'plan', 'hw_profile' ])
 
     # tested:
     #setup_gns3_rt_openwrt_netlab()
@@ -508,42 +901,92 @@ if __name__ == '__main__':
 ################################################################################
 # main
 
-parser=argparse.ArgumentParser(description='setup switch network.')
-parser.add_argument('-l', '--logfile', type=str, dest='fnlog', default="/dev/stderr", help='the file to output the log')
-parser.add_argument('-o', '--outputfile', type=str, dest='fnout', default="/dev/stderr", help='the file save the setup contents')
-parser.add_argument('-j', '--json', type=str, dest='json', default=None, help="the JSON config file")
-parser.add_argument('-s', '--noreset', action='store_true', default=False, help='reset the router to factory mode')
-parser.add_argument('-t', '--type', type=str, dest='type', default="openwrtuci", help='the device driver type')
-parser.add_argument('-d', '--debug', action='store_true', default=False, help='show debug messages')
-parser.add_argument('-v', '--version', action='store_true', default=False, help='show version')
-parser.add_argument('c', type=str, help='The command, such as "info", "reset", "layout"; default is "layout"')
-args = parser.parse_args()
-
-log_level = logging.INFO
-if args.debug:
-    log_level = logging.DEBUG
-L.setLevel(log_level)
-
-if args.version:
-    L.info("version: " + __version__)
-    exit(0)
-
-if args.fnlog == "/dev/stderr":
-    L.info ("output log to standard error")
-else:
-    mylog.add_file_logger('switch', args.fnlog, log_level)
+## load the JSON config of a device
+#  @param fn_json The JSON config file, None to use the defaults only.
+#  @param driver The default device driver type.
+#  @param content_file The default file to save the setup contents.
+def load_config(fn_json, driver="openwrtuci", content_file="/dev/stderr"):
+    conf={"driver": driver, "content_file": content_file }
+    if fn_json:
+        with open(fn_json, "r") as file:
+            conf_update = pyjson5.load(file)
+            # update the config conf with conf_update
+            conf.update(conf_update)
+    return conf
+
+## set up the devices of the inventory in parallel, see fleet.py
+def run_fleet(args):
+    from fleet import load_inventory, format_summary
+    if not args.inventory:
+        L.error("the inventory file is required by the command 'fleet'")
+        return False
+    def load(fn_json, name):
+        conf = load_config(fn_json, args.type, args.fnout)
+        # the setup contents and the console output of each device go to its own files, named after the device like its log
+        if conf['content_file'] == "/dev/stderr":
+            conf['content_file'] = os.path.join(args.logdir, name + ".txt")
+        if not 'console_logfile' in conf:
+            conf['console_logfile'] = os.path.join(args.logdir, name + ".console")
+        return conf
+    os.makedirs(args.logdir, exist_ok=True)
+    try:
+        fleet = load_inventory(args.inventory, load, command=args.fleet_command, reset=not args.noreset, logdir=args.logdir)
+    except (OSError, ValueError) as e:
+        L.error("unable to load the inventory '{0}': {1}".format(args.inventory, e))
+        return False
+    tm_start = time.monotonic()
+    results = fleet.run(functools.partial(setup_network_equipment, resume=args.resume, force=args.force))
+    L.info("fleet summary:\n" + format_summary(results))
+    L.info("fleet: {0:.1f} seconds wall time".format(time.monotonic() - tm_start))
+    return all(i['ok'] for i in results)
+
+def main():
+    parser=argparse.ArgumentParser(description='setup switch network.')
+    parser.add_argument('-l', '--logfile', type=str, dest='fnlog', default="/dev/stderr", help='the file to output the log')
+    parser.add_argument('-o', '--outputfile', type=str, dest='fnout', default="/dev/stderr", help='the file save the setup contents')
+    parser.add_argument('-j', '--json', type=str, dest='json', default=None, help="the JSON config file")
+    parser.add_argument('-s', '--noreset', action='store_true', default=False, help='reset the router to factory mode')
+    parser.add_argument('-t', '--type', type=str, dest='type', default="openwrtuci", help='the device driver type')
+    parser.add_argument('-d', '--debug', action='store_true', default=False, help='show debug messages')
+    parser.add_argument('-v', '--version', action='store_true', default=False, help='show version')
+    parser.add_argument('-i', '--inventory', type=str, dest='inventory', default=None, help='the inventory file of the devices for the command "fleet"')
+    parser.add_argument('-c', '--fleet-command', type=str, dest='fleet_command', default="layout", help='the command for the devices of the fleet, such as "info", "reset", "layout"')
+    parser.add_argument('-r', '--resume', action='store_true', default=False, help='skip the steps done by the interrupted run, if their inputs are not changed')
+    parser.add_argument('-f', '--force', action='store_true', default=False, help='apply the config even if the device has the fingerprint of the same config')
+    parser.add_argument('-L', '--logdir', type=str, dest='logdir', default="fleet-logs", help='the directory of the per-device logs of the fleet')
+    parser.add_argument('c', type=str, help='The command, such as "info", "reset", "layout", "fleet", "test" (run the unit tests); default is "layout"')
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+    L.setLevel(log_level)
+
+    if args.version:
+        L.info("version: " + __version__)
+        exit(0)
+
+    if args.fnlog == "/dev/stderr":
+        L.info ("output log to standard error")
+    else:
+        mylog.add_file_logger('switch', args.fnlog, log_level)
 
-conf={"driver": args.type, "content_file": args.fnout }
-L.debug("args.json=" + str(args.json))
-if args.json:
-    with open(args.json, "r") as file:
-        conf_update = pyjson5.load(file)
-        # update the config conf with conf_update
-        conf.update(conf_update)
+    if args.c == "fleet":
+        return 0 if run_fleet(args) else 1
 
-#L.debug("conf=" + str(conf))
+    if args.c == "test":
+        # the tests of this file, see myTest
+        import unittest
+        return 0 if unittest.main(argv=[sys.argv[0]], exit=False).result.wasSuccessful() else 1
 
-setup_network_equipment(conf, reset=not args.noreset, command=args.c)
+    L.debug("args.json=" + str(args.json))
+    conf = load_config(args.json, args.type, args.fnout)
 
+    #L.debug("conf=" + str(conf))
 
+    if not setup_network_equipment(conf, reset=not args.noreset, command=args.c, resume=args.resume, force=args.force):
+        return 1
+    return 0
 
+if __name__ == '__main__':
+    sys.exit(main())
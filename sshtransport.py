@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the SSH transport with a persistent master connection
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import os
+import subprocess
+import logging as L
+
+from hwprofile import get_cache_dir
+from consoledrain import DrainedSpawn
+
+## SshTransport Class
+#
+#  The OpenSSH client keeps a master connection to the device (ControlMaster),
+#  the interactive shell and each of the commands run in their own channels of the master connection,
+#  so there's only one handshake and login for each device.
+class SshTransport():
+    def __init__(self, host, port=22, user='root', identity=None, options=None, control_dir=None, persist=600):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.identity = identity
+        # the extra options of ssh, such as ['StrictHostKeyChecking=no']
+        self.options = options if options else ['StrictHostKeyChecking=accept-new']
+        if not control_dir:
+            control_dir = get_cache_dir('ssh')
+        self.control_dir = control_dir
+        # the seconds the master connection stays after the last channel was closed
+        self.persist = persist
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## the arguments of ssh to use the master connection
+    def get_ssh_args(self):
+        args = [ 'ssh', '-p', str(self.port), '-o', 'BatchMode=yes', '-o', 'ControlPath=' + os.path.join(self.control_dir, '%C') ]
+        if self.identity:
+            args += [ '-i', self.identity ]
+        for i in self.options:
+            args += [ '-o', i ]
+        args.append("{0}@{1}".format(self.user, self.host) if self.user else self.host)
+        return args
+
+    def _insert_args(self, extra):
+        args = self.get_ssh_args()
+        return args[:1] + extra + args[1:]
+
+    ## start the master connection in background
+    #  @param timeout The seconds to connect and log in.
+    def start(self, timeout=30):
+        try:
+            os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        except OSError as e:
+            L.error("unable to create '{0}': {1}".format(self.control_dir, e))
+            return False
+        args = self._insert_args([ '-f', '-N', '-o', 'ControlMaster=auto', '-o', 'ControlPersist={0}'.format(self.persist),
+            '-o', 'ConnectTimeout={0}'.format(timeout) ])
+        L.info("ssh to '{0}:{1}' ...".format(self.host, self.port))
+        try:
+            ret = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout + 5)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            L.error("unable to ssh to '{0}': {1}".format(self.host, e))
+            return False
+        if ret.returncode != 0:
+            L.error("unable to ssh to '{0}': {1}".format(self.host, ret.stderr.decode('UTF-8', errors='replace').strip()))
+            return False
+        return True
+
+    ## check if the master connection is running
+    def is_alive(self):
+        ret = subprocess.run(self._insert_args([ '-O', 'check' ]), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return ret.returncode == 0
+
+    ## stop the master connection
+    def stop(self):
+        subprocess.run(self._insert_args([ '-O', 'exit' ]), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    ## run a command in a new channel
+    #  @param cmd The shell command.
+    #  @param input The bytes to the stdin of the command, such as a script for 'sh -s'.
+    #  @param timeout The timeout in seconds, None to wait forever.
+    #  @return (rc, the bytes of stdout and stderr); rc is None if timeout.
+    def exec(self, cmd, input=None, timeout=None):
+        args = self.get_ssh_args() + [ cmd ]
+        try:
+            ret = subprocess.run(args, input=input, stdin=(None if input is not None else subprocess.DEVNULL),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            L.error("ssh exec timeout: {0}".format(cmd))
+            return (None, e.output if e.output else b'')
+        return (ret.returncode, ret.stdout)
+
+    ## start an interactive shell in a new channel
+    #  @return the pexpect spawn of the shell
+    def spawn_shell(self, timeout=600):
+        args = self._insert_args([ '-tt' ])
+        return DrainedSpawn(args[0], args[1:], timeout=timeout)
+
+if __name__ == '__main__':
+    import unittest
+    import shutil
+    import socket
+    import tempfile
+    import time
+    import getpass
+
+    SSHD = shutil.which('sshd') or ('/usr/sbin/sshd' if os.path.exists('/usr/sbin/sshd') else None)
+
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_ssh_args(self):
+            ssh = SshTransport('192.168.1.1', 2222, identity='/tmp/id_ed25519', control_dir='/tmp/ssh')
+            self.assertEqual(ssh.get_ssh_args(), [ 'ssh', '-p', '2222', '-o', 'BatchMode=yes', '-o', 'ControlPath=/tmp/ssh/%C',
+                '-i', '/tmp/id_ed25519', '-o', 'StrictHostKeyChecking=accept-new', 'root@192.168.1.1' ])
+            self.assertEqual(ssh._insert_args([ '-O', 'check' ])[:3], [ 'ssh', '-O', 'check' ])
+
+        @unittest.skipUnless(SSHD and shutil.which('ssh-keygen'), "sshd not found")
+        def test_local_sshd(self):
+            # a sshd on the loopback, logged in by the current user with a new key
+            with tempfile.TemporaryDirectory() as tmpdir:
+                for name in [ 'host_key', 'id_key' ]:
+                    subprocess.run([ 'ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', os.path.join(tmpdir, name) ], check=True)
+                shutil.copy(os.path.join(tmpdir, 'id_key.pub'), os.path.join(tmpdir, 'authorized_keys'))
+                with socket.socket() as s:
+                    s.bind(('127.0.0.1', 0))
+                    port = s.getsockname()[1]
+                with open(os.path.join(tmpdir, 'sshd_config'), 'w') as fp:
+                    fp.write("ListenAddress 127.0.0.1\nHostKey {0}/host_key\nAuthorizedKeysFile {0}/authorized_keys\n"
+                        "StrictModes no\nPidFile {0}/sshd.pid\nUsePAM no\n".format(tmpdir))
+                sshd = subprocess.Popen([ SSHD, '-D', '-p', str(port), '-f', os.path.join(tmpdir, 'sshd_config') ])
+                time.sleep(0.5)
+                ssh = SshTransport('127.0.0.1', port, user=getpass.getuser(), identity=os.path.join(tmpdir, 'id_key'),
+                    options=[ 'StrictHostKeyChecking=no', 'UserKnownHostsFile=/dev/null' ], control_dir=os.path.join(tmpdir, 'ctl'))
+                try:
+                    self.assertEqual(ssh.start(), True)
+                    self.assertEqual(ssh.is_alive(), True)
+                    self.assertEqual(ssh.exec('echo hello; exit 3'), (3, b'hello\n'))
+                    self.assertEqual(ssh.exec('sh -s', input=b'echo $((1+2))\n'), (0, b'3\n'))
+                    pexp = ssh.spawn_shell(timeout=5)
+                    pexp.sendline('echo "a""b"')
+                    pexp.expect('ab')
+                    pexp.close()
+                finally:
+                    ssh.stop()
+                    sshd.terminate()
+                    sshd.wait()
+
+    unittest.main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the graph of the setup steps, the host steps run while the device is busy
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import time
+import threading
+import logging as L
+import concurrent.futures
+
+## Step Class
+#
+#  A step of the setup. The step runs when all of its inputs are available, and provides its outputs to the later steps.
+#  The device steps talk to the device, they run one by one in the order they are added, in the caller's thread.
+#  The host steps, such as validating the config and rendering the scripts, run in the worker threads at the same time.
+class Step():
+    ## the constructor
+    #  @param name The name of the step.
+    #  @param func The function of the step, it's called with the inputs as the keyword arguments.
+    #         It returns False if failed; the value of the output if there's one output; a dict of the outputs if there are more.
+    #  @param inputs The names of the inputs.
+    #  @param outputs The names of the outputs.
+    #  @param host True if the step runs on the host only.
+    def __init__(self, name, func, inputs=(), outputs=(), host=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.host = host
+        # the seconds from the start of the graph, None if not run
+        self.tm_start = None
+        self.tm_end = None
+        # None if not run, True if done, False if failed
+        self.ok = None
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    def get_seconds(self):
+        if self.tm_start is None or self.tm_end is None:
+            return 0.0
+        return self.tm_end - self.tm_start
+
+## StepGraph Class
+#
+#  Run the steps by their inputs and outputs. The graph stops at the first failed step, the steps not started are skipped.
+class StepGraph():
+    def __init__(self, max_workers=4):
+        self.steps = []
+        self.max_workers = max_workers
+        self.tm_wall = 0.0
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## add a step, see Step()
+    #  @return the step
+    def add_step(self, name, func, inputs=(), outputs=(), host=False):
+        step = Step(name, func, inputs, outputs, host)
+        for i in self.steps:
+            if i.name == name:
+                raise ValueError("duplicated step '{0}'".format(name))
+            dup = set(i.outputs) & set(step.outputs)
+            if dup:
+                raise ValueError("the outputs {0} of step '{1}' are provided by step '{2}'".format(sorted(dup), name, i.name))
+        self.steps.append(step)
+        return step
+
+    ## check that all of the inputs are provided, and the device steps don't depend on the later device steps
+    def _check(self, values):
+        providers = {}
+        for step in self.steps:
+            for i in step.outputs:
+                providers[i] = step
+        for step in self.steps:
+            for i in step.inputs:
+                if not (i in values or i in providers):
+                    raise ValueError("the input '{0}' of step '{1}' is not provided".format(i, step.name))
+        # the host steps may depend on each other, find the cycles
+        def visit(step, path):
+            if step in path:
+                raise ValueError("circular steps: {0}".format(" -> ".join([ i.name for i in path[path.index(step):] ] + [step.name])))
+            for i in step.inputs:
+                if i in providers and not i in values:
+                    visit(providers[i], path + [step])
+        for step in self.steps:
+            visit(step, [])
+
+    def _run_step(self, step, values, tm_start):
+        step.tm_start = time.monotonic() - tm_start
+        try:
+            ret = step.func(**{ i: values[i] for i in step.inputs })
+        except Exception:
+            L.exception("step '{0}' error".format(step.name))
+            ret = False
+        step.tm_end = time.monotonic() - tm_start
+        if ret is False:
+            L.error("step '{0}' failed".format(step.name))
+            return False
+        if len(step.outputs) > 1:
+            missing = [ i for i in step.outputs if not (isinstance(ret, dict) and i in ret) ]
+            if missing:
+                L.error("step '{0}' doesn't provide {1}".format(step.name, missing))
+                return False
+            return { i: ret[i] for i in step.outputs }
+        return { i: ret for i in step.outputs }
+
+    ## run the steps
+    #  @param values The dict of the initial inputs, the outputs of the steps are added to it.
+    #  @return True if all of the steps are done
+    def run(self, values):
+        self._check(values)
+        tm_start = time.monotonic()
+        devices = [ i for i in self.steps if not i.host ]
+        hosts = [ i for i in self.steps if i.host ]
+        running = {}
+        failed = False
+        def is_ready(step):
+            return all(i in values for i in step.inputs)
+        def finish(step, outputs):
+            nonlocal failed
+            step.ok = outputs is not False
+            if step.ok:
+                values.update(outputs)
+            else:
+                failed = True
+        # the host steps are logged as the threads of the caller, see fleet.py
+        prefix = threading.current_thread().name + "-step"
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=prefix) as executor:
+            while not failed:
+                # the host steps start as soon as their inputs are ready
+                for step in [ i for i in hosts if is_ready(i) ]:
+                    hosts.remove(step)
+                    running[executor.submit(self._run_step, step, values.copy(), tm_start)] = step
+                if devices and is_ready(devices[0]):
+                    step = devices.pop(0)
+                    finish(step, self._run_step(step, values, tm_start))
+                    # collect the host steps done while the device was busy
+                    for future in [ i for i in running if i.done() ]:
+                        finish(running.pop(future), future.result())
+                    continue
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    finish(running.pop(future), future.result())
+            for future in concurrent.futures.as_completed(list(running)):
+                finish(running.pop(future), future.result())
+        self.tm_wall = time.monotonic() - tm_start
+        if failed:
+            return False
+        if devices or hosts:
+            L.error("steps not run: {0}".format([ i.name for i in devices + hosts ]))
+            return False
+        return True
+
+    ## get the seconds saved by running the host steps while the device is busy
+    def get_saved_seconds(self):
+        return max(0.0, sum(i.get_seconds() for i in self.steps) - self.tm_wall)
+
+    ## get the timing report of the steps
+    def get_report(self):
+        lines = [ "{0:<16} {1:<6} {2:<8} {3:>9} {4:>9}".format("STEP", "KIND", "RESULT", "START", "SECONDS") ]
+        for i in self.steps:
+            result = "skipped" if i.ok is None else ("ok" if i.ok else "FAILED")
+            start = "" if i.tm_start is None else "{0:.1f}".format(i.tm_start)
+            lines.append("{0:<16} {1:<6} {2:<8} {3:>9} {4:>9.1f}".format(i.name, "host" if i.host else "device", result, start, i.get_seconds()))
+        lines.append("{0:.1f} seconds wall time, {1:.1f} seconds saved by the overlapped host steps".format(self.tm_wall, self.get_saved_seconds()))
+        return "\n".join(lines)
+
+if __name__ == '__main__':
+    import unittest
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_overlap(self):
+            calls = []
+            def device_step(name, delay, value=True):
+                def func(**kwargs):
+                    calls.append(name)
+                    time.sleep(delay)
+                    return value
+                return func
+            def render(plan, info):
+                time.sleep(0.3)
+                return "{0}-{1}".format(plan, info)
+            graph = StepGraph()
+            graph.add_step('show_info', device_step('show_info', 0.05), outputs=['info'])
+            graph.add_step('validate', lambda configs: { 'plan': configs['layout'], 'ports': [1, 2] }, inputs=['configs'], outputs=['plan', 'ports'], host=True)
+            graph.add_step('render', render, inputs=['plan', 'info'], outputs=['script'], host=True)
+            graph.add_step('reset', device_step('reset', 0.3), inputs=['info'], outputs=['reset'])
+            graph.add_step('set_layout', lambda script, reset: script, inputs=['script', 'reset'], outputs=['layout'])
+            values = { 'configs': { 'layout': 'vlans' } }
+            self.assertEqual(graph.run(values), True)
+            self.assertEqual((values['layout'], values['ports']), ('vlans-True', [1, 2]))
+            self.assertEqual(calls, ['show_info', 'reset'])
+            # the rendering overlaps the reset
+            self.assertLess(graph.tm_wall, 0.55)
+            self.assertGreater(graph.get_saved_seconds(), 0.2)
+            self.assertIn("render           host   ok", graph.get_report())
+
+        def test_failure(self):
+            calls = []
+            graph = StepGraph()
+            graph.add_step('show_info', lambda: calls.append('show_info') or True, outputs=['info'])
+            graph.add_step('validate', lambda: False, outputs=['plan'], host=True)
+            graph.add_step('reset', lambda info: time.sleep(0.1) or calls.append('reset') or True, inputs=['info'], outputs=['reset'])
+            graph.add_step('set_layout', lambda plan, reset: True, inputs=['plan', 'reset'])
+            self.assertEqual(graph.run({}), False)
+            self.assertNotIn('set_layout', calls)
+            self.assertEqual(graph.steps[3].ok, None)
+            self.assertIn("skipped", graph.get_report())
+
+        def test_check(self):
+            graph = StepGraph()
+            graph.add_step('a', lambda b: True, inputs=['b'], outputs=['a'], host=True)
+            graph.add_step('b', lambda a: True, inputs=['a'], outputs=['b'], host=True)
+            self.assertRaises(ValueError, graph.run, {})
+            self.assertRaises(ValueError, graph.add_step, 'c', lambda: True, outputs=['a'])
+            graph = StepGraph()
+            graph.add_step('a', lambda x: True, inputs=['x'])
+            self.assertRaises(ValueError, graph.run, {})
+
+    unittest.main()
@@ -11,7 +11,23 @@ __version__ = 'v0.1.1'
 __license__ = 'GPLv3'
 
 import os
+import time
+import functools
 import pexpect
+from expectset import get_pattern_set, expect_pattern_set, DEFAULT_SEARCH_WINDOW
+from timeoutmodel import TimeoutModel, DEFAULT_TIMEOUTS
+from retrypolicy import RetryPolicy
+from journal import Journal
+
+import re
+import logging
+L = logging.getLogger('switch')
+
+# the fingerprint of the config applied is stored on the device as the prefix followed by the digest
+FINGERPRINT_PREFIX = 'agilenet-config-'
+# the whole fingerprint in the device output, the digest is of 16 hex digits, see journal.get_digest();
+# it's followed by the end of the line (or the quote of the CLI), so a partly received digest is not matched
+FINGERPRINT_PATTERN = re.escape(FINGERPRINT_PREFIX) + r'([0-9a-f]{16})"?[\r\n]'
 
 ## Switch Class
 #
@@ -22,9 +38,143 @@ class Switch():
         self._pexp = None
         self._has_hw = False
         self._is_gns3 = True
+        # the session-scoped cache of the device facts, such as hostname, version, model
+        self._facts = {}
+        self._facts_hits = 0
+        self._facts_misses = 0
+        # the latency history of the device, see set_timeout_model()
+        self.timeouts = TimeoutModel()
+        # the counters of the retries, {policy name: {'attempts', 'retries', 'failures'}}
+        self._retry_stats = {}
+        # the steps done on the device, to resume an interrupted run, see set_journal()
+        self.journal = Journal()
     def __str__(self):
         return self.__class__.__name__
 
+    # the search window in bytes of expect(), None to search the whole output
+    searchwindowsize = DEFAULT_SEARCH_WINDOW
+
+    ## wait for the patterns in the device output
+    #  The patterns are compiled once per driver class and matched on bytes, see expectset.py.
+    #  @param self The object pointer.
+    #  @param patterns A pattern or a list of the patterns, the same as pexpect.expect().
+    #  @param timeout The timeout in seconds, -1 for the default timeout of the connection, None to block.
+    #  @return the index of the matched pattern
+    def expect(self, patterns, timeout=None):
+        pattern_set = get_pattern_set(self.__class__.__name__, patterns)
+        return expect_pattern_set(self.pexp, pattern_set, timeout=timeout, searchwindowsize=self.searchwindowsize)
+
+    ## set the latency history of the device, such as TimeoutModel('openwrtuci-/dev/ttyUSB0') stored in the cache directory
+    #  @param self The object pointer.
+    #  @param model The TimeoutModel.
+    def set_timeout_model(self, model):
+        self.timeouts = model
+
+    ## set the journal of the steps done on the device, such as Journal('openwrtuci-/dev/ttyUSB0') stored in the cache directory
+    #  @param self The object pointer.
+    #  @param journal The Journal.
+    def set_journal(self, journal):
+        self.journal = journal
+
+    ## get the timeout of a class of the operations, learned from the latency history of the device
+    #  @param self The object pointer.
+    #  @param name The class of the operation, such as 'prompt', 'show', 'commit', 'reboot', 'opkg', see timeoutmodel.py.
+    #  @param default The timeout if the device has no history of the class.
+    def get_timeout(self, name, default=None):
+        return self.timeouts.get_timeout(name, default)
+
+    ## get the interval of polling the device, it's shorter for the fast devices
+    #  @param self The object pointer.
+    #  @param name The class of the operation.
+    #  @param default The interval if the device has no history of the class.
+    def get_poll_interval(self, name, default):
+        return self.timeouts.get_poll_interval(name, default)
+
+    ## record the latency of an operation finished in time
+    #  @param self The object pointer.
+    #  @param name The class of the operation.
+    #  @param seconds The latency.
+    def record_latency(self, name, seconds):
+        self.timeouts.record(name, seconds)
+
+    ## expect() with the learned timeout of the class, the latency is recorded if a pattern is matched
+    #  pexpect.TIMEOUT is raised if it's not in the patterns, so the learned timeout of such a wait is not less than
+    #  the default: an operation slower than usual, such as a slow download, doesn't fail, it's only waited less if handled.
+    #  @param self The object pointer.
+    #  @param name The class of the operation.
+    #  @param patterns The patterns, see expect().
+    #  @param default The timeout if the device has no history of the class.
+    #  @param tm_start The start time (time.monotonic()) of the operation, the time of calling this function if not set.
+    def timed_expect(self, name, patterns, default=None, tm_start=None):
+        if tm_start is None:
+            tm_start = time.monotonic()
+        lst = patterns if isinstance(patterns, list) else [patterns]
+        timeout = self.get_timeout(name, default)
+        if not pexpect.TIMEOUT in lst:
+            timeout = max(timeout, DEFAULT_TIMEOUTS[name] if default is None else default)
+        ret = self.expect(patterns, timeout=timeout)
+        if not lst[ret] in (pexpect.EOF, pexpect.TIMEOUT):
+            self.record_latency(name, time.monotonic() - tm_start)
+        return ret
+
+    ## run an operation with the retry policy, and count the retries
+    #  @param self The object pointer.
+    #  @param policy The RetryPolicy.
+    #  @param func The operation.
+    #  @param classify The function to get the outcome from the return value of func, see RetryPolicy.run().
+    #  @return (True, the last return value) if succeeded, (False, the last return value or the exception) if not.
+    def retry(self, policy, func, classify=None):
+        assert (isinstance(policy, RetryPolicy))
+        return policy.run(func, classify, self._retry_stats.setdefault(policy.name, {}))
+
+    ## get the counters of the retries
+    #  @param self The object pointer.
+    #  @return a dict of {policy name: {'attempts': x, 'retries': y, 'failures': z}}
+    def get_retry_stats(self):
+        return self._retry_stats
+
+    ## get a fact from the cache, or probe the device and cache the value
+    #  @param self The object pointer.
+    #  @param name The name of the fact, such as 'hostname'.
+    #  @param probe The function to get the value from the device.
+    def get_fact(self, name, probe):
+        if name in self._facts:
+            self._facts_hits += 1
+            return self._facts[name]
+        self._facts_misses += 1
+        value = probe()
+        self._facts[name] = value
+        return value
+
+    ## get a group of facts, probe them all at once if any of them is not in the cache
+    #  @param self The object pointer.
+    #  @param names The list of the fact names.
+    #  @param probe The function to get a dict of the facts from the device.
+    def get_facts(self, names, probe):
+        if all(i in self._facts for i in names):
+            self._facts_hits += 1
+            return { i: self._facts[i] for i in names }
+        self._facts_misses += 1
+        facts = probe()
+        self._facts.update(facts)
+        return facts
+
+    ## remove facts from the cache, it should be called by the functions which change the device state
+    #  @param self The object pointer.
+    #  @param names The fact names to be removed; remove all of the facts if not set.
+    def invalidate_facts(self, *names):
+        if not names:
+            self._facts.clear()
+            return
+        for i in names:
+            self._facts.pop(i, None)
+
+    ## get the counters of the facts cache
+    #  @param self The object pointer.
+    #  @return a dict of {'hits': x, 'misses': y}, the hits are the device round trips saved.
+    def get_facts_stats(self):
+        return { 'hits': self._facts_hits, 'misses': self._facts_misses }
+
     ## Check/Set if this device is for GNS3 network simulator
     #  @param self The object pointer.
     #  @param value A boolean value indicate the status.
@@ -66,6 +216,151 @@ class Switch():
         raise NotImplementedError()
         return False
 
+    ## check if the device need to reboot to make the saved config take effect
+    #  @param self The object pointer.
+    def needs_reboot(self):
+        return True
+
+    ## get the fingerprint of the config applied to the device, see set_config_fingerprint()
+    #  @param self The object pointer.
+    #  @return the digest, or None if not found or not supported by the device
+    def get_config_fingerprint(self):
+        return None
+
+    ## store the fingerprint of the config applied to the device, it's read back in one round trip by the next run
+    #  The fingerprint may be in the running config only, it's saved by save_config().
+    #  @param self The object pointer.
+    #  @param digest The digest of the config, None to remove the fingerprint.
+    #  @return False if not supported by the device
+    def set_config_fingerprint(self, digest):
+        return False
+
+    ## run a show command on the CLI and get the config fingerprint in its output, see get_config_fingerprint()
+    #  The pending output is discarded and the echo of the command is expected first,
+    #  so the stale prompts left in the buffer, such as by _enter_enable(), are not taken as the end of the output.
+    #  @param self The object pointer.
+    #  @param cmd The show command, such as 'sh run | i snmp-server location'.
+    #  @return the digest, or None if not found
+    def _show_config_fingerprint(self, cmd):
+        pexpect_clean_buffer(self.pexp)
+        self.pexp.sendline(cmd + "\r\n")
+        self.expect(re.escape(cmd))
+        ret = self.expect([FINGERPRINT_PATTERN, '[\r\n][^\r\n]*#'])
+        if ret != 0:
+            return None
+        digest = parse_config_fingerprint(self.pexp.after.decode('UTF-8'))
+        self.expect('#')
+        return digest
+
+    ## start a session on the device, it's called once the connection is established
+    #  @param self The object pointer.
+    def begin_session(self):
+        return True
+
+    ## end the session, restore the terminal settings changed by begin_session()
+    #  @param self The object pointer.
+    def end_session(self):
+        return True
+
+    # the console speed after login, see upshift_console(); 0 to keep the speed
+    console_baud = 0
+    # restore the original console speed at the end, see restore_console()
+    console_restore = True
+    # the console speed is saved by save_config(), such as 'line con 0 / speed' of IOS
+    console_speed_saved = False
+    # the seconds for the device to finish the output at the old speed
+    console_settle_time = 1.0
+    # the console speed before upshift_console(), None if not changed
+    _console_baud_orig = None
+    # the prompt to verify the console after the speed is changed
+    console_prompt = r"\n[\w@:/~().-]+ ?[#>$] ?"
+
+    ## send the commands to change the console speed of the device, implemented by the drivers
+    #  The device changes the speed once the last command is sent, the response is not read.
+    #  @param self The object pointer.
+    #  @param baud The new baud rate.
+    #  @return False if not supported
+    def _send_console_speed(self, baud):
+        return False
+
+    ## check if the prompt appears at the current speed of the serial port
+    #  @param self The object pointer.
+    def _verify_console(self):
+        self.pexp.discard_pending()
+        for i in range(3):
+            self.pexp.sendline("")
+            if self.expect([self.console_prompt, pexpect.TIMEOUT], timeout=2) == 0:
+                return True
+        return False
+
+    ## change the console speed of the device and the serial port, fall back to the old speed if the prompt is not found
+    #  @param self The object pointer.
+    #  @param baud The new baud rate.
+    #  @return True if the console works at the new speed
+    def _change_console_speed(self, baud):
+        baud_old = self._get_console_baudrate()
+        if not baud_old:
+            L.info("the connection is not a serial port, keep the console speed")
+            return False
+        if baud_old == baud:
+            return True
+        if not self._send_console_speed(baud):
+            L.info("{0} doesn't support changing the console speed".format(str(self)))
+            return False
+        time.sleep(self.console_settle_time)
+        self.pexp.set_baudrate(baud)
+        if self._verify_console():
+            L.info("the console speed changed from {0} to {1}".format(baud_old, baud))
+            return True
+        L.warning("not found the prompt at {0}, fall back to {1}".format(baud, baud_old))
+        self.pexp.set_baudrate(baud_old)
+        if not self._verify_console():
+            L.error("the console is lost at both {0} and {1}".format(baud, baud_old))
+        return False
+
+    ## raise the console speed after login, so the later commands run faster on the slow consoles
+    #  @param self The object pointer.
+    #  @param baud The new baud rate, console_baud if not set.
+    def upshift_console(self, baud=0):
+        if not baud:
+            baud = self.console_baud
+        if not baud:
+            return False
+        baud_old = self._get_console_baudrate()
+        if not self._change_console_speed(baud):
+            return False
+        if not self._console_baud_orig:
+            self._console_baud_orig = baud_old
+        return True
+
+    ## the baud rate of the serial port, None if the connection is not a serial port
+    def _get_console_baudrate(self):
+        get_baudrate = getattr(self.pexp, 'get_baudrate', None)
+        return get_baudrate() if get_baudrate else None
+
+    ## check if the console speed was changed by upshift_console()
+    #  @param self The object pointer.
+    def get_console_upshifted(self):
+        return self._console_baud_orig is not None
+    console_upshifted = property(get_console_upshifted)
+
+    ## restore the console speed changed by upshift_console()
+    #  @param self The object pointer.
+    #  @param force Restore the speed even if console_restore is not set, such as before a reboot.
+    def restore_console(self, force=False):
+        if not self.console_upshifted or not (force or self.console_restore):
+            return True
+        if not self._change_console_speed(self._console_baud_orig):
+            return False
+        self._console_baud_orig = None
+        return True
+
+    ## get the basic facts of the device
+    #  @param self The object pointer.
+    #  @return a dict with keys 'board', 'model', 'version', 'hostname'
+    def collect_facts(self):
+        return { 'board': self.get_board(), 'model': self.get_model_name(), 'version': self.get_version(), 'hostname': self.get_hostname() }
+
     ## get the device board info
     #  @param self The object pointer.
     def get_board(self):
@@ -138,9 +433,26 @@ class Switch():
         return False
 
 
+## the decorator to cache the return value of a device getter in the facts cache
+#  @param name The name of the fact.
+def cached_fact(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            return self.get_fact(name, lambda: func(self, *args, **kwargs))
+        return wrapper
+    return decorator
+
 # pexpect clean buffer
 def pexpect_clean_buffer(pexp):
     #return # ignore
+    # the console is read in background, just move the cursor, see consoledrain.py
+    discard = getattr(pexp, 'discard_pending', None)
+    if discard:
+        dropped = discard()
+        if dropped is not None:
+            print('clear_buffer(): discard {0} bytes'.format(dropped))
+            return
     buff = None
     try:
         buff = pexp.read_nonblocking(16384, timeout = 1)
@@ -150,6 +462,9 @@ def pexpect_clean_buffer(pexp):
 
 # pexpect clean buffer
 def pexpect_clean_buffer2(pexp):
+    discard = getattr(pexp, 'discard_pending', None)
+    if discard and (discard() is not None):
+        return
     flushedStuff = ''
     try:
         while not pexp.expect(r'.+', timeout=2):
@@ -164,6 +479,14 @@ def port_vlan_to_lists(port_vlan):
     vlan_list = [port_vlan[i] for i in port_list]
     return [port_list, vlan_list]
 
+## get the digest of the config fingerprint in the device output, see Switch.get_config_fingerprint()
+#  @param text The output, such as 'snmp-server location agilenet-config-0123456789abcdef\r\n'.
+def parse_config_fingerprint(text):
+    m = re.search(FINGERPRINT_PATTERN, text)
+    if not m:
+        return None
+    return m.group(1)
+
 def get_timezone():
     import time
     print(f"get timezone={time.tzname}")
@@ -177,6 +500,14 @@ if __name__ == '__main__':
         def tearDown(self):
             pass
 
+        def test_parse_config_fingerprint(self):
+            self.assertEqual(parse_config_fingerprint('snmp-server location "agilenet-config-0123456789abcdef"\r\n'), '0123456789abcdef')
+            self.assertEqual(parse_config_fingerprint('agilenet-config-0123456789abcdef\n'), '0123456789abcdef')
+            # a partly received digest
+            self.assertEqual(parse_config_fingerprint('agilenet-config-0123456789ab'), None)
+            self.assertEqual(parse_config_fingerprint('agilenet-config-0123456789abcdef'), None)
+            self.assertEqual(parse_config_fingerprint('snmp-server location lab\r\n'), None)
+
         def test_portvlan2lists_corner(self):
             port_vlan = {}
             self.assertEqual(port_vlan_to_lists(port_vlan), None)
@@ -221,4 +552,99 @@ if __name__ == '__main__':
             import time
             self.assertEqual(time.tzname, get_timezone())
 
+        def test_facts_cache(self):
+            class MySwitch(Switch):
+                probe_count = 0
+                @cached_fact('hostname')
+                def get_hostname(self):
+                    self.probe_count += 1
+                    return 'sw1'
+            sw = MySwitch()
+            self.assertEqual(sw.get_hostname(), 'sw1')
+            self.assertEqual(sw.get_hostname(), 'sw1')
+            self.assertEqual(sw.probe_count, 1)
+            self.assertEqual(sw.get_facts_stats(), { 'hits': 1, 'misses': 1 })
+            sw.invalidate_facts('hostname')
+            self.assertEqual(sw.get_hostname(), 'sw1')
+            self.assertEqual(sw.probe_count, 2)
+
+            # a group of facts probed in one round trip
+            self.assertEqual(sw.get_facts(['hostname', 'version'], lambda: { 'hostname': 'sw2', 'version': '1.0' }), { 'hostname': 'sw2', 'version': '1.0' })
+            self.assertEqual(sw.get_facts(['version'], lambda: None), { 'version': '1.0' })
+            self.assertEqual(sw.get_hostname(), 'sw2')
+            sw.invalidate_facts()
+            self.assertEqual(sw.get_hostname(), 'sw1')
+            self.assertEqual(sw.get_facts_stats(), { 'hits': 3, 'misses': 4 })
+
+        def test_upshift_console(self):
+            # the prompt is found only if the serial port and the device run at the same speed
+            class FakePexpect():
+                def __init__(self):
+                    self.baud = 9600
+                    self.device_baud = 9600
+                def get_baudrate(self):
+                    return self.baud
+                def set_baudrate(self, baud):
+                    self.baud = baud
+                def discard_pending(self):
+                    return 0
+                def sendline(self, line):
+                    pass
+                def expect(self, patterns, timeout=-1):
+                    return 0 if self.baud == self.device_baud else 1
+            class MySwitch(Switch):
+                console_settle_time = 0
+                max_baud = 115200
+                def _send_console_speed(self, baud):
+                    if baud <= self.max_baud:
+                        self.pexp.device_baud = baud
+                    return True
+            sw = MySwitch()
+            sw.pexp = FakePexpect()
+            self.assertEqual(sw.upshift_console(), False)
+            self.assertEqual(sw.upshift_console(115200), True)
+            self.assertEqual((sw.pexp.baud, sw.console_upshifted), (115200, True))
+            self.assertEqual(sw.restore_console(), True)
+            self.assertEqual((sw.pexp.baud, sw.pexp.device_baud, sw.console_upshifted), (9600, 9600, False))
+            # fall back to the old speed if the device doesn't change the speed
+            self.assertEqual(sw.upshift_console(230400), False)
+            self.assertEqual((sw.pexp.baud, sw.console_upshifted), (9600, False))
+            # keep the speed at the end
+            sw.console_restore = False
+            self.assertEqual(sw.upshift_console(115200), True)
+            self.assertEqual(sw.restore_console(), True)
+            self.assertEqual(sw.pexp.baud, 115200)
+            self.assertEqual(sw.restore_console(force=True), True)
+            self.assertEqual(sw.pexp.baud, 9600)
+
+        def test_timed_expect(self):
+            class MySwitch(Switch):
+                ret = 0
+                timeouts_used = []
+                def expect(self, patterns, timeout=None):
+                    self.timeouts_used.append(timeout)
+                    return self.ret
+            sw = MySwitch()
+            responses = [">", "#", pexpect.EOF, pexpect.TIMEOUT]
+            # the default timeout until the device has enough history
+            for i in range(5):
+                self.assertEqual(sw.timed_expect('prompt', responses, 5), 0)
+            self.assertEqual(sw.timeouts_used, [5] * 5)
+            self.assertEqual(sw.timeouts.get_stats()['prompt']['count'], 5)
+            self.assertEqual(sw.get_timeout('prompt', 5), 1)
+            # the timeouts are not recorded
+            sw.ret = 3
+            sw.timed_expect('prompt', responses, 5)
+            self.assertEqual(sw.timeouts.get_stats()['prompt']['count'], 5)
+            self.assertEqual(sw.timeouts_used[-1], 1)
+            # the wait without pexpect.TIMEOUT is not shorter than the default
+            for i in range(5):
+                sw.record_latency('reboot', 40)
+            self.assertEqual(sw.get_timeout('reboot'), 80)
+            sw.ret = 0
+            sw.timed_expect('reboot', 'Please press Enter to activate this console.')
+            self.assertEqual(sw.timeouts_used[-1], 600)
+            sw.timed_expect('reboot', ['login:', pexpect.TIMEOUT])
+            self.assertEqual(sw.timeouts_used[-1], 80)
+
     unittest.main()
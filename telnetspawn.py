@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the built-in telnet client for pexpect
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import asyncio
+import threading
+import logging as L
+
+import pexpect
+from pexpect.spawnbase import SpawnBase
+
+from consoledrain import RingBuffer, DEFAULT_RING_SIZE
+
+# the telnet commands, RFC 854
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+# the telnet options
+OPT_BINARY = 0  # RFC 856
+OPT_ECHO = 1    # RFC 857
+OPT_SGA = 3     # RFC 858, suppress go ahead
+
+## TelnetCodec Class
+#
+#  The minimal telnet option negotiation of a console client:
+#  the binary mode in both directions, the server echoes and suppresses go-ahead, all of the other options are refused.
+class TelnetCodec():
+    # the options the peer may enable (WILL) and the options we enable (DO)
+    REMOTE_OPTIONS = (OPT_BINARY, OPT_ECHO, OPT_SGA)
+    LOCAL_OPTIONS = (OPT_BINARY, OPT_SGA)
+
+    def __init__(self):
+        self.remote = {} # the options enabled by the peer
+        self.local = {}  # the options enabled by us
+        self._cmd = None # the pending command, such as WILL, waiting for the option byte
+        self._state = 0  # 0: data, 1: IAC, 2: the option of a command, 3: subnegotiation, 4: IAC in subnegotiation
+        self._cr = False # the last data byte is CR
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## the requests sent once connected
+    def get_negotiation(self):
+        self.remote[OPT_BINARY] = True
+        self.remote[OPT_SGA] = True
+        self.local[OPT_BINARY] = True
+        return bytes([IAC, DO, OPT_BINARY, IAC, WILL, OPT_BINARY, IAC, DO, OPT_SGA])
+
+    ## escape the data to be sent
+    def encode(self, data):
+        return data.replace(b'\xff', b'\xff\xff')
+
+    def _negotiate(self, cmd, opt):
+        if cmd == WILL:
+            if opt in self.REMOTE_OPTIONS:
+                if not self.remote.get(opt):
+                    self.remote[opt] = True
+                    return bytes([IAC, DO, opt])
+                return b''
+            return bytes([IAC, DONT, opt])
+        if cmd == WONT:
+            if self.remote.get(opt):
+                self.remote[opt] = False
+                return bytes([IAC, DONT, opt])
+            return b''
+        if cmd == DO:
+            if opt in self.LOCAL_OPTIONS:
+                if not self.local.get(opt):
+                    self.local[opt] = True
+                    return bytes([IAC, WILL, opt])
+                return b''
+            return bytes([IAC, WONT, opt])
+        # DONT
+        if self.local.get(opt):
+            self.local[opt] = False
+            return bytes([IAC, WONT, opt])
+        return b''
+
+    ## decode the received data
+    #  @param data The bytes from the socket, the commands may be split across the calls.
+    #  @return (the payload, the reply to the peer)
+    def decode(self, data):
+        payload = bytearray()
+        reply = bytearray()
+        for c in data:
+            if self._state == 0:
+                if c == IAC:
+                    self._state = 1
+                elif c == 0 and self._cr:
+                    # CR NUL is CR in the NVT mode
+                    self._cr = False
+                else:
+                    payload.append(c)
+                    self._cr = (c == 13)
+            elif self._state == 1:
+                if c == IAC:
+                    payload.append(c)
+                    self._state = 0
+                elif c in (WILL, WONT, DO, DONT):
+                    self._cmd = c
+                    self._state = 2
+                elif c == SB:
+                    self._state = 3
+                else:
+                    # NOP, GA, ...
+                    self._state = 0
+            elif self._state == 2:
+                reply += self._negotiate(self._cmd, c)
+                self._state = 0
+            elif self._state == 3:
+                if c == IAC:
+                    self._state = 4
+            else:
+                # the subnegotiations are not supported, skip them
+                self._state = 0 if c == SE else 3
+        return (bytes(payload), bytes(reply))
+
+## the event loop thread shared by all of the telnet connections
+_telnet_loop = None
+_telnet_loop_lock = threading.Lock()
+
+def get_telnet_loop():
+    global _telnet_loop
+    with _telnet_loop_lock:
+        if _telnet_loop is None:
+            _telnet_loop = asyncio.new_event_loop()
+            threading.Thread(target=_telnet_loop.run_forever, name="telnet-loop", daemon=True).start()
+        return _telnet_loop
+
+## TelnetSpawn Class
+#
+#  A pexpect spawn of a telnet connection without the telnet binary.
+#  All of the connections run in one asyncio event loop thread, the received data is kept in a ring buffer,
+#  so the console is always drained like the DrainedSpawn.
+class TelnetSpawn(SpawnBase):
+    def __init__(self, host, port, timeout=30, maxread=2000, logfile=None, connect_timeout=10, capacity=DEFAULT_RING_SIZE):
+        super().__init__(timeout=timeout, maxread=maxread, logfile=logfile)
+        self.host = host
+        self.port = port
+        self.codec = TelnetCodec()
+        self.ring = RingBuffer(capacity)
+        self._seq = 0
+        self._writer = None
+        self._task = None
+        self._loop = get_telnet_loop()
+        self.closed = True
+        future = asyncio.run_coroutine_threadsafe(self._connect(), self._loop)
+        try:
+            future.result(connect_timeout)
+        except Exception as e:
+            future.cancel()
+            raise pexpect.EOF("unable to connect to '{0}:{1}': {2}".format(host, port, e))
+        self.closed = False
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    async def _connect(self):
+        reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._writer.write(self.codec.get_negotiation())
+        self._task = self._loop.create_task(self._read_loop(reader))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                payload, reply = self.codec.decode(data)
+                if reply:
+                    self._writer.write(reply)
+                if payload:
+                    self.ring.write(payload)
+        except OSError as e:
+            L.error("telnet '{0}:{1}': {2}".format(self.host, self.port, e))
+        finally:
+            self.ring.set_eof()
+
+    def _write(self, data):
+        if not self._writer.is_closing():
+            self._writer.write(data)
+
+    def send(self, s):
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        b = self._encoder.encode(s, final=False)
+        if self.closed or self.ring.eof:
+            raise pexpect.EOF('The telnet connection is closed.')
+        self._loop.call_soon_threadsafe(self._write, self.codec.encode(b))
+        return len(b)
+
+    def sendline(self, s=''):
+        s = self._coerce_send_string(s)
+        return self.send(s + self.linesep)
+
+    def write(self, s):
+        self.send(s)
+
+    ## send a control character, such as 'c' for Ctrl-C
+    def sendcontrol(self, char):
+        char = char.lower()
+        if 'a' <= char <= 'z':
+            return self.send(bytes([ord(char) - ord('a') + 1]))
+        ctrl = {'@': 0, '`': 0, '[': 27, '{': 27, '\\': 28, '|': 28, ']': 29, '}': 29, '^': 30, '~': 30, '_': 31, '?': 127}
+        if not char in ctrl:
+            return 0
+        return self.send(bytes([ctrl[char]]))
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if timeout == -1:
+            timeout = self.timeout
+        data, self._seq, dropped = self.ring.read(self._seq, size, timeout)
+        if dropped > 0:
+            L.warning("telnet: the ring buffer is full, {0} bytes lost".format(dropped))
+        if data is None:
+            self.flag_eof = True
+            raise pexpect.EOF('End Of File (EOF). The telnet connection is closed.')
+        if not data:
+            raise pexpect.TIMEOUT('Timeout exceeded.')
+        s = self._decoder.decode(data, final=False)
+        self._log(s, 'read')
+        return s
+
+    ## drop all of the received data not matched yet, see ConsoleDrainMixin.discard_pending()
+    #  @return the number of bytes dropped
+    def discard_pending(self):
+        seq_end = self.ring.seq_end
+        dropped = seq_end - self._seq + len(self.buffer)
+        self._seq = seq_end
+        self.buffer = self.string_type()
+        self._before = self.buffer_type()
+        return dropped
+
+    ## the connection is always drained, for the compatibility of DrainedSpawn
+    def start_drain(self):
+        pass
+
+    def isalive(self):
+        return not self.closed and not self.ring.eof
+
+    async def _close(self):
+        self._writer.close()
+        if self._task:
+            await asyncio.wait([self._task], timeout=1)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._writer:
+            future = asyncio.run_coroutine_threadsafe(self._close(), self._loop)
+            try:
+                future.result(2)
+            except Exception as e:
+                L.warning("telnet '{0}:{1}': {2}".format(self.host, self.port, e))
+
+## TelnetStandIn Class
+#
+#  A local telnet server like the console server for the tests and the benchmark:
+#  it negotiates the options, then echoes each line followed by the prompt.
+class TelnetStandIn():
+    def __init__(self, prompt=b"root@OpenWrt:/# ", banner=b"Please press Enter to activate this console.\r\n"):
+        self.prompt = prompt
+        self.banner = banner
+        self.port = None
+        self._server = None
+        self._loop = get_telnet_loop()
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    ## start the server at a free local port, return the port
+    def start(self):
+        future = asyncio.run_coroutine_threadsafe(asyncio.start_server(self._handle, '127.0.0.1', 0), self._loop)
+        self._server = future.result(5)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    def stop(self):
+        if self._server:
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._server = None
+
+    ## the output of a command line
+    def get_output(self, line):
+        if line == b"iac":
+            # the binary data should be escaped
+            return b"\xff\xfe\r\n"
+        return b""
+
+    async def _handle(self, reader, writer):
+        codec = TelnetCodec()
+        # the server echoes
+        codec.LOCAL_OPTIONS = (OPT_BINARY, OPT_ECHO, OPT_SGA)
+        codec.local[OPT_ECHO] = True
+        codec.local[OPT_SGA] = True
+        writer.write(bytes([IAC, WILL, OPT_ECHO, IAC, WILL, OPT_SGA, IAC, DO, 24]) + self.banner)
+        line = bytearray()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                payload, reply = codec.decode(data)
+                writer.write(reply)
+                for c in payload:
+                    if c in (10, 13):
+                        out = bytes(line) + b"\r\n" + self.get_output(bytes(line)) + self.prompt
+                        writer.write(codec.encode(out))
+                        line = bytearray()
+                    else:
+                        line.append(c)
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+if __name__ == '__main__':
+    import unittest
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_codec(self):
+            codec = TelnetCodec()
+            self.assertEqual(codec.get_negotiation(), bytes([IAC, DO, OPT_BINARY, IAC, WILL, OPT_BINARY, IAC, DO, OPT_SGA]))
+            # the server enables echo, SGA was requested already, the terminal type is refused
+            payload, reply = codec.decode(bytes([IAC, WILL, OPT_ECHO, IAC, WILL, OPT_SGA, IAC, DO, 24]) + b"login")
+            self.assertEqual(payload, b"login")
+            self.assertEqual(reply, bytes([IAC, DO, OPT_ECHO, IAC, WONT, 24]))
+            # the command split across the reads, the escaped IAC and CR NUL
+            self.assertEqual(codec.decode(b"a\xff"), (b"a", b""))
+            self.assertEqual(codec.decode(bytes([WONT, OPT_ECHO]) + b"\xff\xffb\r\x00c"), (b"\xffb\rc", bytes([IAC, DONT, OPT_ECHO])))
+            # the subnegotiation is skipped
+            self.assertEqual(codec.decode(bytes([IAC, SB, 24, 1, IAC, SE]) + b"d"), (b"d", b""))
+            self.assertEqual(codec.encode(b"\xff1"), b"\xff\xff1")
+
+        def test_spawn(self):
+            server = TelnetStandIn()
+            port = server.start()
+            try:
+                pexp = TelnetSpawn('127.0.0.1', port, timeout=5)
+                self.assertEqual(pexp.isalive(), True)
+                pexp.expect('Please press Enter')
+                pexp.sendline("")
+                pexp.expect('root@.*:/# ')
+                pexp.sendline("uci show system")
+                self.assertEqual(pexp.expect(['Entry not found', 'root@.*:/# ']), 1)
+                self.assertEqual(pexp.before, b"uci show system\r\n")
+                pexp.sendline("iac")
+                pexp.expect('root@.*:/# ')
+                self.assertEqual(pexp.before, b"iac\r\n\xff\xfe\r\n")
+                self.assertEqual(pexp.codec.remote.get(OPT_ECHO), True)
+                self.assertRaises(pexpect.TIMEOUT, pexp.read_nonblocking, 10, 0.1)
+                pexp.close()
+                self.assertEqual(pexp.isalive(), False)
+                self.assertRaises(pexpect.EOF, pexp.sendline, "")
+            finally:
+                server.stop()
+
+        def test_connect_failed(self):
+            server = TelnetStandIn()
+            port = server.start()
+            server.stop()
+            self.assertRaises(pexpect.EOF, TelnetSpawn, '127.0.0.1', port, 5, 2000, None, 2)
+
+    unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# encoding: utf8
+# -*- coding: utf-8 -*-
+#
+# the timeouts of the device operations learned from the history
+#
+# Copyright 2016-2021 Yunhui Fu <yhfudev@gmail.com>
+#
+__author__ = 'Yunhui Fu'
+__version__ = 'v0.1.1'
+__license__ = 'GPLv3'
+
+import os
+import re
+import json
+import logging as L
+
+from hwprofile import get_cache_dir
+
+# the default timeouts in seconds of the operation classes, used until the device has enough history
+DEFAULT_TIMEOUTS = {
+    'prompt': 5,    # wake the console and get the prompt
+    'show': 30,     # a show/query command
+    'commit': 120,  # save the config (uci commit)
+    'reboot': 600,  # from the reboot command to the login prompt
+    'firstboot': 900,   # the reboot after the factory reset, the overlay is formatted
+    'service': 120, # restart/reload a service, such as the network
+    'link': 60,     # the network links up after the reboot
+    'opkg': 600,    # update/install the packages
+}
+# the range of the learned timeouts
+MIN_TIMEOUTS = { 'prompt': 1, 'show': 5, 'commit': 10, 'reboot': 60, 'firstboot': 60, 'service': 10, 'link': 10, 'opkg': 60 }
+MAX_TIMEOUTS = { 'prompt': 30, 'show': 300, 'commit': 600, 'reboot': 1800, 'firstboot': 1800, 'service': 600, 'link': 300, 'opkg': 1800 }
+
+# the samples kept for each class
+MAX_SAMPLES = 100
+# the samples needed before the timeout is learned
+MIN_SAMPLES = 5
+# the weight of the new sample in the EWMA
+EWMA_ALPHA = 0.2
+# the timeout is the margin times the larger one of the p95 and the EWMA
+TIMEOUT_MARGIN = 2.0
+
+## get the value at the percentile of the sorted samples (nearest rank)
+def get_percentile(sorted_samples, percent):
+    if not sorted_samples:
+        return None
+    idx = int(round(percent / 100.0 * (len(sorted_samples) - 1)))
+    return sorted_samples[idx]
+
+## TimeoutModel Class
+#
+#  The latency history of a device for each class of the operations, such as 'prompt', 'show', 'commit', 'reboot' and 'opkg'.
+#  The timeout of a class is derived from the p95 and the EWMA of the recent latencies, and stays at the default
+#  until there are MIN_SAMPLES of them. Only the operations finished in time are recorded.
+#  The history is kept in a local JSON file for each device, the model without a key lives in memory only.
+class TimeoutModel():
+    def __init__(self, key=None, path=None):
+        if not path:
+            path = get_cache_dir('timeouts')
+        self.key = key
+        self.path = path
+        # {class: {'samples': [seconds, ...], 'ewma': seconds}}
+        self.history = {}
+        self._dirty = False
+        if key:
+            self.load()
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    def _get_filename(self):
+        return os.path.join(self.path, re.sub(r'[^A-Za-z0-9._@-]', '_', self.key) + ".json")
+
+    ## load the history of the device
+    def load(self):
+        filename = self._get_filename()
+        if not os.path.exists(filename):
+            return False
+        try:
+            with open(filename, "r") as fp:
+                history = json.load(fp)
+        except (OSError, ValueError) as e:
+            L.warning("ignore the broken timeout history '{0}': {1}".format(filename, e))
+            return False
+        if not isinstance(history, dict):
+            return False
+        self.history = history
+        return True
+
+    ## save the history of the device if it's changed
+    def save(self):
+        if not self.key or not self._dirty:
+            return True
+        filename = self._get_filename()
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fn_tmp = filename + ".tmp"
+            with open(fn_tmp, "w") as fp:
+                json.dump(self.history, fp, indent=2, sort_keys=True)
+            os.replace(fn_tmp, filename)
+        except OSError as e:
+            L.error("unable to save the timeout history '{0}': {1}".format(filename, e))
+            return False
+        self._dirty = False
+        return True
+
+    ## record the latency of an operation finished in time
+    #  @param name The class of the operation, such as 'prompt'.
+    #  @param seconds The latency.
+    def record(self, name, seconds):
+        item = self.history.setdefault(name, { 'samples': [], 'ewma': seconds })
+        item['samples'].append(round(seconds, 3))
+        del item['samples'][:-MAX_SAMPLES]
+        item['ewma'] = round(EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * item['ewma'], 3)
+        self._dirty = True
+
+    ## get the timeout of a class of the operations
+    #  @param name The class of the operation.
+    #  @param default The timeout before the class is learned, DEFAULT_TIMEOUTS[name] if not set.
+    def get_timeout(self, name, default=None):
+        if default is None:
+            default = DEFAULT_TIMEOUTS[name]
+        item = self.history.get(name)
+        if not item or len(item['samples']) < MIN_SAMPLES:
+            return default
+        p95 = get_percentile(sorted(item['samples']), 95)
+        timeout = TIMEOUT_MARGIN * max(p95, item['ewma'])
+        return min(max(timeout, MIN_TIMEOUTS.get(name, 1)), MAX_TIMEOUTS.get(name, default))
+
+    ## get the interval of polling the device, such as waiting between the wake-ups of the console
+    #  @param name The class of the operation.
+    #  @param default The interval before the class is learned, it's also the max interval.
+    def get_poll_interval(self, name, default):
+        item = self.history.get(name)
+        if not item or len(item['samples']) < MIN_SAMPLES:
+            return default
+        return min(max(item['ewma'], 0.1), default)
+
+    ## get the statistics of the history
+    #  @return a dict of {class: {'count', 'ewma', 'p50', 'p95', 'timeout'}}
+    def get_stats(self):
+        stats = {}
+        for name, item in self.history.items():
+            samples = sorted(item['samples'])
+            stats[name] = { 'count': len(samples), 'ewma': item['ewma'], 'p50': get_percentile(samples, 50),
+                'p95': get_percentile(samples, 95), 'timeout': self.get_timeout(name, DEFAULT_TIMEOUTS.get(name, 0)) }
+        return stats
+
+if __name__ == '__main__':
+    import unittest
+    import tempfile
+    class myTest(unittest.TestCase):
+        def setUp(self):
+            pass
+        def tearDown(self):
+            pass
+
+        def test_get_percentile(self):
+            self.assertEqual(get_percentile([], 95), None)
+            self.assertEqual(get_percentile([1, 2, 3, 4, 5], 50), 3)
+            self.assertEqual(get_percentile(list(range(101)), 95), 95)
+
+        def test_learn(self):
+            model = TimeoutModel()
+            # the defaults for the unseen device
+            self.assertEqual(model.get_timeout('prompt'), 5)
+            self.assertEqual(model.get_timeout('prompt', 3), 3)
+            self.assertEqual(model.get_poll_interval('prompt', 2), 2)
+            for i in range(MIN_SAMPLES - 1):
+                model.record('prompt', 0.2)
+            self.assertEqual(model.get_timeout('prompt', 3), 3)
+            model.record('prompt', 0.2)
+            # a fast console, the timeout is not less than the min
+            self.assertEqual(model.get_timeout('prompt', 3), 1)
+            self.assertAlmostEqual(model.get_poll_interval('prompt', 2), 0.2)
+            # a slow reboot, the timeout follows the p95
+            for i in range(20):
+                model.record('reboot', 100 + i)
+            self.assertEqual(model.get_timeout('reboot'), 2 * 118)
+            # limited by the max
+            for i in range(10):
+                model.record('show', 1000)
+            self.assertEqual(model.get_timeout('show'), MAX_TIMEOUTS['show'])
+            self.assertEqual(model.get_stats()['reboot']['count'], 20)
+
+        def test_store(self):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                model = TimeoutModel('openwrtuci-/dev/ttyUSB0', tmpdir)
+                for i in range(MAX_SAMPLES + 10):
+                    model.record('commit', 8)
+                self.assertTrue(model.save())
+                self.assertTrue(os.path.exists(os.path.join(tmpdir, 'openwrtuci-_dev_ttyUSB0.json')))
+                model2 = TimeoutModel('openwrtuci-/dev/ttyUSB0', tmpdir)
+                self.assertEqual(len(model2.history['commit']['samples']), MAX_SAMPLES)
+                self.assertEqual(model2.get_timeout('commit'), 16)
+                self.assertEqual(TimeoutModel('openwrtuci-/dev/ttyUSB1', tmpdir).get_timeout('commit'), 120)
+
+    unittest.main()